@@ -0,0 +1,388 @@
+import hashlib
+import json
+import os
+from array import array
+import numpy as np
+
+META_FILE = 'meta.json'
+
+
+def is_artifact(path):
+    return os.path.isfile(os.path.join(path, META_FILE))
+
+
+def pick_artifact(binary_path, text_path):
+    return binary_path if is_artifact(binary_path) or not os.path.exists(text_path) else text_path
+
+
+def fingerprint(path):
+    # Content hash of an artifact folder or text file, recorded by artifacts
+    # derived from it so stale ones can be told apart.
+    digest = hashlib.sha256()
+    paths = ([os.path.join(path, name) for name in sorted(os.listdir(path))]
+             if os.path.isdir(path) else [path])
+    for file_path in paths:
+        digest.update(os.path.basename(file_path).encode('utf-8'))
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_array(directory, name, values):
+    np.save(os.path.join(directory, name + '.npy'), np.ascontiguousarray(values))
+
+
+def _read_array(directory, name, mmap):
+    return np.load(os.path.join(directory, name + '.npy'), mmap_mode='r' if mmap else None)
+
+
+def _write_json(directory, name, value):
+    with open(os.path.join(directory, name), 'w', encoding='utf-8') as f:
+        json.dump(value, f)
+
+
+def _read_json(directory, name):
+    with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_meta(directory, kind, **fields):
+    # meta.json goes last, so a half-written artifact never looks complete.
+    _write_json(directory, META_FILE, dict(fields, kind=kind, version=1))
+
+
+def _read_meta(directory, kind):
+    meta = _read_json(directory, META_FILE)
+    if meta.get('kind') != kind:
+        raise ValueError(directory + ' holds a ' + str(meta.get('kind')) +
+                         ' artifact, not ' + kind)
+    return meta
+
+
+def _start(directory):
+    os.makedirs(directory, exist_ok=True)
+    if is_artifact(directory):
+        os.remove(os.path.join(directory, META_FILE))
+
+
+def save_matrix(directory, matrix, row_ids, columns):
+    from scipy import sparse
+    matrix = sparse.csr_matrix(matrix)
+    _start(directory)
+    _write_array(directory, 'data', matrix.data)
+    _write_array(directory, 'indices', matrix.indices)
+    _write_array(directory, 'indptr', matrix.indptr)
+    _write_array(directory, 'row_ids', np.array(row_ids, dtype=str))
+    _write_json(directory, 'columns.json', list(columns))
+    _write_meta(directory, 'sparse_matrix', shape=list(matrix.shape))
+
+
+def load_matrix(directory, mmap=True):
+    from scipy import sparse
+    meta = _read_meta(directory, 'sparse_matrix')
+    matrix = sparse.csr_matrix((_read_array(directory, 'data', mmap),
+                                _read_array(directory, 'indices', mmap),
+                                _read_array(directory, 'indptr', mmap)),
+                               shape=tuple(meta['shape']), copy=False)
+    return matrix, _read_array(directory, 'row_ids', mmap), _read_json(directory, 'columns.json')
+
+
+def save_columns(directory, columns):
+    _start(directory)
+    for name, values in columns.items():
+        _write_array(directory, name, np.asarray(values))
+    _write_meta(directory, 'columns', columns=list(columns))
+
+
+def load_columns(directory, mmap=True):
+    meta = _read_meta(directory, 'columns')
+    return {name: _read_array(directory, name, mmap) for name in meta['columns']}
+
+
+TOP_GAMES = 10
+MAX_PLAYTIME = 2 ** 32 - 1
+
+
+class LibraryTable:
+    # Full libraries stored CSR style: per-row game columns and playtimes, each
+    # row sorted by descending playtime. games and appids describe the columns.
+    # The top games of a row are its first entries, which is what top() reads.
+    def __init__(self, steamids, games, indptr, game_index, playtimes, appids=None):
+        self.steamids = steamids
+        self.games = games
+        self.indptr = indptr
+        self.game_index = game_index
+        self.playtimes = playtimes
+        self.appids = np.zeros(len(games), dtype=np.int32) if appids is None else appids
+        self._rows = None
+
+    def __len__(self):
+        return len(self.steamids)
+
+    def row(self, steamid):
+        if self._rows is None:
+            self._rows = {str(id): row for row, id in enumerate(self.steamids)}
+        return self._rows.get(str(steamid))
+
+    def entries(self, row):
+        start, end = self.indptr[row], self.indptr[row + 1]
+        return self.game_index[start:end], self.playtimes[start:end]
+
+    def library(self, row):
+        return {self.games[game]: int(playtime) for game, playtime in zip(*self.entries(row))}
+
+    def get(self, steamid, default=None):
+        row = self.row(steamid)
+        if row is None:
+            return default
+        return self.library(row)
+
+    def items(self):
+        for row, steamid in enumerate(self.steamids):
+            yield str(steamid), self.library(row)
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def appid_map(self):
+        # Name to appid for the games these rows hold, the game_ids.json layout.
+        return {self.games[game]: int(self.appids[game])
+                for game in np.unique(np.asarray(self.game_index))}
+
+    def top(self, count=TOP_GAMES):
+        return TopGames(self, count)
+
+
+class TopGames(LibraryTable):
+    # The first count games of every row of a full table. Single rows are
+    # sliced straight from the full (possibly memory-mapped) arrays; the flat
+    # indptr, game_index and playtimes are only built when first asked for.
+    def __init__(self, full, count):
+        self.full = full
+        self.count = count
+        self.steamids = full.steamids
+        self.games = full.games
+        self.appids = full.appids
+        self._rows = None
+        self._arrays = None
+
+    def entries(self, row):
+        start = self.full.indptr[row]
+        end = min(self.full.indptr[row + 1], start + self.count)
+        return self.full.game_index[start:end], self.full.playtimes[start:end]
+
+    def _flat(self):
+        if self._arrays is None:
+            indptr = np.asarray(self.full.indptr)
+            lengths = np.minimum(np.diff(indptr), self.count)
+            top_indptr = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+            positions = (np.repeat(indptr[:-1] - top_indptr[:-1], lengths) +
+                         np.arange(top_indptr[-1]))
+            self._arrays = (top_indptr, np.asarray(self.full.game_index)[positions],
+                            np.asarray(self.full.playtimes)[positions])
+        return self._arrays
+
+    @property
+    def indptr(self):
+        return self._flat()[0]
+
+    @property
+    def game_index(self):
+        return self._flat()[1]
+
+    @property
+    def playtimes(self):
+        return self._flat()[2]
+
+    def top(self, count=TOP_GAMES):
+        return self.full.top(min(count, self.count))
+
+
+class LibraryTableWriter:
+    # Games are interned by appid when one is known, so a renamed game keeps
+    # its column and takes the newest name; games without an appid are keyed
+    # by name.
+    def __init__(self):
+        self.steamids = []
+        self.columns = {}
+        self.games = []
+        self.appids = array('i')
+        self.indptr = array('q', [0])
+        self.game_index = array('i')
+        self.playtimes = array('I')
+
+    def _column(self, game, appid):
+        key = appid or game
+        column = self.columns.get(key)
+        if column is None:
+            column = self.columns[key] = len(self.games)
+            self.games.append(game)
+            self.appids.append(appid)
+        else:
+            self.games[column] = game
+        return column
+
+    def _append(self, steamid, games):
+        # games holds (name, appid, playtime) in descending playtime order.
+        self.steamids.append(steamid)
+        for game, appid, playtime in games:
+            self.game_index.append(self._column(game, appid))
+            self.playtimes.append(min(max(int(playtime), 0), MAX_PLAYTIME))
+        self.indptr.append(len(self.game_index))
+
+    def add(self, steamid, library, appids=None):
+        appids = appids or {}
+        # A stable sort, so games with equal playtime keep the library's order.
+        ranked = sorted(library.items(), key=lambda item: item[1], reverse=True)
+        self._append(steamid, [(game, int(appids.get(game) or 0), playtime)
+                               for game, playtime in ranked])
+
+    def add_row(self, table, row):
+        # Copies a row of another table along with its appids.
+        games, playtimes = table.entries(row)
+        self._append(str(table.steamids[row]),
+                     [(table.games[game], int(table.appids[game]), playtime)
+                      for game, playtime in zip(games, playtimes)])
+
+    def table(self):
+        return LibraryTable(np.array(self.steamids, dtype=str), list(self.games),
+                            np.frombuffer(self.indptr, dtype=np.int64),
+                            np.frombuffer(self.game_index, dtype=np.int32),
+                            np.frombuffer(self.playtimes, dtype=np.uint32),
+                            np.frombuffer(self.appids, dtype=np.int32))
+
+    def save(self, directory):
+        save_library_table(directory, self.table())
+
+
+def save_library_table(directory, table):
+    _start(directory)
+    _write_array(directory, 'steamids', np.asarray(table.steamids, dtype=str))
+    _write_array(directory, 'indptr', np.asarray(table.indptr, dtype=np.int64))
+    _write_array(directory, 'game_index', np.asarray(table.game_index, dtype=np.int32))
+    _write_array(directory, 'playtimes',
+                 np.clip(np.asarray(table.playtimes), 0, MAX_PLAYTIME).astype(np.uint32))
+    _write_array(directory, 'appids', np.asarray(table.appids, dtype=np.int32))
+    _write_json(directory, 'games.json', list(table.games))
+    _write_meta(directory, 'libraries', count=len(table.steamids))
+
+
+def libraries_from_dict(libraries_dict, appids=None):
+    writer = LibraryTableWriter()
+    for steamid, library in libraries_dict.items():
+        writer.add(steamid, library, appids)
+    return writer
+
+
+def save_libraries(directory, libraries_dict):
+    libraries_from_dict(libraries_dict).save(directory)
+
+
+def load_libraries(path, mmap=True):
+    if not is_artifact(path):
+        # A libraries.json export.
+        with open(path, 'r', encoding='utf-8') as f:
+            return libraries_from_dict(json.load(f)).table()
+    _read_meta(path, 'libraries')
+    # Tables written before appids were kept only have the top ten games.
+    appids = (_read_array(path, 'appids', mmap)
+              if os.path.exists(os.path.join(path, 'appids.npy')) else None)
+    return LibraryTable(_read_array(path, 'steamids', mmap),
+                        _read_json(path, 'games.json'),
+                        _read_array(path, 'indptr', mmap),
+                        _read_array(path, 'game_index', mmap),
+                        _read_array(path, 'playtimes', mmap), appids)
+
+
+class RankedGames:
+    # Per-cluster game lists ranked by total playtime, stored CSR style.
+    def __init__(self, clusters, indptr, game_index, playtimes, games, labels=None):
+        self.clusters = clusters
+        self.indptr = indptr
+        self.game_index = game_index
+        self.playtimes = playtimes
+        self.games = games
+        # Fingerprint of the cluster labels the ranking was built from.
+        self.labels = labels
+        self._positions = {int(cluster): i for i, cluster in enumerate(clusters)}
+
+    def __len__(self):
+        return len(self.clusters)
+
+    def ranked(self, cluster):
+        position = self._positions.get(int(cluster))
+        if position is None:
+            return
+        start, end = self.indptr[position], self.indptr[position + 1]
+        for game, playtime in zip(self.game_index[start:end], self.playtimes[start:end]):
+            yield self.games[game], int(playtime)
+
+    def top_games(self, cluster, exclude=(), count=3):
+        top = []
+        for game, playtime in self.ranked(cluster):
+            if game not in exclude:
+                top.append((game, playtime))
+                if len(top) == count:
+                    break
+        return top
+
+
+def save_ranked_games(directory, ranked, labels=None):
+    _start(directory)
+    _write_array(directory, 'clusters', np.asarray(ranked.clusters, dtype=np.int64))
+    _write_array(directory, 'indptr', np.asarray(ranked.indptr, dtype=np.int64))
+    _write_array(directory, 'game_index', np.asarray(ranked.game_index, dtype=np.int32))
+    _write_array(directory, 'playtimes', np.asarray(ranked.playtimes, dtype=np.int64))
+    _write_json(directory, 'games.json', list(ranked.games))
+    _write_meta(directory, 'ranked_games', count=len(ranked.clusters), labels=labels)
+
+
+def load_ranked_games(directory, mmap=True):
+    meta = _read_meta(directory, 'ranked_games')
+    return RankedGames(_read_array(directory, 'clusters', mmap),
+                       _read_array(directory, 'indptr', mmap),
+                       _read_array(directory, 'game_index', mmap),
+                       _read_array(directory, 'playtimes', mmap),
+                       _read_json(directory, 'games.json'), meta.get('labels'))
+
+
+class CorePoints:
+    # A fitted DBSCAN model's core samples and their raw cluster labels, which
+    # is all it takes to place new rows into the existing clusters.
+    def __init__(self, matrix, row_ids, labels, columns, eps, min_samples):
+        self.matrix = matrix
+        self.row_ids = row_ids
+        self.labels = labels
+        self.columns = columns
+        self.eps = eps
+        self.min_samples = min_samples
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+
+def save_core_points(directory, core):
+    from scipy import sparse
+    matrix = sparse.csr_matrix(core.matrix)
+    _start(directory)
+    _write_array(directory, 'data', matrix.data)
+    _write_array(directory, 'indices', matrix.indices)
+    _write_array(directory, 'indptr', matrix.indptr)
+    _write_array(directory, 'row_ids', np.array(core.row_ids, dtype=str))
+    _write_array(directory, 'labels', np.asarray(core.labels, dtype=np.int64))
+    _write_json(directory, 'columns.json', list(core.columns))
+    _write_meta(directory, 'core_points', shape=list(matrix.shape), eps=float(core.eps),
+                min_samples=int(core.min_samples))
+
+
+def load_core_points(directory, mmap=True):
+    from scipy import sparse
+    meta = _read_meta(directory, 'core_points')
+    matrix = sparse.csr_matrix((_read_array(directory, 'data', mmap),
+                                _read_array(directory, 'indices', mmap),
+                                _read_array(directory, 'indptr', mmap)),
+                               shape=tuple(meta['shape']), copy=False)
+    return CorePoints(matrix, _read_array(directory, 'row_ids', mmap),
+                      _read_array(directory, 'labels', mmap),
+                      _read_json(directory, 'columns.json'), meta['eps'], meta['min_samples'])
@@ -0,0 +1,236 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+from scipy import sparse
+from sklearn.neighbors import NearestNeighbors
+from artifacts import (LibraryTableWriter, fingerprint, is_artifact, load_columns,
+                       load_core_points, load_libraries, save_columns, save_ranked_games)
+from buildindex import INDEX_PATH, build_index
+from createclusters import (CORE_POINTS_PATH, DENSE_LIMIT_BYTES, STATS_PATH, cluster_tag_sums,
+                            save_cluster_stats, top_tag_names)
+from createinputdata import (EXCLUDE_TAGS, create_sparse_tag_time_matrix, load_json_file,
+                             sparse_max_scale_normalization)
+from instrument import run_report, stage
+
+LIBRARIES_PATH = '../data/libraries'
+APPIDS_PATH = '../data/game_ids.json'
+LABELS_PATH = '../data/dbscan_cluster_labels'
+MERGED_LABELS_PATH = '../data/merged_dbscan_cluster_labels'
+QUERY_CHUNK_ROWS = 10000
+
+
+def load_new_libraries(path):
+    # A getlibraries checkpoint (.jsonl) brings the new games' appids along;
+    # a libraries artifact or JSON export is just the libraries.
+    if not path.endswith('.jsonl'):
+        return load_libraries(path), {}
+    writer = LibraryTableWriter()
+    added = set()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if record['library'] and record['steamid'] not in added:
+                writer.add(record['steamid'], record['library'], record['appids'])
+                added.add(record['steamid'])
+    libraries = writer.table()
+    return libraries, libraries.top().appid_map()
+
+
+def tag_vectors(libraries, game_tags, tags):
+    # The rows createinputdata would build, on the fitted tag vocabulary.
+    # Playtime on games without scraped tags or on tags the fit never saw
+    # cannot be placed, and is counted for the drift check instead.
+    libraries = libraries.top()
+    matrix, library_ids, new_tags = create_sparse_tag_time_matrix(game_tags, libraries,
+                                                                  EXCLUDE_TAGS)
+    column = {tag: i for i, tag in enumerate(tags)}
+    mapping = np.array([column.get(tag, -1) for tag in new_tags] + [-1], dtype=np.int64)
+    coo = matrix.tocoo()
+    cols = mapping[coo.col]
+    known = cols >= 0
+    aligned = sparse.csr_matrix((coo.data[known], (coo.row[known], cols[known])),
+                                shape=(matrix.shape[0], len(tags)))
+
+    # Playtime and unplaceable playtime per library, so callers can leave
+    # out rows they have counted before.
+    playtimes = np.asarray(libraries.playtimes, dtype=np.float64)
+    rows = np.repeat(np.arange(len(library_ids)), np.diff(np.asarray(libraries.indptr)))
+    tagged = np.array([game in game_tags for game in libraries.games] + [False], dtype=bool)
+    untagged = ~tagged[np.asarray(libraries.game_index)]
+    unknown = (np.bincount(rows[untagged], playtimes[untagged], minlength=len(library_ids)) +
+               np.bincount(coo.row[~known], coo.data[~known], minlength=len(library_ids)))
+    return sparse_max_scale_normalization(aligned).tocsr(), library_ids, \
+        np.bincount(rows, playtimes, minlength=len(library_ids)), unknown
+
+
+def densify(matrix):
+    if matrix.shape[0] * matrix.shape[1] * 8 <= DENSE_LIMIT_BYTES:
+        return matrix.toarray()
+    return matrix
+
+
+def assign_to_core_points(vectors, core, n_jobs=None):
+    # A new row joins the cluster of its nearest core point if that point is
+    # within eps, like a border point in the original fit; otherwise it is
+    # noise. New rows never become core points themselves, that needs a refit.
+    if len(core) == 0:
+        return np.full(vectors.shape[0], -1, dtype=np.int64)
+    nn = NearestNeighbors(n_neighbors=1, n_jobs=n_jobs).fit(densify(core.matrix))
+    labels = np.empty(vectors.shape[0], dtype=np.int64)
+    for start in range(0, vectors.shape[0], QUERY_CHUNK_ROWS):
+        chunk = vectors[start:start + QUERY_CHUNK_ROWS]
+        distance, nearest = nn.kneighbors(chunk.toarray())
+        labels[start:start + chunk.shape[0]] = np.where(
+            distance[:, 0] <= core.eps, np.asarray(core.labels)[nearest[:, 0]], -1)
+    return labels
+
+
+def upsert_columns(directory, key, new):
+    # Rows whose key is already present are overwritten, the rest appended.
+    # Returns which of the new rows replaced an existing one.
+    old = load_columns(directory, mmap=False)
+    positions = {id: i for i, id in enumerate(np.asarray(old[key], dtype=str))}
+    rows = np.array([positions.get(str(id), -1) for id in new[key]], dtype=np.int64)
+    replace = rows >= 0
+    columns = {}
+    for name, values in old.items():
+        incoming = np.asarray(new[name])
+        values = np.asarray(values).astype(np.result_type(values, incoming))
+        values[rows[replace]] = incoming[replace]
+        columns[name] = np.concatenate([values, incoming[~replace]])
+    save_columns(directory, columns)
+    return replace
+
+
+def merge_libraries(directory, new):
+    existing = load_libraries(directory, mmap=False)
+    writer = LibraryTableWriter()
+    for row, steamid in enumerate(existing.steamids):
+        replacement = new.row(steamid)
+        if replacement is None:
+            writer.add_row(existing, row)
+        else:
+            writer.add_row(new, replacement)
+    for row, steamid in enumerate(new.steamids):
+        if existing.row(steamid) is None:
+            writer.add_row(new, row)
+    table = writer.table()
+    writer.save(directory)
+    return table
+
+
+def merge_appids(filename, appids):
+    game_appids = load_json_file(filename) if os.path.exists(filename) else {}
+    game_appids.update(appids)
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(dict(sorted(game_appids.items())), f, indent=4)
+
+
+def update_stats(stats, vectors, labels, playtime, unknown_playtime, new=None):
+    # Only rows not counted before go into the statistics: a library that is
+    # assigned again (a re-run, or a training row) keeps its earlier share.
+    if new is not None:
+        vectors, labels = vectors[np.flatnonzero(new)], labels[new]
+        playtime, unknown_playtime = playtime[new], unknown_playtime[new]
+    clusters = sorted(int(cluster) for cluster in set(labels) if cluster >= 0)
+    for cluster, row in zip(clusters, cluster_tag_sums(vectors, labels, clusters)):
+        entry = stats['clusters'][str(cluster)]
+        entry['size'] += int((labels == cluster).sum())
+        entry['tag_sums'] = (np.asarray(entry['tag_sums']) + row).tolist()
+    assigned = stats['assigned']
+    assigned['libraries'] += len(labels)
+    assigned['noise'] += int((labels == -1).sum())
+    assigned['playtime'] += float(np.sum(playtime))
+    assigned['unknown_playtime'] += float(np.sum(unknown_playtime))
+
+
+def drift_reasons(stats, max_growth=0.25, noise_margin=0.1, max_unknown=0.1):
+    fitted, assigned = stats['fitted'], stats['assigned']
+    reasons = []
+    if not assigned['libraries']:
+        return reasons
+    growth = assigned['libraries'] / max(fitted['libraries'], 1)
+    if growth > max_growth:
+        reasons.append('{} libraries assigned since the fit, {:.0%} of the training set'.format(
+            assigned['libraries'], growth))
+    fitted_noise = fitted['noise'] / max(fitted['libraries'], 1)
+    assigned_noise = assigned['noise'] / assigned['libraries']
+    if assigned_noise > fitted_noise + noise_margin:
+        reasons.append('{:.0%} of assigned libraries are noise against {:.0%} in the fit'.format(
+            assigned_noise, fitted_noise))
+    if assigned['playtime'] and assigned['unknown_playtime'] / assigned['playtime'] > max_unknown:
+        reasons.append('{:.0%} of assigned playtime is on untagged games or new tags'.format(
+            assigned['unknown_playtime'] / assigned['playtime']))
+    shifted = [cluster for cluster, entry in stats['clusters'].items()
+               if set(top_tag_names(entry['tag_sums'], stats['tags'])) != set(entry['top_tags'])]
+    if shifted:
+        reasons.append('clusters {} changed their top tags'.format(', '.join(shifted)))
+    return reasons
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Place new libraries into the fitted DBSCAN clusters without refitting, '
+                    'updating labels, libraries, cluster statistics and the game index.')
+    parser.add_argument('path', help='new libraries: a getlibraries --no-compact checkpoint '
+                                     '(.jsonl), a libraries artifact or a libraries.json')
+    parser.add_argument('--n-jobs', type=int, help='parallel jobs for the core point queries')
+    parser.add_argument('--max-growth', type=float, default=0.25,
+                        help='recommend a refit once assigned libraries exceed this fraction '
+                             'of the training set')
+    parser.add_argument('--noise-margin', type=float, default=0.1,
+                        help='recommend a refit when the assigned noise rate exceeds the '
+                             "fit's by this much")
+    parser.add_argument('--max-unknown', type=float, default=0.1,
+                        help='recommend a refit when this fraction of new playtime cannot be '
+                             'placed on known tags')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with stage('load'):
+        if not is_artifact(CORE_POINTS_PATH) or not os.path.exists(STATS_PATH):
+            raise SystemExit('No core points or cluster statistics found, run createclusters '
+                             'first.')
+        core = load_core_points(CORE_POINTS_PATH)
+        stats = load_json_file(STATS_PATH)
+        libraries, appids = load_new_libraries(args.path)
+        game_tags = load_json_file('../data/game_tags.json')
+    with stage('tag_vectors'):
+        vectors, library_ids, playtime, unknown = tag_vectors(libraries, game_tags, core.columns)
+    with stage('assign'):
+        labels = assign_to_core_points(vectors, core, args.n_jobs)
+        merged = np.array([stats['clusters'][str(label)]['merged'] if label >= 0 else -1
+                           for label in labels], dtype=np.int64)
+    with stage('save'):
+        ids = np.array(library_ids, dtype=str)
+        upsert_columns(LABELS_PATH, 'LibraryID', {'LibraryID': ids, 'Cluster': labels})
+        replaced = upsert_columns(MERGED_LABELS_PATH, 'LibraryID',
+                                  {'LibraryID': ids, 'Cluster': labels, 'MergedCluster': merged})
+        table = merge_libraries(LIBRARIES_PATH, libraries)
+        if appids:
+            merge_appids(APPIDS_PATH, appids)
+        update_stats(stats, vectors, labels, playtime, unknown, ~replaced)
+        stats['drift'] = drift_reasons(stats, args.max_growth, args.noise_margin,
+                                       args.max_unknown)
+        stats['refit_recommended'] = bool(stats['drift'])
+        save_cluster_stats(STATS_PATH, stats)
+    with stage('build_index'):
+        label_columns = load_columns(MERGED_LABELS_PATH)
+        save_ranked_games(INDEX_PATH, build_index(
+            np.asarray(label_columns['LibraryID'], dtype=str),
+            np.asarray(label_columns['MergedCluster']), table),
+            fingerprint(MERGED_LABELS_PATH))
+
+    print('Assigned {} libraries ({} already known, {} noise) in {:.2f}s.'.format(
+        len(labels), int(replaced.sum()), int((labels == -1).sum()), time.perf_counter() - start))
+    if stats['refit_recommended']:
+        print('A full refit is recommended (pipeline.py or createinputdata and createclusters):')
+        for reason in stats['drift']:
+            print('  -', reason)
+
+
+if __name__ == '__main__':
+    with run_report('assignclusters'):
+        main()
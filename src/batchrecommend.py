@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import aiohttp
+from tqdm import tqdm
+from getlibraries import (async_get_owned_games, async_public_check_batch, async_resolve_ids,
+                         keep_top_ten_games, load_ids)
+from instrument import run_report, stage
+from ratelimit import TokenBucket
+from recommendserver import RecommendationModel
+from responsecache import disable_cache, get_cache
+from workerpool import run_pool
+
+_scorer = {}
+
+
+def _init_scorer(model):
+    # With the default fork start method the model is inherited, not pickled.
+    _scorer['model'] = model
+
+
+def score_batch(batch):
+    results = _scorer['model'].recommend_many(
+        [(top_games, set(library.keys())) for _, _, top_games, library in batch])
+    return [dict(result, id=id, steamid=steamid)
+            for (id, steamid, _, _), result in zip(batch, results)]
+
+
+async def batch_recommend(ids, output, model, processes=None, concurrency=8,
+                          requests_per_minute=65, burst=1, batch_size=32):
+    # Fetching stays on the event loop under the rate limiter; scoring runs in
+    # worker processes a batch at a time, and every finished record is
+    # written out straight away.
+    limiter = TokenBucket.per_minute(requests_per_minute, burst, 'steam_api')
+    loop = asyncio.get_running_loop()
+    counts = {'recommended': 0, 'failed': 0}
+    batch = []
+    scoring = []
+
+    with ProcessPoolExecutor(processes, initializer=_init_scorer, initargs=(model,)) as pool, \
+            open(output, 'w', encoding='utf-8') as out, \
+            tqdm(total=len(ids), desc='Users', unit='user') as pbar:
+
+        def write(records):
+            for record in records:
+                out.write(json.dumps(record) + '\n')
+            out.flush()
+            pbar.update(len(records))
+
+        async def score(items):
+            records = await loop.run_in_executor(pool, score_batch, items)
+            counts['recommended'] += len(records)
+            write(records)
+
+        def submit():
+            scoring.append(asyncio.ensure_future(score(list(batch))))
+            batch.clear()
+
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        timeout = aiohttp.ClientTimeout(total=30)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            def fail(id, steamid, error):
+                counts['failed'] += 1
+                write([{'id': id, 'steamid': steamid, 'error': error}])
+
+            async def fetch(item):
+                id, steamid = item
+                steamid, library, appids = await async_get_owned_games(
+                    session, limiter, steamid, checked_public=True)
+                if not library:
+                    fail(id, steamid, 'Library could not be fetched, the profile may be '
+                                      'private or hidden.')
+                    return
+                batch.append((id, steamid, keep_top_ten_games(library), library))
+                if len(batch) >= batch_size:
+                    submit()
+
+            # Names are resolved and visibility checked for the whole list up
+            # front, a summaries call covers a hundred users.
+            resolved = await async_resolve_ids(session, limiter, ids, concurrency)
+            public_ids = await async_public_check_batch(
+                session, limiter, list(dict.fromkeys(
+                    steamid for steamid in resolved.values() if steamid is not None)),
+                concurrency)
+            pending = []
+            for id in ids:
+                steamid = resolved[id]
+                if steamid is None:
+                    fail(id, None, 'Custom URL could not be resolved.')
+                elif steamid not in public_ids:
+                    fail(id, steamid, 'Profile is not public.')
+                else:
+                    pending.append((id, steamid))
+            await run_pool(pending, concurrency, fetch)
+        if batch:
+            submit()
+        await asyncio.gather(*scoring)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Recommend games for every Steam ID in a file, writing one JSON '
+                    'record per user as results come in.')
+    parser.add_argument('filename', help='id list file inside ../data/')
+    parser.add_argument('--output',
+                        help='JSONL output, defaults to ../data/recommendations_<id file name>.jsonl')
+    parser.add_argument('--processes', type=int,
+                        help='scoring worker processes, defaults to the number of cores')
+    parser.add_argument('--batch-size', type=int, default=32,
+                        help='users scored per worker task')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='maximum in-flight Steam API requests')
+    parser.add_argument('--rate', type=float, default=65,
+                        help='Steam API requests per minute')
+    parser.add_argument('--burst', type=int, default=1,
+                        help='token bucket capacity')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always hit the API instead of the on-disk response cache')
+    args = parser.parse_args()
+
+    if args.no_cache:
+        disable_cache()
+    ids = list(dict.fromkeys(load_ids('../data/' + args.filename)))
+    output = args.output
+    if output is None:
+        output = '../data/recommendations_' + \
+            os.path.splitext(os.path.basename(args.filename))[0] + '.jsonl'
+
+    with stage('load_model'):
+        model = RecommendationModel.load()
+    start = time.perf_counter()
+    with stage('recommend'):
+        counts = asyncio.run(batch_recommend(ids, output, model, args.processes,
+                                             args.concurrency, args.rate, args.burst,
+                                             args.batch_size))
+    elapsed = time.perf_counter() - start
+    print('Recommended for {} users ({} failed) in {:.1f}s, {:.1f} users/sec.'.format(
+        counts['recommended'], counts['failed'], elapsed, len(ids) / elapsed))
+    print("Recommendations saved to '{}'.".format(output))
+    print(get_cache().summary())
+
+
+if __name__ == '__main__':
+    with run_report('batchrecommend'):
+        main()
@@ -0,0 +1,349 @@
+import argparse
+import asyncio
+import contextlib
+import importlib
+import io
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def dense_tag_time_matrix(ctx):
+    from createinputdata import EXCLUDE_TAGS, create_tag_time_matrix
+    ctx['dense_matrix'] = create_tag_time_matrix(
+        ctx['game_tags'], ctx['libraries'].to_dict(), EXCLUDE_TAGS)
+
+
+def dense_normalization(ctx):
+    from createinputdata import max_scale_normalization
+    max_scale_normalization(ctx['dense_matrix'])
+
+
+def tag_time_matrix(ctx):
+    from createinputdata import EXCLUDE_TAGS, create_sparse_tag_time_matrix
+    ctx['matrix'], ctx['library_ids'], ctx['tags'] = create_sparse_tag_time_matrix(
+        ctx['game_tags'], ctx['libraries'], EXCLUDE_TAGS)
+
+
+def normalization(ctx):
+    from createclusters import matrix_to_frame
+    from createinputdata import sparse_max_scale_normalization
+    scaled = sparse_max_scale_normalization(ctx['matrix'])
+    ctx['data'] = matrix_to_frame(scaled, ctx['library_ids'], ctx['tags'])
+
+
+def find_eps(ctx):
+    from createclusters import find_optimal_eps
+    n = len(ctx['library_ids'])
+    sample = ctx['args'].eps_sample if n > ctx['args'].eps_sample else None
+    _, eps = find_optimal_eps(ctx['data'], '../models/eps_plot.png', -1, sample)
+    ctx['eps'] = eps or 0.1
+
+
+def dbscan(ctx):
+    from createclusters import apply_dbscan
+    ctx['labels'] = apply_dbscan(ctx['data'], ctx['eps'], 3,
+                                 memory_limit_mb=ctx['args'].memory_limit_mb, n_jobs=-1)
+
+
+def top_tags_per_cluster(ctx):
+    from createclusters import list_top_tags_per_cluster
+    ctx['top_tags'] = list_top_tags_per_cluster(ctx['data'], ctx['labels'])
+
+
+def merge_greedy(ctx):
+    from createclusters import merge_clusters_by_tags
+    merge_clusters_by_tags(ctx['top_tags'], threshold=0.5)
+
+
+def merge_union_find(ctx):
+    import numpy as np
+    from createclusters import merge_clusters_union_find
+    merged_tags, cluster_id_map = merge_clusters_union_find(ctx['top_tags'], threshold=0.5)
+    ctx['cluster_tags'] = {str(k): v for k, v in merged_tags.items()}
+    ctx['merged_clusters'] = np.array([cluster_id_map.get(label, -1)
+                                       for label in ctx['labels']])
+
+
+def build_game_index(ctx):
+    import numpy as np
+    from buildindex import build_index
+    ctx['index'] = build_index(np.asarray(ctx['library_ids']), ctx['merged_clusters'],
+                               ctx['libraries'])
+
+
+def scoring_users(ctx):
+    if 'scoring_users' not in ctx:
+        libraries = ctx['libraries']
+        ctx['scoring_users'] = [libraries.library(row) for row in
+                                range(min(len(libraries), ctx['args'].scoring_users))]
+    return ctx['scoring_users']
+
+
+def score_python(ctx):
+    from singleuser import (BLACKLIST, calculate_similarity_scores,
+                            get_top_tags_by_playtime, normalize_scores)
+    for library in scoring_users(ctx):
+        top_tags = get_top_tags_by_playtime(library, ctx['game_tags'], BLACKLIST)
+        normalize_scores(calculate_similarity_scores(
+            [tag for tag, _ in top_tags], ctx['cluster_tags']))
+
+
+def score_vectorized(ctx):
+    from singleuser import BLACKLIST
+    from tagscoring import TagScorer
+    scorer = TagScorer(ctx['cluster_tags'], ctx['game_tags'], BLACKLIST)
+    top_tags = scorer.top_tags(scoring_users(ctx))
+    scorer.assign([[tag for tag, _ in tags] for tags in top_tags])
+
+
+# name, function, largest user count it is run for (None for no limit)
+STAGES = [
+    ('tag_time_matrix_dense', dense_tag_time_matrix, 20000),
+    ('normalization_dense', dense_normalization, 20000),
+    ('tag_time_matrix', tag_time_matrix, None),
+    ('normalization', normalization, None),
+    ('find_optimal_eps', find_eps, None),
+    ('apply_dbscan', dbscan, None),
+    ('top_tags_per_cluster', top_tags_per_cluster, None),
+    ('merge_clusters_greedy', merge_greedy, 100000),
+    ('merge_clusters', merge_union_find, None),
+    ('build_index', build_game_index, None),
+    ('scoring_python', score_python, None),
+    ('scoring', score_vectorized, None),
+]
+
+
+def measure(stage, ctx, memory, quiet=True):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output) if quiet else contextlib.nullcontext(), \
+            contextlib.redirect_stderr(output) if quiet else contextlib.nullcontext():
+        start, start_cpu = time.perf_counter(), time.process_time()
+        stage(ctx)
+        metrics = {'seconds': time.perf_counter() - start,
+                   'cpu_seconds': time.process_time() - start_cpu}
+        if memory:
+            # Tracing slows Python code down a lot, so memory gets its own run.
+            tracemalloc.start()
+            stage(ctx)
+            metrics['peak_mb'] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+    return metrics
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_stub(users, games, seed, latency, ids_file):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(SRC_DIR, 'stubsteam.py'), '--port', str(port),
+         '--users', str(users), '--games', str(games), '--seed', str(seed),
+         '--latency', str(latency), '--write-ids', ids_file],
+        cwd=SRC_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process, 'http://127.0.0.1:' + str(port)
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError('stubsteam did not start on port ' + str(port))
+
+
+def run_crawl(args, results):
+    process, base = start_stub(args.crawl_users, args.crawl_games, args.seed,
+                               args.stub_latency, os.path.abspath('../data/stub_ids.txt'))
+    # getlibraries and gettags read their base URLs on import.
+    os.environ['STEAM_API_BASE'] = base
+    os.environ['STEAM_STORE_BASE'] = base
+    try:
+        from getlibraries import LibraryCheckpoint, async_fetch_libraries, load_ids
+        from gettags import async_get_game_tag_dict
+        from responsecache import disable_cache
+        disable_cache()
+        ids = load_ids('../data/stub_ids.txt')
+        games = {'Stub Game ' + str(i): 10 * (i + 1) for i in range(args.crawl_games)}
+
+        def crawl_libraries(ctx):
+            checkpoint = LibraryCheckpoint('../data/bench_libraries.jsonl')
+            asyncio.run(async_fetch_libraries(ids, checkpoint, args.crawl_concurrency,
+                                              args.crawl_rate, args.crawl_concurrency))
+            checkpoint.close()
+            os.remove('../data/bench_libraries.jsonl')
+
+        def crawl_tags(ctx):
+            asyncio.run(async_get_game_tag_dict(games, {}, args.crawl_rate / 60,
+                                                args.crawl_concurrency))
+
+        for name, stage, count in (('crawl_libraries', crawl_libraries, len(ids)),
+                                   ('crawl_tags', crawl_tags, len(games))):
+            metrics = measure(stage, {}, memory=False)
+            metrics['items_per_second'] = count / metrics['seconds']
+            results[name + '@' + str(count)] = dict(metrics, stage=name, size=count)
+            report_line(name, count, metrics)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+# Stages nothing else depends on; they only run when asked for.
+OPTIONAL_STAGES = {'tag_time_matrix_dense', 'normalization_dense', 'merge_clusters_greedy',
+                   'scoring_python', 'scoring'}
+
+
+def warm_imports():
+    # Import the stage modules, and the libraries they load lazily, up front
+    # so no stage is charged for loading pandas, sklearn or matplotlib.
+    for module in ('buildindex', 'createclusters', 'createinputdata', 'singleuser',
+                   'tagscoring', 'pandas', 'scipy.sparse.csgraph', 'sklearn.neighbors',
+                   'sklearn.cluster', 'kneed', 'matplotlib.pyplot'):
+        importlib.import_module(module)
+
+
+def run_size(args, users, results):
+    from synthdata import generate_dataset
+    libraries, game_tags, _ = generate_dataset(users, args.games, args.tags, args.seed)
+    ctx = {'args': args, 'libraries': libraries, 'game_tags': game_tags}
+    names = [name for name, _, _ in STAGES]
+    selected = set(args.stages.split(',')) if args.stages else set(names)
+    if 'normalization_dense' in selected:
+        selected.add('tag_time_matrix_dense')
+    last = max(names.index(name) for name in selected)
+    for name, stage, limit in STAGES[:last + 1]:
+        wanted = name in selected
+        if not wanted and name in OPTIONAL_STAGES:
+            continue
+        if limit is not None and users > limit:
+            print('{:<24}{:>10}  skipped above {} users'.format(name, users, limit))
+            continue
+        metrics = measure(stage, ctx, memory=args.memory and wanted)
+        if wanted:
+            results[name + '@' + str(users)] = dict(metrics, stage=name, size=users)
+            report_line(name, users, metrics)
+
+
+def report_line(name, size, metrics):
+    line = '{:<24}{:>10}{:>10.3f}{:>10.3f}'.format(
+        name, size, metrics['seconds'], metrics['cpu_seconds'])
+    line += '{:>10.1f}'.format(metrics['peak_mb']) if 'peak_mb' in metrics else '{:>10}'.format('-')
+    if 'items_per_second' in metrics:
+        line += '  {:.1f}/s'.format(metrics['items_per_second'])
+    print(line)
+
+
+def compare(results, baseline, tolerance, min_seconds=0.05):
+    regressions = []
+    print('\n{:<34}{:>12}{:>12}{:>10}'.format('stage@size', 'baseline s', 'now s', 'ratio'))
+    for key, metrics in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        ratio = metrics['seconds'] / base['seconds'] if base['seconds'] else float('inf')
+        flag = ''
+        if ratio > tolerance and metrics['seconds'] > min_seconds:
+            flag = '  slower'
+        if 'peak_mb' in metrics and 'peak_mb' in base and base['peak_mb'] and \
+                metrics['peak_mb'] / base['peak_mb'] > tolerance:
+            flag += '  more memory'
+        if flag:
+            regressions.append(key)
+        print('{:<34}{:>12.3f}{:>12.3f}{:>10.2f}{}'.format(
+            key, base['seconds'], metrics['seconds'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time and memory-profile every pipeline stage on seeded synthetic '
+                    'data and compare against a stored baseline.')
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='comma separated user counts, e.g. 1000,10000,100000,1000000')
+    parser.add_argument('--games', type=int, default=2000)
+    parser.add_argument('--tags', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', help='comma separated stage names to report, default all: ' +
+                        ', '.join(name for name, _, _ in STAGES))
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip the tracemalloc pass')
+    parser.add_argument('--eps-sample', type=int, default=5000,
+                        help='libraries sampled for the eps estimate on larger sizes')
+    parser.add_argument('--memory-limit-mb', type=int,
+                        help='run DBSCAN on the chunked neighbor graph within this much memory')
+    parser.add_argument('--scoring-users', type=int, default=2000,
+                        help='users scored in the scoring stages')
+    parser.add_argument('--crawl', action='store_true',
+                        help='also benchmark the library and store crawls against stubsteam')
+    parser.add_argument('--crawl-users', type=int, default=2000)
+    parser.add_argument('--crawl-games', type=int, default=500)
+    parser.add_argument('--crawl-rate', type=float, default=60000,
+                        help='requests per minute allowed during the crawl benchmarks')
+    parser.add_argument('--crawl-concurrency', type=int, default=32)
+    parser.add_argument('--stub-latency', type=float, default=0.02,
+                        help='seconds stubsteam adds to every response')
+    parser.add_argument('--output', default='../models/bench_results.json')
+    parser.add_argument('--baseline', default='../models/bench_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.5,
+                        help='ratio to the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline)
+    # Stages write their usual ../data and ../models files, so they run in a
+    # scratch workspace. The benchmarks never talk to the real Steam API.
+    os.environ.setdefault('STEAM_API_KEY', 'benchmark')
+    results = {}
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workspace:
+        for name in ('data', 'models', 'src'):
+            os.makedirs(os.path.join(workspace, name))
+        os.chdir(os.path.join(workspace, 'src'))
+        try:
+            print('{:<24}{:>10}{:>10}{:>10}{:>10}'.format('stage', 'size', 'wall s', 'cpu s',
+                                                          'peak MB'))
+            if args.crawl:
+                run_crawl(args, results)
+            warm_imports()
+            for users in (int(size) for size in args.sizes.split(',')):
+                run_size(args, users, results)
+        finally:
+            os.chdir(cwd)
+
+    from instrument import peak_rss_mb
+    report = {'python': platform.python_version(), 'machine': platform.machine(),
+              'cpus': os.cpu_count(), 'seed': args.seed, 'peak_rss_mb': peak_rss_mb(),
+              'results': results}
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print("Results saved to '{}'.".format(args.output))
+
+    if args.save_baseline:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print("Baseline saved to '{}'.".format(args.baseline))
+    elif os.path.exists(baseline_path):
+        with open(baseline_path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(len(regressions), 'regressions over', args.tolerance, 'x the baseline.')
+            raise SystemExit(1)
+        print('No regressions against the baseline.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+HEAVY = ('numpy', 'scipy', 'pandas', 'sklearn', 'matplotlib', 'kneed', 'bs4', 'requests',
+         'aiohttp')
+# Import time budget in milliseconds for each entry point, and the heavy
+# libraries it may load before main() runs. Anything else has to wait for the
+# code path that uses it.
+BUDGETS = {
+    'singleuser': (300, {'numpy'}),
+    'getlibraries': (250, set()),
+    'gettags': (250, set()),
+    'getgroupids': (600, {'numpy', 'aiohttp'}),
+    'createinputdata': (500, {'numpy', 'scipy'}),
+    'createclusters': (500, {'numpy', 'scipy'}),
+    'buildindex': (300, {'numpy'}),
+    'assignclusters': (1500, {'numpy', 'scipy', 'sklearn'}),
+    'sweepclusters': (2000, {'numpy', 'scipy', 'pandas', 'sklearn'}),
+    'recommendserver': (800, {'numpy', 'scipy', 'aiohttp'}),
+    'batchrecommend': (900, {'numpy', 'scipy', 'aiohttp'}),
+    'pipeline': (150, set()),
+    'synthdata': (300, {'numpy'}),
+}
+
+
+def import_profile(module, env):
+    # A fresh interpreter per sample. -X importtime lists every module the
+    # import loaded, nested under its importer, with cumulative microseconds.
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                            cwd=SRC_DIR, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError('import {} failed:\n{}'.format(
+            module, '\n'.join(result.stderr.splitlines()[-5:])))
+    total = 0
+    loaded = set()
+    direct = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        loaded.add(name.strip().split('.')[0])
+        if name == ' ' + module:
+            total = int(cumulative)
+        elif name.startswith('   ') and not name.startswith('     '):
+            direct[name.strip()] = int(cumulative)
+    return total / 1000, wall * 1000, loaded, direct
+
+
+def interpreter_ms(env, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], cwd=SRC_DIR, env=env, check=True)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples)
+
+
+def measure(module, env, repeat):
+    profiles = [import_profile(module, env) for _ in range(repeat)]
+    direct = {}
+    for _, _, _, imports in profiles:
+        for name, value in imports.items():
+            direct.setdefault(name, []).append(value / 1000)
+    return {'import_ms': statistics.median(profile[0] for profile in profiles),
+            'wall_ms': statistics.median(profile[1] for profile in profiles),
+            'heavy': sorted(set(HEAVY) & profiles[0][2]),
+            'slowest': sorted(((name, statistics.median(values)) for name, values
+                               in direct.items()), key=lambda item: -item[1])[:5]}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the import time of every entry point with -X importtime and '
+                    'check it against a per-script budget and its allowed heavy imports.')
+    parser.add_argument('--scripts', help='comma separated entry points, all by default')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='fresh interpreters per script, the median is reported')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply every budget, for slower machines')
+    parser.add_argument('--output', default='../models/startup_results.json')
+    args = parser.parse_args()
+
+    scripts = args.scripts.split(',') if args.scripts else list(BUDGETS)
+    unknown = [script for script in scripts if script not in BUDGETS]
+    if unknown:
+        raise SystemExit('No budget for ' + ', '.join(unknown))
+    # getlibraries reads the API key on import, nothing here calls the API.
+    env = dict(os.environ)
+    env.setdefault('STEAM_API_KEY', 'benchmark')
+
+    print('Interpreter start: {:.1f} ms'.format(interpreter_ms(env, args.repeat)))
+    print('{:<18}{:>11}{:>10}{:>11}  {}'.format('script', 'import ms', 'wall ms', 'budget ms',
+                                               'heavy imports'))
+    results = {}
+    failures = []
+    for script in scripts:
+        budget, allowed = BUDGETS[script]
+        budget *= args.scale
+        metrics = measure(script, env, args.repeat)
+        problems = []
+        if metrics['import_ms'] > budget:
+            problems.append('over budget')
+        extra = [name for name in metrics['heavy'] if name not in allowed]
+        if extra:
+            problems.append('loads ' + ', '.join(extra))
+        results[script] = dict(metrics, budget_ms=budget, problems=problems)
+        print('{:<18}{:>11.1f}{:>10.1f}{:>11.0f}  {}{}'.format(
+            script, metrics['import_ms'], metrics['wall_ms'], budget,
+            ', '.join(metrics['heavy']) or '-',
+            '  <- ' + '; '.join(problems) if problems else ''))
+        if problems:
+            failures.append(script)
+            for name, ms in metrics['slowest']:
+                print('{:>22} {:>8.1f} ms'.format(name, ms))
+
+    report = {'python': platform.python_version(), 'machine': platform.machine(),
+              'repeat': args.repeat, 'scale': args.scale, 'results': results}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print("Results saved to '{}'.".format(args.output))
+    if failures:
+        print(len(failures), 'scripts over their startup budget:', ', '.join(failures))
+        raise SystemExit(1)
+    print('Every script is within its startup budget.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import glob
+import os
+import random
+import sqlite3
+import time
+import zlib
+from tagextract import extract_tags_fast, extract_tags_soup
+from stubsteam import STUB_TAGS, render_store_page
+
+BLACKLIST = ['Free to Play', 'Multiplayer', 'Early Access']
+
+
+def load_saved_pages(directory):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.html'))):
+        with open(path, 'rb') as f:
+            pages.append((os.path.basename(path), f.read()))
+    return pages
+
+
+def load_cached_pages(cache_path, limit):
+    conn = sqlite3.connect(cache_path)
+    rows = conn.execute("SELECT key, body FROM responses WHERE key LIKE '%/app/%' "
+                        "AND status = 200 LIMIT ?", (limit,)).fetchall()
+    conn.close()
+    return [(key, zlib.decompress(body)) for key, body in rows]
+
+
+def generate_pages(count, seed):
+    rng = random.Random(seed)
+    tags = STUB_TAGS + ['Rock &amp; Roll', 'Shoot &#39;Em Up']
+    pages = []
+    for i in range(count):
+        appid = 10 * (i + 1)
+        if rng.random() < 0.05:
+            page = '<html><body>Welcome to Steam</body></html>'
+        else:
+            page = render_store_page(appid, rng.sample(tags, rng.randint(3, 20)))
+        pages.append((str(appid), page.encode('utf-8')))
+    return pages
+
+
+def time_parser(parser, pages, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [parser(content, BLACKLIST) for _, content in pages]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare full BeautifulSoup tag parsing with the fast extractor.')
+    parser.add_argument('--pages', help='directory of saved <appid>.html store pages')
+    parser.add_argument('--from-cache',
+                        help='read store pages out of an http_cache.sqlite file')
+    parser.add_argument('--generate', type=int, default=200,
+                        help='number of synthetic pages when no corpus is given')
+    parser.add_argument('--limit', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.pages:
+        pages = load_saved_pages(args.pages)
+    elif args.from_cache:
+        pages = load_cached_pages(args.from_cache, args.limit)
+    else:
+        pages = generate_pages(args.generate, args.seed)
+    pages = pages[:args.limit]
+    if not pages:
+        print('No store pages found.')
+        return
+
+    megabytes = sum(len(content) for _, content in pages) / (1024 * 1024)
+    print('Corpus:', len(pages), 'pages,', '{:.1f} MB'.format(megabytes))
+
+    soup_time, soup_results = time_parser(extract_tags_soup, pages, args.repeat)
+    fast_time, fast_results = time_parser(extract_tags_fast, pages, args.repeat)
+
+    print('{:<20}{:>12}{:>14}'.format('parser', 'seconds', 'pages/sec'))
+    for name, elapsed in (('beautifulsoup', soup_time), ('fast', fast_time)):
+        print('{:<20}{:>12.3f}{:>14.1f}'.format(name, elapsed, len(pages) / elapsed))
+    print('Speedup: {:.1f}x'.format(soup_time / fast_time))
+
+    mismatches = [(name, soup, fast) for (name, _), soup, fast
+                  in zip(pages, soup_results, fast_results) if soup != fast]
+    for name, soup, fast in mismatches[:10]:
+        print('Mismatch on', name + ':', soup, '!=', fast)
+    print('Outputs match on {}/{} pages.'.format(len(pages) - len(mismatches), len(pages)))
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+import argparse
+import time
+import numpy as np
+from artifacts import (RankedGames, fingerprint, is_artifact, load_columns, load_libraries,
+                       pick_artifact, save_ranked_games)
+from instrument import run_report, stage
+
+INDEX_PATH = '../data/cluster_game_index'
+
+
+def load_cluster_members(cluster_label_file):
+    if is_artifact(cluster_label_file):
+        labels = load_columns(cluster_label_file)
+        return np.asarray(labels['LibraryID'], dtype=str), np.asarray(labels['MergedCluster'])
+    import pandas as pd
+    cluster_df = pd.read_csv(cluster_label_file)
+    return (cluster_df['LibraryID'].astype(str).to_numpy(),
+            cluster_df['MergedCluster'].fillna(-1).astype(int).to_numpy())
+
+
+def gather_rows(libraries, rows):
+    # Games and playtimes of the given library rows, concatenated in row order.
+    starts = np.asarray(libraries.indptr)[rows]
+    lengths = np.asarray(libraries.indptr)[rows + 1] - starts
+    offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    positions = offsets + np.arange(lengths.sum())
+    return (np.asarray(libraries.game_index)[positions],
+            np.asarray(libraries.playtimes)[positions])
+
+
+def rank_games(games, playtimes):
+    # Ranked by total playtime; ties keep first appearance order, which is
+    # what sorting find_top_games' insertion ordered dict gives.
+    unique, first, inverse = np.unique(games, return_index=True, return_inverse=True)
+    totals = np.zeros(len(unique), dtype=np.int64)
+    np.add.at(totals, inverse, playtimes)
+    order = np.lexsort((first, -totals))
+    return unique[order], totals[order]
+
+
+def build_index(library_ids, merged_clusters, libraries, depth=None):
+    libraries = libraries.top()
+    rows = np.array([libraries.row(library_id) for library_id in library_ids], dtype=object)
+    known = np.array([row is not None for row in rows], dtype=bool)
+    clusters = np.unique(merged_clusters[known & (merged_clusters >= 0)])
+    indptr = [0]
+    game_index = []
+    playtimes = []
+    for cluster in clusters:
+        member_rows = rows[known & (merged_clusters == cluster)].astype(np.int64)
+        games, totals = rank_games(*gather_rows(libraries, member_rows))
+        game_index.append(games[:depth])
+        playtimes.append(totals[:depth])
+        indptr.append(indptr[-1] + len(game_index[-1]))
+    return RankedGames(clusters, np.array(indptr),
+                       np.concatenate(game_index) if game_index else np.array([], dtype=np.int32),
+                       np.concatenate(playtimes) if playtimes else np.array([], dtype=np.int64),
+                       list(libraries.games))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Precompute, for every merged cluster, its games ranked by total '
+                    'playtime so singleuser can recommend without re-reading training data.')
+    parser.add_argument('--depth', type=int,
+                        help='keep only this many games per cluster (default: all)')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    labels_path = pick_artifact('../data/merged_dbscan_cluster_labels',
+                                '../data/merged_dbscan_cluster_labels.csv')
+    with stage('load'):
+        library_ids, merged_clusters = load_cluster_members(labels_path)
+        libraries = load_libraries(pick_artifact('../data/libraries', '../data/libraries.json'))
+    with stage('build_index'):
+        index = build_index(library_ids, merged_clusters, libraries, args.depth)
+    with stage('save'):
+        save_ranked_games(INDEX_PATH, index, fingerprint(labels_path))
+    print('Indexed {} clusters, {} ranked games in {:.2f}s.'.format(
+        len(index), len(index.game_index), time.perf_counter() - start))
+    print("Cluster game index saved to '{}/'.".format(INDEX_PATH.split('/')[-1]))
+
+
+if __name__ == '__main__':
+    with run_report('buildindex'):
+        main()
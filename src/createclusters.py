@@ -1,23 +1,132 @@
-import pandas as pd
 import numpy as np
 import json
-import matplotlib.pyplot as plt
-from sklearn.neighbors import NearestNeighbors
-from sklearn.cluster import DBSCAN
-from kneed import KneeLocator
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from scipy import sparse
+from tqdm import tqdm
+from artifacts import (CorePoints, is_artifact, load_matrix, pick_artifact, save_columns,
+                       save_core_points)
+from instrument import run_report, stage
+
+DENSE_LIMIT_BYTES = 2 * 1024 ** 3
+CORE_POINTS_PATH = '../data/dbscan_core_points'
+STATS_PATH = '../data/cluster_stats.json'
+
+
+def matrix_to_frame(matrix, library_ids, tags):
+    import pandas as pd
+    index = pd.Index(library_ids, name='LibraryID')
+    return pd.DataFrame.sparse.from_spmatrix(matrix, index=index, columns=tags)
 
 
 def load_data(file_path):
-    return pd.read_csv(file_path, index_col='LibraryID')
+    if is_artifact(file_path):
+        return matrix_to_frame(*load_matrix(file_path))
+    import pandas as pd
+    # Library ids are strings in the artifacts, the CSV is read the same way.
+    return pd.read_csv(file_path, index_col='LibraryID', dtype={'LibraryID': str})
+
+
+def as_matrix(data, dense_limit=DENSE_LIMIT_BYTES):
+    # sklearn's tree based neighbor search is several times faster on dense
+    # input, so the sparse matrix is only kept when densifying would not fit.
+    if hasattr(data, 'sparse'):
+        matrix = data.sparse.to_coo().tocsr()
+        if matrix.shape[0] * matrix.shape[1] * 8 <= dense_limit:
+            return matrix.toarray()
+        return matrix
+    return np.asarray(data)
+
+
+def stratified_sample(strata, size, seed=0):
+    # Proportional allocation over strata, at least one row from each.
+    n = len(strata)
+    if size >= n:
+        return np.arange(n)
+    rng = np.random.default_rng(seed)
+    order = np.argsort(strata, kind='stable')
+    _, starts, counts = np.unique(strata[order], return_index=True, return_counts=True)
+    chosen = []
+    for start, count in zip(starts, counts):
+        take = min(count, max(1, int(round(size * count / n))))
+        chosen.append(rng.choice(order[start:start + count], take, replace=False))
+    return np.sort(np.concatenate(chosen))
+
+
+def k_distances(matrix, k=4, n_jobs=None, rows=None):
+    from sklearn.neighbors import NearestNeighbors
+    nbrs = NearestNeighbors(n_neighbors=k, n_jobs=n_jobs).fit(matrix)
+    queries = matrix if rows is None else matrix[rows]
+    distances, _ = nbrs.kneighbors(queries)
+    return np.sort(distances[:, k - 1])
+
+
+def fit_knee(distances, total=None, knee_points=None):
+    # x positions are scaled to the full dataset so sampled and exact elbows line up.
+    from kneed import KneeLocator
+    total = len(distances) if total is None else total
+    x = np.arange(len(distances)) * (total / len(distances))
+    y = distances
+    if knee_points and len(distances) > knee_points:
+        keep = np.linspace(0, len(distances) - 1, knee_points).round().astype(int)
+        x, y = x[keep], y[keep]
+    return KneeLocator(x, y, curve='convex', direction='increasing',
+                       interp_method='polynomial')
+
+
+def bootstrap_eps(distances, total, knee_points, rounds, seed=0):
+    rng = np.random.default_rng(seed)
+    estimates = []
+    for _ in range(rounds):
+        resample = np.sort(rng.choice(distances, len(distances), replace=True))
+        elbow_y = fit_knee(resample, total, knee_points).elbow_y
+        if elbow_y is not None:
+            estimates.append(elbow_y)
+    if not estimates:
+        return None, None
+    return np.percentile(estimates, 2.5), np.percentile(estimates, 97.5)
+
 
+def find_optimal_eps(data, plot_path, n_jobs=None, sample_size=None, knee_points=None,
+                     bootstrap=0, compare_exact=False, seed=0):
+    matrix = as_matrix(data)
+    n = matrix.shape[0]
+    rows = None
+    if sample_size and sample_size < n:
+        strata = np.asarray(matrix.argmax(axis=1)).ravel()
+        rows = stratified_sample(strata, sample_size, seed)
 
-def find_optimal_eps(data, plot_path):
-    neigh = NearestNeighbors(n_neighbors=4)
-    nbrs = neigh.fit(data)
-    distances, indices = nbrs.kneighbors(data)
-    distances = np.sort(distances, axis=0)[:, 3]
-    kneedle = KneeLocator(range(len(distances)), distances, curve='convex',
-                          direction='increasing', interp_method='polynomial')
+    start = time.perf_counter()
+    distances = k_distances(matrix, n_jobs=n_jobs, rows=rows)
+    knn_time = time.perf_counter() - start
+    start = time.perf_counter()
+    kneedle = fit_knee(distances, n, knee_points)
+    knee_time = time.perf_counter() - start
+
+    print('k-distances: {:.2f}s for {} of {} rows (n_jobs={})'.format(
+        knn_time, len(distances), n, n_jobs))
+    print('Knee fit: {:.2f}s over {} points'.format(
+        knee_time, min(len(distances), knee_points or len(distances))))
+    if kneedle.elbow_y is not None:
+        print('Estimated eps: {:.4f}'.format(kneedle.elbow_y))
+    if bootstrap and rows is not None:
+        low, high = bootstrap_eps(distances, n, knee_points, bootstrap, seed)
+        if low is not None:
+            print('Elbow 95% confidence bounds: {:.4f} - {:.4f} ({} bootstrap rounds)'.format(
+                low, high, bootstrap))
+
+    if compare_exact and (rows is not None or knee_points):
+        start = time.perf_counter()
+        exact = fit_knee(k_distances(matrix, n_jobs=n_jobs))
+        exact_time = time.perf_counter() - start
+        if exact.elbow_y is not None and kneedle.elbow_y is not None:
+            error = abs(kneedle.elbow_y - exact.elbow_y) / exact.elbow_y
+            print('Exact eps: {:.4f} in {:.2f}s, estimate is off by {:.2%}'.format(
+                exact.elbow_y, exact_time, error))
+
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(8, 4))
     kneedle.plot_knee()
     plt.xlabel('Points sorted by distance')
@@ -27,14 +136,148 @@ def find_optimal_eps(data, plot_path):
     return kneedle.elbow, kneedle.elbow_y
 
 
-def apply_dbscan(data, eps, min_samples):
-    db = DBSCAN(eps=eps, min_samples=min_samples).fit(data)
+def matrix_bytes(matrix):
+    if sparse.issparse(matrix):
+        return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+    return matrix.nbytes
+
+
+def neighbor_index_bytes(matrix):
+    # Sparse input is searched by brute force over the fitted matrix itself.
+    # Dense input gets a tree holding a float64 copy of the points and an
+    # index array, plus node bounds that are small next to those.
+    if sparse.issparse(matrix):
+        return 0
+    return matrix.shape[0] * (matrix.shape[1] * 8 + 8)
+
+
+def plan_radius_graph(matrix, memory_limit_mb, n_jobs):
+    # Splits the budget into what is fixed (this process's matrix, every
+    # worker's copy of it and its neighbor index, the graph's row pointers),
+    # the chunks in flight and the graph's edges. Half of what is left after
+    # the fixed part goes to each of the other two. Worst case every row of a
+    # chunk is within eps of every other row, so a chunk's distances take
+    # rows * n_rows * (8 byte distance + 4 byte index), once in the worker and
+    # once on its way back here.
+    n = matrix.shape[0]
+    copies = n_jobs if n_jobs > 1 else 0
+    fixed = (matrix_bytes(matrix) * (1 + copies) +
+             neighbor_index_bytes(matrix) * max(1, copies) + (n + 1) * 8)
+    available = memory_limit_mb * 1024 * 1024 - fixed
+    if available <= 0:
+        raise MemoryError('The matrix and {} neighbor indexes alone take {:.0f} MB, more than '
+                          'the {} MB memory limit. Raise the limit or use fewer --n-jobs.'.format(
+                              max(1, copies), fixed / (1024 * 1024), memory_limit_mb))
+    per_worker = available / 2 / max(1, n_jobs)
+    chunk = max(1, int(per_worker // (n * 12 * 2)))
+    edges = int(min(available / 2 // 12, n * n))
+    return chunk, edges, max(1, int(per_worker // (2 * 1024 * 1024)))
+
+
+_radius_worker = {}
+
+
+def _init_radius_worker(matrix, eps, working_memory_mb):
+    from sklearn.neighbors import NearestNeighbors
+    _radius_worker['matrix'] = matrix
+    _radius_worker['nbrs'] = NearestNeighbors(radius=eps).fit(matrix)
+    _radius_worker['working_memory'] = working_memory_mb
+
+
+def _radius_chunk(bounds):
+    from sklearn import config_context
+    start, end = bounds
+    with config_context(working_memory=_radius_worker['working_memory']):
+        return _radius_worker['nbrs'].radius_neighbors_graph(
+            _radius_worker['matrix'][start:end], mode='distance', sort_results=True)
+
+
+def radius_chunks(matrix, eps, bounds, n_jobs, working_memory):
+    # Chunks come back in row order with at most n_jobs of them in flight, so
+    # finished chunks never pile up waiting to be copied into the graph.
+    if n_jobs == 1:
+        _init_radius_worker(matrix, eps, working_memory)
+        for b in bounds:
+            yield _radius_chunk(b)
+        return
+    with ProcessPoolExecutor(n_jobs, initializer=_init_radius_worker,
+                             initargs=(matrix, eps, working_memory)) as pool:
+        pending = [pool.submit(_radius_chunk, b) for b in bounds[:n_jobs]]
+        for next_bounds in bounds[n_jobs:] + [None] * min(n_jobs, len(bounds)):
+            chunk = pending.pop(0).result()
+            if next_bounds is not None:
+                pending.append(pool.submit(_radius_chunk, next_bounds))
+            yield chunk
+
+
+def build_radius_graph(matrix, eps, memory_limit_mb=1024, n_jobs=None):
+    n_jobs = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+    n = matrix.shape[0]
+    chunk, capacity, working_memory = plan_radius_graph(matrix, memory_limit_mb, n_jobs)
+    bounds = [(start, min(start + chunk, n)) for start in range(0, n, chunk)]
+    # The graph is filled in place as chunks arrive instead of stacking a list
+    # of chunks, which would hold every edge twice.
+    index_dtype = np.int32 if max(n, capacity) < 2 ** 31 else np.int64
+    data = np.empty(capacity, dtype=np.float64)
+    indices = np.empty(capacity, dtype=index_dtype)
+    indptr = np.zeros(n + 1, dtype=index_dtype)
+    filled = 0
+    for (start, end), part in zip(bounds, tqdm(radius_chunks(matrix, eps, bounds, n_jobs,
+                                                             working_memory),
+                                               total=len(bounds), desc='Neighbor Graph')):
+        if filled + part.nnz > capacity:
+            raise MemoryError('The eps neighbor graph needs more than the {} edges that fit in '
+                              'the {} MB memory limit, consider a smaller eps.'.format(
+                                  capacity, memory_limit_mb))
+        data[filled:filled + part.nnz] = part.data
+        indices[filled:filled + part.nnz] = part.indices
+        indptr[start + 1:end + 1] = filled + part.indptr[1:]
+        filled += part.nnz
+    graph = sparse.csr_matrix((data[:filled], indices[:filled], indptr), shape=(n, n))
+    graph_mb = filled * 12 / (1024 * 1024)
+    print('Neighbor graph: {} edges, {:.1f} MB in {} chunks of {} rows'.format(
+        filled, graph_mb, len(bounds), chunk))
+    return graph
+
+
+def apply_dbscan(data, eps, min_samples, export_csv=False, memory_limit_mb=None,
+                 n_jobs=None):
+    from sklearn.cluster import DBSCAN
+    if memory_limit_mb is None:
+        matrix = as_matrix(data)
+        db = DBSCAN(eps=eps, min_samples=min_samples).fit(matrix)
+    else:
+        matrix = as_matrix(data, dense_limit=memory_limit_mb * 1024 * 1024 // 4)
+        graph = build_radius_graph(matrix, eps, memory_limit_mb, n_jobs)
+        db = DBSCAN(eps=eps, min_samples=min_samples, metric='precomputed').fit(graph)
     labels = db.labels_
-    cluster_df = pd.DataFrame({'Cluster': labels}, index=data.index)
-    cluster_df.to_csv('../data/dbscan_cluster_labels.csv')
+    core = db.core_sample_indices_
+    save_core_points(CORE_POINTS_PATH, CorePoints(
+        sparse.csr_matrix(matrix[core]), np.array(data.index, dtype=str)[core], labels[core],
+        list(data.columns), eps, min_samples))
+    save_columns('../data/dbscan_cluster_labels',
+                 {'LibraryID': np.array(data.index, dtype=str), 'Cluster': labels})
+    if export_csv:
+        import pandas as pd
+        cluster_df = pd.DataFrame({'Cluster': labels}, index=data.index)
+        cluster_df.to_csv('../data/dbscan_cluster_labels.csv')
     return labels
 
 
+def save_merged_labels(data, labels, cluster_id_map, export_csv=False):
+    merged_labels = np.array([cluster_id_map.get(label, -1) for label in labels])
+    save_columns('../data/merged_dbscan_cluster_labels',
+                 {'LibraryID': np.array(data.index, dtype=str), 'Cluster': labels,
+                  'MergedCluster': merged_labels})
+    print("Updated cluster labels with merged IDs saved to 'merged_dbscan_cluster_labels/'.")
+    if export_csv:
+        import pandas as pd
+        cluster_df = pd.DataFrame({'LibraryID': data.index, 'Cluster': labels})
+        cluster_df['MergedCluster'] = cluster_df['Cluster'].map(cluster_id_map)
+        cluster_df.to_csv('../data/merged_dbscan_cluster_labels.csv', index=False)
+        print("Updated cluster labels with merged IDs saved to 'merged_dbscan_cluster_labels.csv'.")
+
+
 def list_top_tags_per_cluster(data, labels):
     clusters = [label for label in set(labels) if label >= 0]
     top_tags = {}
@@ -78,28 +321,156 @@ def merge_clusters_by_tags(cluster_tags, threshold=0.5):
     return new_cluster_tags, cluster_id_map
 
 
+def tag_incidence_matrix(cluster_tags):
+    vocabulary = {}
+    rows, cols = [], []
+    for row, tags in enumerate(cluster_tags.values()):
+        for tag in set(tags):
+            rows.append(row)
+            cols.append(vocabulary.setdefault(tag, len(vocabulary)))
+    return sparse.csr_matrix((np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                             shape=(len(cluster_tags), len(vocabulary)))
+
+
+def merge_clusters_union_find(cluster_tags, threshold=0.5):
+    # Same outputs as merge_clusters_by_tags, but merging is transitive and
+    # does not depend on cluster order: every pair at or above the threshold
+    # is joined and each connected group becomes one merged cluster.
+    clusters = list(cluster_tags.keys())
+    if not clusters:
+        return {}, {}
+    incidence = tag_incidence_matrix(cluster_tags)
+    sizes = np.asarray(incidence.sum(axis=1)).ravel()
+    if threshold <= 0:
+        similar = sparse.csr_matrix(np.ones((len(clusters), len(clusters)), dtype=bool))
+    else:
+        # Only pairs that share a tag show up in the product.
+        shared = sparse.triu(incidence @ incidence.T, k=1).tocoo()
+        jaccard = shared.data / (sizes[shared.row] + sizes[shared.col] - shared.data)
+        keep = jaccard >= threshold
+        similar = sparse.csr_matrix((np.ones(keep.sum(), dtype=bool),
+                                     (shared.row[keep], shared.col[keep])),
+                                    shape=(len(clusters), len(clusters)))
+    from scipy.sparse.csgraph import connected_components
+    _, components = connected_components(similar, directed=False)
+
+    # Merged ids follow the order in which groups first appear, and a group
+    # keeps the tags of its first cluster.
+    new_ids = {}
+    new_cluster_tags = {}
+    cluster_id_map = {}
+    for cluster, component in zip(clusters, components):
+        if component not in new_ids:
+            new_ids[component] = len(new_ids)
+            new_cluster_tags[new_ids[component]] = cluster_tags[cluster]
+        cluster_id_map[cluster] = new_ids[component]
+    return new_cluster_tags, cluster_id_map
+
+
+def cluster_tag_sums(matrix, labels, clusters):
+    # Per-cluster column sums from one sparse product with a cluster indicator.
+    position = {cluster: i for i, cluster in enumerate(clusters)}
+    rows = np.array([position.get(label, -1) for label in labels], dtype=np.int64)
+    member = rows >= 0
+    indicator = sparse.csr_matrix((np.ones(member.sum()), (rows[member], np.flatnonzero(member))),
+                                  shape=(len(clusters), len(labels)))
+    return np.asarray((indicator @ sparse.csr_matrix(matrix)).todense())
+
+
+def top_tag_names(tag_sums, tags, count=3):
+    return [tags[i] for i in np.argsort(-np.asarray(tag_sums), kind='stable')[:count]]
+
+
+def fit_cluster_stats(data, labels, cluster_id_map, eps, min_samples):
+    # Baseline for assignclusters: sizes, tag sums and top tags of every raw
+    # cluster as fitted, plus counters for libraries assigned since.
+    tags = [str(tag) for tag in data.columns]
+    clusters = sorted(int(label) for label in set(labels) if label >= 0)
+    sums = cluster_tag_sums(data.sparse.to_coo().tocsr() if hasattr(data, 'sparse')
+                            else np.asarray(data), labels, clusters)
+    sizes = np.bincount(np.asarray(labels)[np.asarray(labels) >= 0], minlength=len(clusters))
+    return {
+        'eps': float(eps), 'min_samples': int(min_samples), 'tags': tags,
+        'fitted': {'libraries': len(labels), 'noise': int((np.asarray(labels) == -1).sum())},
+        'assigned': {'libraries': 0, 'noise': 0, 'playtime': 0.0, 'unknown_playtime': 0.0},
+        'clusters': {str(cluster): {'merged': int(cluster_id_map.get(cluster, -1)),
+                                    'fitted_size': int(sizes[cluster]),
+                                    'size': int(sizes[cluster]),
+                                    'top_tags': top_tag_names(row, tags),
+                                    'tag_sums': row.tolist()}
+                     for cluster, row in zip(clusters, sums)},
+        'refit_recommended': False, 'drift': []}
+
+
+def save_cluster_stats(filename, stats):
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(stats, f)
+
+
 def save_merged_clusters(cluster_tags, filename):
     cluster_tags_str = {str(k): v for k, v in cluster_tags.items()}
     with open(filename, 'w') as f:
         json.dump(cluster_tags_str, f)
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Cluster the scaled tag-time matrix with DBSCAN and merge similar clusters.')
+    parser.add_argument('--csv', action='store_true',
+                        help='also export the cluster labels as CSV files')
+    parser.add_argument('--n-jobs', type=int,
+                        help='parallel jobs for the k-nearest neighbor queries, -1 for all cores')
+    parser.add_argument('--eps-sample', type=int,
+                        help='estimate eps from a stratified sample of this many libraries')
+    parser.add_argument('--knee-points', type=int,
+                        help='downsample the k-distance curve to this many points for the knee fit')
+    parser.add_argument('--bootstrap', type=int, default=0,
+                        help='bootstrap rounds for confidence bounds on a sampled elbow')
+    parser.add_argument('--compare-exact', action='store_true',
+                        help='also run the exact estimate and report how far off the sampled one is')
+    parser.add_argument('--memory-limit-mb', type=int,
+                        help='build the eps neighbor graph in chunks across --n-jobs processes '
+                             'within this much memory and run DBSCAN on it, failing when the '
+                             'graph cannot fit')
+    parser.add_argument('--greedy-merge', action='store_true',
+                        help='merge clusters with the old order dependent pairwise pass')
+    parser.add_argument('--eps',
+                        help="eps to cluster with, or 'auto' for the estimated value; "
+                             'prompted for after the estimate if omitted')
+    parser.add_argument('--merge-threshold', type=float, default=0.5,
+                        help='top tag Jaccard similarity above which clusters are merged')
+    return parser.parse_args()
+
+
 def main():
-    data = load_data('../data/scaled_tag_time_matrix_excluded.csv')
-    eps, eps_y = find_optimal_eps(data, '../models/eps_plot.png')
-    new_eps = input('Input eps to use, or blank for auto-calculated value: ')
-    if new_eps == '':
-        new_eps = eps_y
+    args = parse_args()
+    with stage('load'):
+        data = load_data(pick_artifact('../data/scaled_tag_time_matrix_excluded',
+                                       '../data/scaled_tag_time_matrix_excluded.csv'))
+    new_eps = args.eps
+    if new_eps in (None, 'auto'):
+        # A given eps skips the k-distance estimate (and its plot) entirely.
+        with stage('find_eps'):
+            eps, eps_y = find_optimal_eps(data, '../models/eps_plot.png', args.n_jobs,
+                                          args.eps_sample, args.knee_points, args.bootstrap,
+                                          args.compare_exact)
+        if new_eps is None:
+            new_eps = input('Input eps to use, or blank for auto-calculated value: ')
+        if new_eps in ('', 'auto'):
+            new_eps = eps_y
     min_samples = 3
-    labels = apply_dbscan(data, float(new_eps), min_samples)
-    top_tags = list_top_tags_per_cluster(data, labels)
-    merged_tags, cluster_id_map = merge_clusters_by_tags(
-        top_tags, threshold=0.5)
+    with stage('dbscan'):
+        labels = apply_dbscan(data, float(new_eps), min_samples, args.csv,
+                              args.memory_limit_mb, args.n_jobs)
+    with stage('merge'):
+        top_tags = list_top_tags_per_cluster(data, labels)
+        merge = merge_clusters_by_tags if args.greedy_merge else merge_clusters_union_find
+        merged_tags, cluster_id_map = merge(top_tags, threshold=args.merge_threshold)
 
-    cluster_df = pd.read_csv('../data/dbscan_cluster_labels.csv')
-    cluster_df['MergedCluster'] = cluster_df['Cluster'].map(cluster_id_map)
-    cluster_df.to_csv('../data/merged_dbscan_cluster_labels.csv', index=False)
-    print("Updated cluster labels with merged IDs saved to 'merged_dbscan_cluster_labels.csv'.")
+    with stage('save'):
+        save_merged_labels(data, labels, cluster_id_map, args.csv)
+        save_cluster_stats(STATS_PATH, fit_cluster_stats(data, labels, cluster_id_map,
+                                                         float(new_eps), min_samples))
 
     for cluster, tags in merged_tags.items():
         print(f"Merged Cluster {cluster}: Top tags: {tags}")
@@ -109,4 +480,5 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    with run_report('createclusters'):
+        main()
@@ -1,5 +1,14 @@
 import json
-import pandas as pd
+import argparse
+import numpy as np
+from scipy import sparse
+from artifacts import libraries_from_dict, load_libraries, pick_artifact, save_matrix
+from instrument import run_report, stage
+
+EXCLUDE_TAGS = ['Action', 'RPG', 'Adventure',
+                'Indie', 'Strategy', 'Open World',
+                'Simulation', 'Singleplayer', 'Casual',
+                'FPS']
 
 
 def load_json_file(file):
@@ -8,6 +17,7 @@ def load_json_file(file):
 
 
 def save_matrix_to_csv(file, data):
+    import pandas as pd
     df = pd.DataFrame(data)
     df.to_csv(file, index=True, index_label='LibraryID')
 
@@ -34,28 +44,100 @@ def create_tag_time_matrix(game_tag_dict, game_playtime_dict, exclude_tags):
 
 
 def max_scale_normalization(tag_time_matrix):
+    import pandas as pd
     df = pd.DataFrame(tag_time_matrix).transpose()
     max_values = df.max(axis=1)
     scaled_df = df.div(max_values, axis=0)
     return scaled_df
 
 
-def main():
-    game_tag_dict = load_json_file('../data/game_tags.json')
-    game_playtime_dict = load_json_file('../data/libraries.json')
-    exclude_tags = ['Action', 'RPG', 'Adventure',
-                    'Indie', 'Strategy', 'Open World',
-                    'Simulation', 'Singleplayer', 'Casual',
-                    'FPS']
+def create_sparse_tag_time_matrix(game_tag_dict, game_playtime_dict, exclude_tags):
+    exclude_tags = set(exclude_tags)
+    tags = sorted(set(tag for tags in game_tag_dict.values()
+                      for tag in tags if tag not in exclude_tags))
+    print('There are', len(tags), 'unique tags after exclusion.')
+    tag_index = {tag: i for i, tag in enumerate(tags)}
+
+    # Game x tag matrix holding each game's 1 / n playtime split, built once
+    # instead of once per library the game shows up in.
+    game_index = {}
+    game_rows, game_cols, game_weights = [], [], []
+    for game, game_tags in game_tag_dict.items():
+        tag_ids = [tag_index[tag] for tag in game_tags if tag in tag_index]
+        if not tag_ids:
+            continue
+        row = game_index.setdefault(game, len(game_index))
+        game_rows.extend([row] * len(tag_ids))
+        game_cols.extend(tag_ids)
+        game_weights.extend([1 / len(tag_ids)] * len(tag_ids))
+    game_tag_matrix = sparse.csr_matrix(
+        (game_weights, (game_rows, game_cols)), shape=(len(game_index), len(tags)))
+
+    libraries = game_playtime_dict
+    if isinstance(libraries, dict):
+        libraries = libraries_from_dict(libraries).table()
+    # Each library is represented by its top ten games.
+    libraries = libraries.top()
+    library_ids = [str(steamid) for steamid in libraries.steamids]
+    # Library game columns are remapped onto the tagged game rows in one go,
+    # untagged games fall out as -1.
+    game_map = np.array([game_index.get(game, -1) for game in libraries.games] + [-1],
+                        dtype=np.int64)
+    lib_cols = game_map[libraries.game_index]
+    lib_rows = np.repeat(np.arange(len(library_ids)), np.diff(libraries.indptr))
+    keep = lib_cols >= 0
+    library_game_matrix = sparse.csr_matrix(
+        (np.asarray(libraries.playtimes, dtype=np.float64)[keep],
+         (lib_rows[keep], lib_cols[keep])),
+        shape=(len(library_ids), len(game_index)))
+
+    tag_time_matrix = (library_game_matrix @ game_tag_matrix).tocsr()
+    return tag_time_matrix, library_ids, tags
+
+
+def sparse_max_scale_normalization(tag_time_matrix):
+    max_values = tag_time_matrix.max(axis=1).toarray().ravel()
+    # Libraries without any tagged playtime stay all zero rather than NaN.
+    scale = np.divide(1.0, max_values, out=np.zeros_like(max_values),
+                      where=max_values > 0)
+    return sparse.diags(scale) @ tag_time_matrix
+
+
+def sparse_matrix_to_dataframe(matrix, library_ids, tags):
+    import pandas as pd
+    return pd.DataFrame(matrix.toarray(), index=library_ids, columns=tags)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Build the scaled tag-time training matrix from libraries and game tags.')
+    parser.add_argument('--csv', action='store_true',
+                        help='also write the dense CSV the older pipeline used')
+    return parser.parse_args()
 
-    tag_time_matrix = create_tag_time_matrix(
-        game_tag_dict, game_playtime_dict, exclude_tags)
-    scaled_df = max_scale_normalization(tag_time_matrix)
 
-    save_matrix_to_csv(
-        '../data/scaled_tag_time_matrix_excluded.csv', scaled_df)
-    print('Saved scaled tag-time matrix (with exclusions) to scaled_tag_time_matrix_excluded.csv')
+def main():
+    args = parse_args()
+    with stage('load'):
+        game_tag_dict = load_json_file('../data/game_tags.json')
+        game_playtime_dict = load_libraries(
+            pick_artifact('../data/libraries', '../data/libraries.json'))
+    with stage('tag_time_matrix'):
+        tag_time_matrix, library_ids, tags = create_sparse_tag_time_matrix(
+            game_tag_dict, game_playtime_dict, EXCLUDE_TAGS)
+        scaled_matrix = sparse_max_scale_normalization(tag_time_matrix)
+
+    with stage('save'):
+        save_matrix(
+            '../data/scaled_tag_time_matrix_excluded', scaled_matrix, library_ids, tags)
+    print('Saved scaled tag-time matrix (with exclusions) to scaled_tag_time_matrix_excluded/')
+
+    if args.csv:
+        save_matrix_to_csv('../data/scaled_tag_time_matrix_excluded.csv',
+                           sparse_matrix_to_dataframe(scaled_matrix, library_ids, tags))
+        print('Saved scaled tag-time matrix (with exclusions) to scaled_tag_time_matrix_excluded.csv')
 
 
 if __name__ == '__main__':
-    main()
+    with run_report('createinputdata'):
+        main()
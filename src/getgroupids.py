@@ -1,52 +1,238 @@
-import requests
-from bs4 import BeautifulSoup
+import argparse
+import asyncio
+import functools
+import os
+import time
+import xml.etree.ElementTree as ET
+import aiohttp
+import numpy as np
+from decouple import config
+from tqdm import tqdm
+from instrument import endpoint_label, get_metrics, run_report, stage
+from ratelimit import TokenBucket
 
+COMMUNITY_BASE = config('STEAM_COMMUNITY_BASE', default='https://steamcommunity.com')
+STEAMID64_BASE = 76561197960265728
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
-def get_group_profiles(group, goal):
-    id_list = []
-    page_num = 1
 
-    while len(id_list) < goal:
-        print("Now scraping page " + str(page_num))
-        group_url = group + "/members/?p=" + str(page_num)
-        response = requests.get(group_url)
+class SteamIdSet:
+    # Seen steamids kept as 32-bit account numbers: a sorted uint32 array plus
+    # a small set of recent additions that is merged in once it grows. About
+    # 4 bytes an id, against roughly 100 for a string in a set.
+    def __init__(self, min_flush=65536):
+        self.sorted = np.empty(0, dtype=np.uint32)
+        self.recent = set()
+        self.min_flush = min_flush
 
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.text, 'html.parser')
-            members = soup.find_all('div', class_='playerAvatar')
+    def __len__(self):
+        return len(self.sorted) + len(self.recent)
 
-            for member in members:
-                if len(id_list) < goal:
-                    profile = member.find('a', href=True)
-                    if profile:
-                        url = profile['href']
-                        id = url.split('/')[-1]
-                        id_list.append(id)
-                else:
-                    break
+    def __contains__(self, steamid):
+        account = int(steamid) - STEAMID64_BASE
+        if account in self.recent:
+            return True
+        # A uint32 needle, a Python int would make numpy upcast the whole array.
+        i = np.searchsorted(self.sorted, np.uint32(account))
+        return i < len(self.sorted) and self.sorted[i] == account
 
-            page_num += 1
+    def _flush(self):
+        if len(self.recent) >= max(self.min_flush, len(self.sorted) // 8):
+            recent = np.sort(np.fromiter(self.recent, dtype=np.uint32, count=len(self.recent)))
+            # Two sorted runs, which the stable sort merges in linear time.
+            self.sorted = np.sort(np.concatenate([self.sorted, recent]), kind='stable')
+            self.recent = set()
 
-        else:
-            print("Scraping failed on page", page_num,
-                  "with error code", response.status_code)
-            break
+    def add(self, steamid):
+        if steamid in self:
+            return False
+        self.recent.add(int(steamid) - STEAMID64_BASE)
+        self._flush()
+        return True
 
-    return id_list
+    def add_many(self, steamids, limit=None):
+        # A whole member page at once. Returns the ids that were new, in page
+        # order, stopping after limit of them.
+        accounts = np.array([int(steamid) for steamid in steamids], dtype=np.int64) - \
+            STEAMID64_BASE
+        keep = np.zeros(len(accounts), dtype=bool)
+        keep[np.unique(accounts, return_index=True)[1]] = True
+        if len(self.sorted):
+            found = np.searchsorted(self.sorted, accounts.astype(np.uint32))
+            keep &= self.sorted[np.minimum(found, len(self.sorted) - 1)] != accounts
+        if self.recent:
+            keep &= np.array([account not in self.recent for account in accounts.tolist()],
+                             dtype=bool)
+        new = np.flatnonzero(keep)[:limit]
+        self.recent.update(accounts[new].tolist())
+        self._flush()
+        return [steamids[i] for i in new]
+
+
+def member_list_url(group, page):
+    # Full group URLs are used as given, bare names go to the community site.
+    if '://' not in group:
+        group = COMMUNITY_BASE + '/groups/' + group
+    return group.rstrip('/') + '/memberslistxml/?xml=1&p=' + str(page)
+
+
+def parse_member_page(content):
+    # Up to 1000 members a page, against about 50 on the HTML member pages.
+    root = ET.fromstring(content)
+    members = root.find('members')
+    steamids = [] if members is None else [
+        element.text.strip() for element in members.iter('steamID64') if element.text]
+    return steamids, int(root.findtext('totalPages') or 1)
+
+
+async def async_fetch_member_page(session, limiter, group, page, max_attempts=4):
+    url = member_list_url(group, page)
+    metrics = get_metrics()
+    backoff = 5
+    for attempt in range(max_attempts):
+        await limiter.acquire()
+        status, content = None, b''
+        start = time.perf_counter()
+        try:
+            async with session.get(url) as response:
+                status = response.status
+                content = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        metrics.observe_request(url, time.perf_counter() - start,
+                                status if status is not None else 'error')
+        if status == 200:
+            try:
+                return parse_member_page(content)
+            except ET.ParseError:
+                tqdm.write('Page ' + str(page) + ' of ' + group + ' is not a member list, '
+                           'the group may be private or missing.')
+                return None, 0
+        if status is not None and status not in RETRY_STATUSES:
+            tqdm.write('Member list page ' + str(page) + ' of ' + group +
+                       ' failed with error code ' + str(status))
+            return None, 0
+        if attempt + 1 < max_attempts:
+            metrics.increment('http_retries_total', endpoint=endpoint_label(url))
+            metrics.increment('backoff_seconds_total', backoff, endpoint=endpoint_label(url))
+            await asyncio.sleep(backoff)
+            backoff *= 2
+    tqdm.write('Giving up on page ' + str(page) + ' of ' + group)
+    return None, 0
+
+
+async def async_stream_group_ids(session, limiter, groups, goal, queue=None, out=None,
+                                 seen=None):
+    # Every group is paged through at the same time. Ids new across all groups
+    # go to the queue as soon as their page arrives, and a final None tells
+    # the consumer there are no more.
+    seen = SteamIdSet() if seen is None else seen
+
+    async def scrape(group):
+        page = 1
+        while len(seen) < goal:
+            steamids, total_pages = await async_fetch_member_page(session, limiter, group, page)
+            if steamids is None:
+                return
+            new = seen.add_many([steamid for steamid in steamids if steamid.isdigit()],
+                                max(goal - len(seen), 0))
+            if out is not None:
+                out.write(''.join(steamid + '\n' for steamid in new))
+                out.flush()
+            tqdm.write('Page {} of {} for {}: {} new ids, {} in total'.format(
+                page, total_pages, group, len(new), len(seen)))
+            if queue is not None:
+                for steamid in new:
+                    await queue.put(steamid)
+            if page >= total_pages:
+                return
+            page += 1
+
+    try:
+        await asyncio.gather(*(scrape(group) for group in groups))
+    finally:
+        if queue is not None:
+            await queue.put(None)
+    return seen
+
+
+async def async_collect_group_ids(groups, goal, output, fetch=None, queue_size=1000,
+                                  requests_per_minute=20):
+    # fetch, when given, is a consumer coroutine function called with session=
+    # and queue=, run alongside the scrape.
+    limiter = TokenBucket.per_minute(requests_per_minute, 1, 'steam_community')
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        queue = asyncio.Queue(queue_size) if fetch is not None else None
+        with open(output, 'w') as out:
+            producer = async_stream_group_ids(session, limiter, groups, goal, queue, out)
+            if fetch is None:
+                return await producer
+            seen, _ = await asyncio.gather(producer, fetch(session=session, queue=queue))
+            return seen
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Collect unique profile ids from the member lists of one or more Steam '
+                    'community groups, optionally fetching their libraries as ids arrive.')
+    parser.add_argument('groups', nargs='*',
+                        help='group URLs or names, prompted for if omitted')
+    parser.add_argument('--count', type=int,
+                        help='how many unique member ids to collect, prompted for if omitted')
+    parser.add_argument('--output', default='../data/user_ids.txt',
+                        help='id list file, written as ids arrive')
+    parser.add_argument('--group-rate', type=float, default=20,
+                        help='member list page requests per minute')
+    parser.add_argument('--fetch', action='store_true',
+                        help='fetch libraries for the ids while the member lists are scraped')
+    parser.add_argument('--queue-size', type=int, default=1000,
+                        help='ids buffered between the scrape and the library fetch')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='maximum in-flight Steam API requests with --fetch')
+    parser.add_argument('--rate', type=float, default=65,
+                        help='Steam API requests per minute with --fetch')
+    parser.add_argument('--burst', type=int, default=1,
+                        help='Steam API token bucket capacity with --fetch')
+    parser.add_argument('--checkpoint',
+                        help='library checkpoint with --fetch, defaults to '
+                             '../data/libraries_<output name>.jsonl')
+    return parser.parse_args()
 
 
 def main():
-    groupurl = input("Input group URL: ")
-    num = int(input("How many member ids to fetch: "))
-    ids = get_group_profiles(groupurl, num)
-    print('Fetched', str(len(ids)), 'unique profile IDs.')
-    # filename = input('Filename to save group IDs to: ')
-    filename = '../data/user_ids.txt'
-    with open(filename, 'w') as f:
-        for id in ids:
-            f.write(id + '\n')
-    print('Saved to user_ids.txt')
+    args = parse_args()
+    groups = args.groups
+    if not groups:
+        groups = input("Input group URLs, separated by spaces: ").split()
+    num = args.count
+    if num is None:
+        num = int(input("How many member ids to fetch: "))
+
+    fetch = None
+    if args.fetch:
+        from getlibraries import LibraryCheckpoint, async_fetch_stream, save_libraries
+        checkpoint_path = args.checkpoint or '../data/libraries_' + \
+            os.path.splitext(os.path.basename(args.output))[0] + '.jsonl'
+        checkpoint = LibraryCheckpoint(checkpoint_path)
+        fetch = functools.partial(
+            async_fetch_stream, limiter=TokenBucket.per_minute(args.rate, args.burst, 'steam_api'),
+            checkpoint=checkpoint, concurrency=args.concurrency)
+
+    with stage('scrape'):
+        try:
+            seen = asyncio.run(async_collect_group_ids(groups, num, args.output, fetch,
+                                                       args.queue_size, args.group_rate))
+        finally:
+            if args.fetch:
+                checkpoint.close()
+    print('Fetched', str(len(seen)), 'unique profile IDs from', len(groups), 'groups.')
+    print('Saved to', args.output)
+    if args.fetch:
+        with stage('save'):
+            save_libraries(checkpoint_path, len(seen))
 
 
 if __name__ == '__main__':
-    main()
+    with run_report('getgroupids'):
+        main()
@@ -1,13 +1,30 @@
-import requests
 from decouple import config
 import time
 from tqdm import tqdm
 import json
+import os
+import argparse
+import asyncio
+from ratelimit import TokenBucket
+from workerpool import run_pool
+from httpsession import get_session
+from responsecache import get_cache, disable_cache
+from vanitycache import disable_vanity_cache, get_vanity_cache
+from instrument import endpoint_label, get_metrics, run_report, stage
 
 API_KEY = config('STEAM_API_KEY')
+API_BASE = config('STEAM_API_BASE', default='http://api.steampowered.com')
+VANITY_URL = API_BASE + '/ISteamUser/ResolveVanityURL/v0001/'
+SUMMARIES_URL = API_BASE + '/ISteamUser/GetPlayerSummaries/v0002/'
+OWNED_GAMES_URL = API_BASE + '/IPlayerService/GetOwnedGames/v0001/'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# ResolveVanityURL's success code for a name no profile uses.
+VANITY_NO_MATCH = 42
+SUMMARIES_BATCH_SIZE = 100
 
 
 def test_valid_connection():
+    import requests
     try:
         requests.get('https://www.google.com/', timeout=5)
         return True
@@ -15,16 +32,36 @@ def test_valid_connection():
         return False
 
 
-def attempt_request(api_call_url, parameters):
+def attempt_request(api_call_url, parameters, request_times=None):
+    import requests
+    metrics = get_metrics()
+    endpoint = endpoint_label(api_call_url)
+    cached = get_cache().get(api_call_url, parameters)
+    if cached is not None:
+        metrics.increment('http_cache_hits_total', endpoint=endpoint)
+        return cached
+    metrics.increment('http_cache_misses_total', endpoint=endpoint)
+
+    if request_times is not None:
+        request_times[:] = wait_for_request_budget(request_times)
+        request_times.append(time.time())
     while True:
+        start = time.perf_counter()
         try:
-            response = requests.get(api_call_url, params=parameters)
+            response = get_session().get(api_call_url, params=parameters)
+            metrics.observe_request(api_call_url, time.perf_counter() - start,
+                                    response.status_code)
+            get_cache().set(api_call_url, parameters,
+                            response.status_code, response.content)
             return response
         except (requests.ConnectionError):
+            metrics.observe_request(api_call_url, time.perf_counter() - start, 'error')
+            metrics.increment('http_retries_total', endpoint=endpoint)
             print('Lost connection. Reconnecting!')
             while not test_valid_connection():
                 print('Cannot reconnect yet. Waiting a moment.')
                 time.sleep(10)
+                metrics.increment('backoff_seconds_total', 10, endpoint=endpoint)
             print("Valid connection re-established!")
 
 
@@ -41,17 +78,28 @@ def check_id_validity(steamid):
     return True
 
 
-def get_steamid_from_customid(custom_profile_name):
-    api_call_url = 'http://api.steampowered.com/ISteamUser/ResolveVanityURL/v0001/'
+def get_steamid_from_customid(custom_profile_name, request_times=None):
+    known, steamid = get_vanity_cache().lookup(custom_profile_name)
+    if known:
+        return steamid
+    return request_steamid_from_customid(custom_profile_name, request_times)
+
+
+def request_steamid_from_customid(custom_profile_name, request_times=None):
+    api_call_url = VANITY_URL
 
     parameters = {
         'key': API_KEY,
         'vanityurl': custom_profile_name
     }
 
-    response = attempt_request(api_call_url, parameters)
-    data = response.json()
+    response = attempt_request(api_call_url, parameters, request_times)
+    data = response.json() if response.status_code == 200 else {}
+    steamid, _ = resolve_vanity_response(custom_profile_name, data)
+    return steamid
+
 
+def parse_vanity_response(data):
     if 'response' in data and 'success' in data['response'] and data['response']['success'] == 1:
         steamid = data['response'].get('steamid', None)
         return steamid
@@ -60,9 +108,42 @@ def get_steamid_from_customid(custom_profile_name):
         return None
 
 
-def public_check(steamid):
+def resolve_vanity_response(custom_profile_name, data):
+    # The steamid and whether it is a definite answer: the steamid, or None
+    # when Steam says no profile has the name. Only those are cached, failed
+    # requests and other errors are asked again.
+    steamid = parse_vanity_response(data)
+    answered = steamid is not None or \
+        data.get('response', {}).get('success') == VANITY_NO_MATCH
+    if answered:
+        get_vanity_cache().store(custom_profile_name, steamid)
+    return steamid, answered
 
-    api_call_url = 'http://api.steampowered.com/ISteamUser/GetPlayerSummaries/v0002/'
+
+def owned_games_parameters(steamid):
+    return {
+        'key': API_KEY,
+        'steamid': steamid,
+        'include_appinfo': 'true',
+        'include_played_free_games': 'true',
+        'format': 'json'
+    }
+
+
+def parse_owned_games(data):
+    library = {}
+    appids = {}
+    if 'response' in data and 'games' in data['response']:
+        library = {game.get('name'): game.get('playtime_forever', 0)
+                   for game in data['response']['games']}
+        appids = {game.get('name'): game.get('appid', 0)
+                  for game in data['response']['games']}
+    return library, appids
+
+
+def public_check(steamid, request_times=None):
+
+    api_call_url = SUMMARIES_URL
 
     parameters = {
         'key': API_KEY,
@@ -70,7 +151,7 @@ def public_check(steamid):
         'format': 'json'
     }
 
-    response = attempt_request(api_call_url, parameters)
+    response = attempt_request(api_call_url, parameters, request_times)
 
     if response.status_code == 200:
         data = response.json()
@@ -87,51 +168,62 @@ def public_check(steamid):
         return False
 
 
-def get_library(steamid, aggregate_game_appid_dict, request_times, single=False):
-    library = {}
+def public_steamids_from_summaries(data):
+    public_ids = set()
+    if 'response' in data and 'players' in data['response']:
+        for player in data['response']['players']:
+            if player.get('communityvisibilitystate', 0) == 3:
+                public_ids.add(player.get('steamid'))
+    return public_ids
 
-    if not check_id_validity(steamid):
-        steamid = get_steamid_from_customid(steamid)
-        request_times.append(time.time())
-
-    request_times.append(time.time())
-    if public_check(steamid):
-        api_call_url = 'http://api.steampowered.com/IPlayerService/GetOwnedGames/v0001/'
 
+def public_check_batch(steamids, request_times=None):
+    public_ids = set()
+    for i in range(0, len(steamids), SUMMARIES_BATCH_SIZE):
+        batch = steamids[i:i + SUMMARIES_BATCH_SIZE]
         parameters = {
             'key': API_KEY,
-            'steamid': steamid,
-            'include_appinfo': 'true',
-            'include_played_free_games': 'true',
+            'steamids': ','.join(batch),
             'format': 'json'
         }
+        response = attempt_request(SUMMARIES_URL, parameters, request_times)
 
-        response = attempt_request(api_call_url, parameters)
-        request_times.append(time.time())
+        if response.status_code == 200:
+            public_ids.update(public_steamids_from_summaries(response.json()))
+        else:
+            tqdm.write('Failed to get summaries for a batch of ' +
+                       str(len(batch)) + ' steamIDs')
+    return public_ids
+
+
+def get_library(steamid, aggregate_game_appid_dict, request_times, single=False,
+                checked_public=False):
+    library = {}
+
+    if not check_id_validity(steamid):
+        steamid = get_steamid_from_customid(steamid, request_times)
+
+    if checked_public or public_check(steamid, request_times):
+        api_call_url = OWNED_GAMES_URL
+
+        parameters = owned_games_parameters(steamid)
+
+        response = attempt_request(api_call_url, parameters, request_times)
 
         if response.status_code == 200:
-            data = response.json()
-            if 'response' in data and 'games' in data['response']:
-                library = {game.get('name'): game.get('playtime_forever', 0)
-                           for game in data['response']['games']}
+            library, appids = parse_owned_games(response.json())
 
             if check_hidden_playtime(library):
                 tqdm.write('Failed to fetch library for ' + steamid)
                 return False, steamid
 
             tqdm.write('Successfully fetched library for ' + steamid)
-            refined_library = keep_top_ten_games(library)
-
-            appids = {game.get('name'): game.get('appid', 0)
-                      for game in data['response']['games']}
-            for game, appid in appids.items():
-                if game in refined_library:
-                    aggregate_game_appid_dict[game] = appid
+            aggregate_game_appid_dict.update(appids)
 
             if single:
-                return refined_library, steamid, library
+                return keep_top_ten_games(library), steamid, library
             else:
-                return refined_library, steamid
+                return library, steamid
 
         else:
             tqdm.write(
@@ -149,48 +241,536 @@ def keep_top_ten_games(library):
     return refined_library
 
 
-def main():
-    filename = input('Input a group id list file: ')
-    filename = '../data/' + filename
+async def async_attempt_request(session, limiter, api_call_url, parameters, max_retries=6):
+    import aiohttp
+    metrics = get_metrics()
+    endpoint = endpoint_label(api_call_url)
+    cached = get_cache().get(api_call_url, parameters)
+    if cached is not None:
+        metrics.increment('http_cache_hits_total', endpoint=endpoint)
+        return cached.status_code, cached.json()
+    metrics.increment('http_cache_misses_total', endpoint=endpoint)
+
+    backoff = 1
+    status = None
+    for attempt in range(max_retries + 1):
+        await limiter.acquire()
+        retry_after = None
+        start = time.perf_counter()
+        try:
+            async with session.get(api_call_url, params=parameters) as response:
+                status = response.status
+                if status not in RETRY_STATUSES:
+                    if status != 200:
+                        metrics.observe_request(api_call_url, time.perf_counter() - start,
+                                                status)
+                        return status, None
+                    content = await response.read()
+                    metrics.observe_request(api_call_url, time.perf_counter() - start, status)
+                    try:
+                        data = json.loads(content)
+                    except ValueError:
+                        # A truncated body or an HTML error page, worth another try.
+                        tqdm.write('Malformed reply from ' + endpoint + ', backing off.')
+                    else:
+                        get_cache().set(api_call_url, parameters, status, content)
+                        return status, data
+                else:
+                    retry_after = response.headers.get('Retry-After')
+                    metrics.observe_request(api_call_url, time.perf_counter() - start, status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            metrics.observe_request(api_call_url, time.perf_counter() - start, 'error')
+            tqdm.write('Request error (' + type(e).__name__ + '), backing off.')
+        if attempt == max_retries:
+            break
+        delay = backoff
+        if retry_after is not None and retry_after.isdigit():
+            delay = max(delay, int(retry_after))
+        metrics.increment('http_retries_total', endpoint=endpoint)
+        metrics.increment('backoff_seconds_total', delay, endpoint=endpoint)
+        await asyncio.sleep(delay)
+        backoff = min(backoff * 2, 60)
+    metrics.increment('http_giveups_total', endpoint=endpoint)
+    tqdm.write('Giving up on ' + api_call_url + ' after ' +
+               str(max_retries + 1) + ' attempts')
+    return status, None
+
+
+async def async_get_steamid_from_customid(session, limiter, custom_profile_name):
+    known, steamid = get_vanity_cache().lookup(custom_profile_name)
+    if known:
+        return steamid, True
+    return await async_request_steamid_from_customid(session, limiter, custom_profile_name)
+
+
+async def async_request_steamid_from_customid(session, limiter, custom_profile_name):
+    parameters = {
+        'key': API_KEY,
+        'vanityurl': custom_profile_name
+    }
+    status, data = await async_attempt_request(
+        session, limiter, VANITY_URL, parameters)
+    return resolve_vanity_response(custom_profile_name, data if data is not None else {})
+
+
+async def async_public_check(session, limiter, steamid):
+    parameters = {
+        'key': API_KEY,
+        'steamids': steamid,
+        'format': 'json'
+    }
+    status, data = await async_attempt_request(
+        session, limiter, SUMMARIES_URL, parameters)
+    if data is None:
+        # None rather than False: nobody knows whether the profile is public.
+        tqdm.write('Failed to get data for profile with steamID ' + steamid)
+        return None
+    if 'response' in data and 'players' in data['response'] and data['response']['players']:
+        visibility = data['response']['players'][0].get(
+            'communityvisibilitystate', 0)
+        return visibility == 3
+    tqdm.write('No data found for user with steamID ' + steamid)
+    return False
+
+
+async def async_public_check_batch(session, limiter, steamids, concurrency=8):
+    public_ids = set()
+    batches = [steamids[i:i + SUMMARIES_BATCH_SIZE]
+               for i in range(0, len(steamids), SUMMARIES_BATCH_SIZE)]
+
+    async def check_batch(batch):
+        parameters = {
+            'key': API_KEY,
+            'steamids': ','.join(batch),
+            'format': 'json'
+        }
+        status, data = await async_attempt_request(
+            session, limiter, SUMMARIES_URL, parameters)
+        if data is None:
+            tqdm.write('Failed to get summaries for a batch of ' +
+                       str(len(batch)) + ' steamIDs')
+            return
+        public_ids.update(public_steamids_from_summaries(data))
+
+    await run_pool(batches, concurrency, check_batch)
+    return public_ids
+
+
+async def async_get_owned_games(session, limiter, steamid, checked_public=False):
+    # The library is {} when the profile is unknown, private or hidden, and
+    # None when Steam could not be asked, so callers can tell the two apart.
+    if not check_id_validity(steamid):
+        steamid, answered = await async_get_steamid_from_customid(session, limiter, steamid)
+        if steamid is None:
+            return None, {} if answered else None, {}
+
+    if not checked_public:
+        public = await async_public_check(session, limiter, steamid)
+        if public is None:
+            return steamid, None, {}
+        if not public:
+            tqdm.write('Profile is not public!')
+            return steamid, {}, {}
+
+    status, data = await async_attempt_request(
+        session, limiter, OWNED_GAMES_URL, owned_games_parameters(steamid))
+    if data is None:
+        tqdm.write('Failed to get data for profile library with steamid ' + steamid)
+        return steamid, None, {}
+
+    library, appids = parse_owned_games(data)
+    if check_hidden_playtime(library):
+        tqdm.write('Failed to fetch library for ' + steamid)
+        return steamid, {}, {}
+    return steamid, library, appids
+
+
+async def async_get_library(session, limiter, steamid, checked_public=False):
+    # The whole library; training reads its top ten games from the table.
+    steamid, library, appids = await async_get_owned_games(
+        session, limiter, steamid, checked_public)
+    if not library:
+        return False, steamid, {}
+
+    tqdm.write('Successfully fetched library for ' + steamid)
+    return library, steamid, appids
+
+
+async def async_single_library_fetch(session, limiter, steamid):
+    # Async counterpart of single_library_fetch: the top ten games plus the
+    # whole library, (False, {}) when the profile is unknown, private or
+    # hidden, or (None, {}) when Steam could not be asked.
+    steamid, library, appids = await async_get_owned_games(session, limiter, steamid)
+    if library is None:
+        return None, {}
+    if not library:
+        return False, {}
+    return keep_top_ten_games(library), library
+
+
+def split_custom_names(ids):
+    # Steamids and cached names are answered straight away. The rest are the
+    # distinct custom names that still need a ResolveVanityURL call.
+    resolved = {}
+    names = []
+    cache = get_vanity_cache()
+    for id in ids:
+        if id in resolved:
+            continue
+        if check_id_validity(id):
+            resolved[id] = id
+            continue
+        known, steamid = cache.lookup(id)
+        if known:
+            resolved[id] = steamid
+        else:
+            names.append(id)
+    # Custom URLs are case-insensitive, one request covers every spelling.
+    distinct = {}
+    for name in names:
+        distinct.setdefault(name.lower(), name)
+    return resolved, list(distinct.values())
+
+
+def finish_resolution(ids, resolved, requested):
+    by_name = {name.lower(): resolved[name] for name in requested}
+    resolved = {id: resolved[id] if id in resolved else by_name[id.lower()] for id in ids}
+    custom = [id for id in set(ids) if not check_id_validity(id)]
+    unresolved = sum(1 for id in custom if resolved[id] is None)
+    get_metrics().increment('vanity_names_total', len(custom) - len(requested), source='cache')
+    get_metrics().increment('vanity_names_total', len(requested), source='api')
+    tqdm.write('{} custom names, {} needed a request, {} are unresolvable.'.format(
+        len(custom), len(requested), unresolved))
+    return resolved
+
+
+async def async_resolve_ids(session, limiter, ids, concurrency=8):
+    # The resolution pre-pass, run before any library is fetched and sharing
+    # the crawl's limiter, so the fetch starts with every steamid known.
+    resolved, names = split_custom_names(ids)
+
+    with tqdm(total=len(names), desc='Resolve Progress', position=0) as pbar:
+        async def resolve(name):
+            resolved[name], _ = await async_request_steamid_from_customid(
+                session, limiter, name)
+            pbar.update(1)
+
+        await run_pool(names, concurrency, resolve)
+    return finish_resolution(ids, resolved, names)
+
+
+async def async_resolve_only(ids, concurrency=8, requests_per_minute=65, burst=1):
+    import aiohttp
+    limiter = TokenBucket.per_minute(requests_per_minute, burst, 'steam_api')
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        return await async_resolve_ids(session, limiter, ids, concurrency)
+
+
+async def async_fetch_libraries(ids, checkpoint, concurrency=8, requests_per_minute=65,
+                                burst=1):
+    import aiohttp
+    limiter = TokenBucket.per_minute(requests_per_minute, burst, 'steam_api')
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        with stage('resolve'):
+            resolved = await async_resolve_ids(session, limiter, ids, concurrency)
+        steamids = list(dict.fromkeys(
+            steamid for steamid in resolved.values() if steamid is not None))
+        public_ids = await async_public_check_batch(
+            session, limiter, steamids, concurrency)
+        pending = split_public_ids(resolved, public_ids, checkpoint)
+
+        with tqdm(total=len(pending), desc='Fetch Progress', position=0) as pbar:
+            async def fetch(item):
+                id, steamid = item
+                lib, steamid, appids = await async_get_library(
+                    session, limiter, steamid, checked_public=True)
+                checkpoint.record(id, steamid, lib, appids)
+                pbar.update(1)
+
+            await run_pool(pending, concurrency, fetch)
+
+
+async def async_fetch_stream(session, limiter, queue, checkpoint, concurrency=8):
+    # Takes steamids off a producer's queue until it sends None. Visibility is
+    # checked a summaries batch at a time and public libraries go to a small
+    # second queue for the fetch workers, so fetching overlaps with whatever
+    # fills the first queue.
+    fetch_queue = asyncio.Queue(concurrency * 2)
+
+    async def check():
+        try:
+            finished = False
+            while not finished:
+                batch = [await queue.get()]
+                while len(batch) < SUMMARIES_BATCH_SIZE and not queue.empty():
+                    batch.append(queue.get_nowait())
+                finished = None in batch
+                batch = [steamid for steamid in batch
+                         if steamid is not None and steamid not in checkpoint.completed]
+                if not batch:
+                    continue
+                public_ids = await async_public_check_batch(session, limiter, batch, 1)
+                for steamid in batch:
+                    if steamid in public_ids:
+                        await fetch_queue.put(steamid)
+                    else:
+                        checkpoint.record(steamid, steamid)
+        finally:
+            for _ in range(concurrency):
+                await fetch_queue.put(None)
+
+    with tqdm(desc='Fetch Progress', unit='library', position=0) as pbar:
+        async def fetch():
+            while True:
+                steamid = await fetch_queue.get()
+                if steamid is None:
+                    return
+                lib, steamid, appids = await async_get_library(
+                    session, limiter, steamid, checked_public=True)
+                checkpoint.record(steamid, steamid, lib, appids)
+                pbar.update(1)
+
+        await asyncio.gather(check(), *(fetch() for _ in range(concurrency)))
+
+
+def split_public_ids(resolved, public_ids, checkpoint):
+    pending = []
+    for id, steamid in resolved.items():
+        if steamid in public_ids:
+            pending.append((id, steamid))
+        else:
+            checkpoint.record(id, steamid)
+    tqdm.write(str(len(pending)) + ' of ' + str(len(resolved)) +
+               ' profiles are public.')
+    return pending
+
+
+def wait_for_request_budget(request_times):
+    time_now = time.time()
+    request_times = [
+        request_time for request_time in request_times if time_now - request_time < 60]
+
+    if len(request_times) >= 65:
+        with tqdm(total=60, desc="API Call Cooldown", leave=False, position=1) as pbar:
+            for i in range(60):
+                time.sleep(1)
+                pbar.update(1)
+        get_metrics().increment('throttle_seconds_total', 60, limiter='steam_api_cooldown')
+        request_times = []
+    return request_times
+
+
+def resolve_ids(ids, request_times):
+    resolved, names = split_custom_names(ids)
+    for name in tqdm(names, desc='Resolve Progress', position=0):
+        resolved[name] = request_steamid_from_customid(name, request_times)
+    return finish_resolution(ids, resolved, names)
+
+
+def fetch_libraries(ids, checkpoint):
+    request_times = []
+
+    with stage('resolve'):
+        resolved = resolve_ids(ids, request_times)
+    steamids = list(dict.fromkeys(
+        steamid for steamid in resolved.values() if steamid is not None))
+    public_ids = public_check_batch(steamids, request_times)
+    pending = split_public_ids(resolved, public_ids, checkpoint)
+
+    for id, steamid in tqdm(pending, desc='Fetch Progress', position=0):
+        appids = {}
+        lib, steamid = get_library(steamid, appids, request_times,
+                                   checked_public=True)
+        checkpoint.record(id, steamid, lib, appids)
+
+
+class LibraryCheckpoint:
+    def __init__(self, path):
+        self.path = path
+        self.completed = set()
+        if os.path.exists(path):
+            self._load()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def _load(self):
+        good_size = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                self.completed.add(record['id'])
+                good_size += len(line)
+        # Drop a half-written trailing record left behind by a crash.
+        if good_size != os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_size)
+
+    def record(self, id, steamid, library=None, appids=None):
+        record = {'id': id, 'steamid': steamid,
+                  'library': library or None, 'appids': appids or {}}
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.completed.add(id)
+
+    def close(self):
+        self.file.close()
+
+
+def iter_checkpoint(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def write_json_library(f, steamid, library, first):
+    # Same layout json.dump(libraries_dict, f, indent=4) produces,
+    # written one library at a time.
+    f.write('{\n' if first else ',\n')
+    library = json.dumps(library, indent=4)
+    f.write('    ' + json.dumps(steamid) + ': ' + library.replace('\n', '\n    '))
+
+
+def compact_checkpoint(path, library_dir, appid_file, library_json=None):
+    from artifacts import LibraryTableWriter
+    written = set()
+    total = 0
+    writer = LibraryTableWriter()
+    json_file = open(library_json, 'w', encoding='utf-8') if library_json else None
+    try:
+        for record in iter_checkpoint(path):
+            total += 1
+            steamid = record['steamid']
+            if not record['library'] or steamid in written:
+                continue
+            writer.add(steamid, record['library'], record['appids'])
+            if json_file is not None:
+                write_json_library(json_file, steamid, record['library'], not written)
+            written.add(steamid)
+        if json_file is not None:
+            json_file.write('\n}' if written else '{}')
+    finally:
+        if json_file is not None:
+            json_file.close()
+    writer.save(library_dir)
+
+    # Only the games in someone's top ten, which are the ones gettags scrapes.
+    with open(appid_file, 'w', encoding='utf-8') as f:
+        json.dump(dict(sorted(writer.table().top().appid_map().items())), f, indent=4)
+    return len(written), total
+
+
+def load_ids(filename):
     ids = []
     with open(filename, 'r') as f:
         for line in f:
             steamid = line.strip()
             if len(steamid) > 0:
                 ids.append(steamid)
-    libraries_dict = {}
-    request_times = []
-    aggregate_game_appid_dict = {}
+    return ids
+
+
+def save_libraries(checkpoint_path, total, export_json=False):
+    library_json = '../data/libraries.json' if export_json else None
+    fetched, _ = compact_checkpoint(
+        checkpoint_path, '../data/libraries', '../data/game_ids.json', library_json)
+    print('Fetched', str(fetched), 'total libraries')
+    success_rate = (fetched / total) * 100 if total else 0
+    print('Success rate: {}/{} = {:.2f}%'.format(fetched,
+          total, success_rate))
+    print('Completed writing libraries to ../data/libraries/')
+    if export_json:
+        print('Completed writing libraries to file: libraries.json')
+    print('Saved complete game to appid dictionary to file game_ids.json')
 
-    for id in tqdm(ids, desc='Fetch Progress', position=0):
 
-        time_now = time.time()
-        request_times = [
-            request_time for request_time in request_times if time_now - request_time < 60]
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Fetch the game library of every Steam ID in a group id list file.')
+    parser.add_argument('filename', nargs='?',
+                        help='id list file inside ../data/, prompted for if omitted')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='crawl concurrently with a token bucket rate limiter')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='maximum in-flight requests in async mode')
+    parser.add_argument('--rate', type=float, default=65,
+                        help='requests per minute allowed in async mode')
+    parser.add_argument('--burst', type=int, default=1,
+                        help='token bucket capacity in async mode')
+    parser.add_argument('--checkpoint',
+                        help='JSONL file fetched libraries are streamed to, defaults '
+                             'to ../data/libraries_<id file name>.jsonl')
+    parser.add_argument('--fresh', action='store_true',
+                        help='discard an existing checkpoint instead of resuming it')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always hit the API instead of the on-disk response and '
+                             'vanity caches')
+    parser.add_argument('--resolve-only', action='store_true',
+                        help='only resolve the custom names in the id file into the vanity '
+                             'cache, concurrently under the async rate limit')
+    parser.add_argument('--json', action='store_true',
+                        help='also export the libraries as libraries.json')
+    parser.add_argument('--no-compact', action='store_true',
+                        help='only write the checkpoint, leaving libraries/ and game_ids.json '
+                             'alone (for assignclusters)')
+    return parser.parse_args()
 
-        if len(request_times) >= 65:
-            with tqdm(total=60, desc="API Call Cooldown", leave=False, position=1) as pbar:
-                for i in range(60):
-                    time.sleep(1)
-                    pbar.update(1)
-            request_times = []
 
-        lib, id = get_library(id, aggregate_game_appid_dict, request_times)
-        if lib:
-            libraries_dict[id] = lib
+def main():
+    args = parse_args()
+    if args.no_cache:
+        disable_cache()
+        disable_vanity_cache()
+    filename = args.filename
+    if filename is None:
+        filename = input('Input a group id list file: ')
+    ids = load_ids('../data/' + filename)
+
+    if args.resolve_only:
+        with stage('resolve'):
+            asyncio.run(async_resolve_only(ids, args.concurrency, args.rate, args.burst))
+        print(get_vanity_cache().summary())
+        return
+
+    checkpoint_path = args.checkpoint
+    if checkpoint_path is None:
+        checkpoint_path = '../data/libraries_' + \
+            os.path.splitext(os.path.basename(filename))[0] + '.jsonl'
+    if args.fresh and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    checkpoint = LibraryCheckpoint(checkpoint_path)
+    remaining = list(dict.fromkeys(
+        id for id in ids if id not in checkpoint.completed))
+    if len(remaining) < len(ids):
+        print('Resuming from', checkpoint_path + ',', len(ids) - len(remaining),
+              'ids already done.')
 
-    print('Fetched', str(len(libraries_dict)), 'total libraries')
-    success_rate = (len(libraries_dict) / len(ids)) * 100
-    print('Success rate: {}/{} = {:.2f}%'.format(len(libraries_dict),
-          len(ids), success_rate))
-    file = 'libraries.json'
-    with open('../data/' + file, 'w', encoding='utf-8') as f:
-        json.dump(libraries_dict, f, indent=4)
-    print('Completed writing libraries to file:', file)
-
-    with open('../data/game_ids.json', 'w', encoding='utf-8') as f:
-        json.dump(dict(sorted(aggregate_game_appid_dict.items())), f, indent=4)
-    print('Saved complete game to appid dictionary to file game_ids.json')
+    try:
+        with stage('fetch'):
+            if args.use_async:
+                asyncio.run(async_fetch_libraries(
+                    remaining, checkpoint, args.concurrency, args.rate, args.burst))
+            else:
+                fetch_libraries(remaining, checkpoint)
+    finally:
+        checkpoint.close()
+
+    if args.no_compact:
+        print('Libraries left in', checkpoint_path)
+    else:
+        with stage('save'):
+            save_libraries(checkpoint_path, len(set(ids)), args.json)
+    print(get_cache().summary())
+    print(get_vanity_cache().summary())
 
 
 def single_library_fetch(steamid):
@@ -202,17 +782,6 @@ def single_library_fetch(steamid):
     aggregate_game_appid_dict = {}
 
     for id in tqdm(ids, desc='Fetch Progress', position=0):
-        time_now = time.time()
-        request_times = [
-            request_time for request_time in request_times if time_now - request_time < 60]
-
-        if len(request_times) >= 65:
-            with tqdm(total=60, desc="API Call Cooldown", leave=False, position=1) as pbar:
-                for i in range(60):
-                    time.sleep(1)
-                    pbar.update(1)
-            request_times = []
-
         lib, id, all_lib = get_library(
             id, aggregate_game_appid_dict, request_times, True)
         if lib:
@@ -227,4 +796,5 @@ def single_library_fetch(steamid):
 
 
 if __name__ == '__main__':
-    main()
+    with run_report('getlibraries'):
+        main()
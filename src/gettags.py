@@ -1,12 +1,23 @@
 import json
-import requests
+import os
 import time
-from bs4 import BeautifulSoup
+import argparse
+import asyncio
+from decouple import config
 from tqdm import tqdm
-import matplotlib.pyplot as plt
+from httpsession import get_session
+from responsecache import get_cache
+from instrument import endpoint_label, get_metrics, run_report, stage
+from ratelimit import HostScheduler
+from workerpool import run_pool
+from tagextract import extract_raw_tags, apply_blacklist
+
+STORE_BASE = config('STEAM_STORE_BASE', default='https://store.steampowered.com')
+RETRY_STATUSES = {429, 500, 502, 503, 504}
 
 
 def test_valid_connection():
+    import requests
     try:
         requests.get('https://www.google.com/', timeout=5)
         return True
@@ -15,15 +26,34 @@ def test_valid_connection():
 
 
 def attempt_request(api_call_url):
+    import requests
+    metrics = get_metrics()
+    endpoint = endpoint_label(api_call_url)
+    cached = get_cache().get(api_call_url)
+    if cached is not None:
+        metrics.increment('http_cache_hits_total', endpoint=endpoint)
+        return cached
+    metrics.increment('http_cache_misses_total', endpoint=endpoint)
+
     while True:
+        start = time.perf_counter()
         try:
-            response = requests.get(api_call_url)
+            response = get_session().get(api_call_url)
+            metrics.observe_request(api_call_url, time.perf_counter() - start,
+                                    response.status_code)
+            get_cache().set(api_call_url, None, response.status_code, response.content)
+            # Only pages that actually hit the store count against our politeness delay.
+            time.sleep(3)
+            metrics.increment('throttle_seconds_total', 3, limiter='store_politeness')
             return response
         except (requests.ConnectionError):
+            metrics.observe_request(api_call_url, time.perf_counter() - start, 'error')
+            metrics.increment('http_retries_total', endpoint=endpoint)
             print('Lost connection. Reconnecting!')
             while not test_valid_connection():
                 print('Cannot reconnect yet. Waiting a moment.')
                 time.sleep(10)
+                metrics.increment('backoff_seconds_total', 10, endpoint=endpoint)
             print("Valid connection re-established!")
 
 
@@ -32,35 +62,160 @@ def load_game_appid_data(file):
         return json.load(f)
 
 
-def scrape_tags_from_appid(appid, blacklist):
-    site = 'https://store.steampowered.com/app/' + appid
-    response = attempt_request(site)
-    if response.status_code == 200 and response.content:
-        soup = BeautifulSoup(response.content, 'html.parser')
-        tags_container = soup.find('div', class_='glance_tags popular_tags')
-        if tags_container is not None:
-            tags = tags_container.find_all(
-                'a', class_='app_tag', limit=5 + len(blacklist))
-            tags_text = [tag.get_text(strip=True) for tag in tags if tag.get_text(
-                strip=True) not in blacklist][:5]
-        else:
-            line = 'Error ' + str(appid) + ' must not be on steam anymore.'
-            tqdm.write(line)
-            tags_text = []
-    else:
-        tqdm.write('Failed to get reply. Waiting a minute and trying again.')
-        time.sleep(60)
-        tags_text = scrape_tags_from_appid(appid, blacklist)
+def parse_tags_from_page(content, appid):
+    tags_text = extract_raw_tags(content)
+    if tags_text is None:
+        line = 'Error ' + str(appid) + ' must not be on steam anymore.'
+        tqdm.write(line)
+        tags_text = []
     return tags_text
 
 
-def get_game_tag_dict(game_appid_dict, blacklist):
-    game_tag_dict = {}
+def scrape_tags_from_appid(appid):
+    site = STORE_BASE + '/app/' + appid
+    wait = 60
+    while True:
+        response = attempt_request(site)
+        if response.status_code == 200 and response.content:
+            return parse_tags_from_page(response.content, appid)
+        if response.status_code != 200 and response.status_code not in RETRY_STATUSES:
+            tqdm.write('Store page for ' + appid + ' failed with error code ' +
+                       str(response.status_code))
+            get_metrics().increment('http_giveups_total', endpoint=endpoint_label(site))
+            return None
+        tqdm.write('Failed to get reply. Waiting ' + str(wait) +
+                   ' seconds and trying again.')
+        get_metrics().increment('http_retries_total', endpoint=endpoint_label(site))
+        get_metrics().increment('backoff_seconds_total', wait, endpoint=endpoint_label(site))
+        time.sleep(wait)
+        wait = min(wait * 2, 15 * 60)
+
+
+def record_raw_tags(raw_tags, game, appid, tags):
+    raw_tags[str(appid)] = {'game': game, 'tags': tags, 'fetched': time.time()}
+    tqdm.write('Got [' + ', '.join(tags) + '] tags for ' + game)
+
+
+def get_game_tag_dict(game_appid_dict, raw_tags):
     for game, appid in tqdm(game_appid_dict.items(), desc='Tag Fetch Progress', position=0):
-        tags = scrape_tags_from_appid(str(appid), blacklist)
-        game_tag_dict[game] = tags
-        tqdm.write('Got [' + ', '.join(tags) + '] tags for ' + game)
-        time.sleep(3)
+        tags = scrape_tags_from_appid(str(appid))
+        if tags is None:
+            tqdm.write('Giving up on ' + str(appid) + ' for ' + game)
+        else:
+            record_raw_tags(raw_tags, game, appid, tags)
+    return raw_tags
+
+
+async def async_scrape_tags_from_appid(session, scheduler, appid, max_attempts=4):
+    # Returns the tags, or None and whether a later retry round could still
+    # succeed. Only rate limits, server errors and dropped connections are retried.
+    import aiohttp
+    site = STORE_BASE + '/app/' + appid
+    metrics = get_metrics()
+    endpoint = endpoint_label(site)
+    cached = get_cache().get(site)
+    if cached is not None:
+        metrics.increment('http_cache_hits_total', endpoint=endpoint)
+        return parse_tags_from_page(cached.content, appid), False
+    metrics.increment('http_cache_misses_total', endpoint=endpoint)
+
+    backoff = 5
+    for attempt in range(max_attempts):
+        await scheduler.acquire(site)
+        status, content = None, b''
+        start = time.perf_counter()
+        try:
+            async with session.get(site) as response:
+                status = response.status
+                content = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            pass
+        metrics.observe_request(site, time.perf_counter() - start,
+                                status if status is not None else 'error')
+        if status == 200 and content:
+            get_cache().set(site, None, status, content)
+            return parse_tags_from_page(content, appid), False
+        if status is not None and status != 200 and status not in RETRY_STATUSES:
+            tqdm.write('Store page for ' + appid + ' failed with error code ' + str(status))
+            metrics.increment('http_giveups_total', endpoint=endpoint)
+            return None, False
+        if status != 200:
+            # The whole host is struggling, so every worker backs off, not just this one.
+            scheduler.pause(site, backoff)
+        metrics.increment('http_retries_total', endpoint=endpoint)
+        metrics.increment('backoff_seconds_total', backoff, endpoint=endpoint)
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 5 * 60)
+    metrics.increment('http_giveups_total', endpoint=endpoint)
+    return None, True
+
+
+async def async_get_game_tag_dict(game_appid_dict, raw_tags, requests_per_second=1 / 3,
+                                  concurrency=4, retry_rounds=2, max_attempts=4):
+    import aiohttp
+    scheduler = HostScheduler(requests_per_second)
+    failed = []
+    rejected = []
+
+    timeout = aiohttp.ClientTimeout(total=60)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        async def scrape(item):
+            game, appid = item
+            tags, retry = await async_scrape_tags_from_appid(
+                session, scheduler, str(appid), max_attempts)
+            if tags is None:
+                (failed if retry else rejected).append(item)
+            else:
+                record_raw_tags(raw_tags, game, appid, tags)
+            pbar.update(1)
+
+        items = list(game_appid_dict.items())
+        with tqdm(total=len(items), desc='Tag Fetch Progress', position=0) as pbar:
+            await run_pool(items, concurrency, scrape)
+
+        for retry_round in range(retry_rounds):
+            if not failed:
+                break
+            retry, failed = failed, []
+            tqdm.write('Retrying ' + str(len(retry)) + ' failed store pages.')
+            with tqdm(total=len(retry), desc='Tag Retry Progress', position=0) as pbar:
+                await run_pool(retry, concurrency, scrape)
+
+    for game, appid in failed + rejected:
+        tqdm.write('Giving up on ' + str(appid) + ' for ' + game)
+    return raw_tags
+
+
+def load_raw_tags(file):
+    if not os.path.exists(file):
+        return {}
+    with open(file, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_raw_tags(file, raw_tags):
+    temp_file = file + '.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(raw_tags, f)
+    os.replace(temp_file, file)
+
+
+def find_stale_games(game_appid_dict, raw_tags, max_age_days=None):
+    cutoff = None if max_age_days is None else time.time() - max_age_days * 24 * 60 * 60
+    stale = {}
+    for game, appid in game_appid_dict.items():
+        entry = raw_tags.get(str(appid))
+        if entry is None or (cutoff is not None and entry['fetched'] < cutoff):
+            stale[game] = appid
+    return stale
+
+
+def build_game_tag_dict(game_appid_dict, raw_tags, blacklist):
+    game_tag_dict = {}
+    for game, appid in game_appid_dict.items():
+        entry = raw_tags.get(str(appid))
+        game_tag_dict[game] = apply_blacklist(entry['tags'], blacklist) if entry else []
     return game_tag_dict
 
 
@@ -75,21 +230,25 @@ def get_frequency_dict(game_tag_dict):
     return tag_freq_dict
 
 
-def clean_tag_freq_dict(tag_freq_dict):
-    print('Generating histogram...')
+def clean_tag_freq_dict(tag_freq_dict, threshold=None, bin_num=None):
     print('Minimum frequency observed is', min(tag_freq_dict.values()))
     print('Maximum frequency observed is', max(tag_freq_dict.values()))
-    bin_num = int(input('Histogram number of bins desired: '))
+    if threshold is None and bin_num is None:
+        bin_num = int(input('Histogram number of bins desired: '))
 
-    values = list(tag_freq_dict.values())
-    plt.hist(values, bins=bin_num)
-    plt.xlabel('Occurrence Count')
-    plt.ylabel('Number of Tags')
-    plt.title('Distribution of Tag Occurrences')
-    plt.savefig('../data/tag_distribution.png')
-    plt.close()
+    if bin_num is not None:
+        print('Generating histogram...')
+        import matplotlib.pyplot as plt
+        values = list(tag_freq_dict.values())
+        plt.hist(values, bins=bin_num)
+        plt.xlabel('Occurrence Count')
+        plt.ylabel('Number of Tags')
+        plt.title('Distribution of Tag Occurrences')
+        plt.savefig('../data/tag_distribution.png')
+        plt.close()
 
-    threshold = int(input('Review histogram and input threshold for cutoff: '))
+    if threshold is None:
+        threshold = int(input('Review histogram and input threshold for cutoff: '))
 
     clean_dict = {}
     removed_list = []
@@ -113,15 +272,72 @@ def filter_game_tag_dict(game_tag_dict, cleaned_tag_freq_dict):
     return filtered_game_tag_dict
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Scrape store page tags for every game in game_ids.json.')
+    parser.add_argument('--parallel', action='store_true',
+                        help='scrape concurrently under a per-host request budget')
+    parser.add_argument('--rate', type=float, default=1 / 3,
+                        help='store page requests per second per host in parallel mode')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='maximum in-flight store page requests in parallel mode')
+    parser.add_argument('--retry-rounds', type=int, default=2,
+                        help='passes over failed pages after the main scrape')
+    parser.add_argument('--max-age-days', type=float,
+                        help='also re-scrape games whose raw tags are older than this')
+    parser.add_argument('--full', action='store_true',
+                        help='re-scrape every game, not just new or stale ones')
+    parser.add_argument('--offline', action='store_true',
+                        help='skip scraping and re-derive the filtered tags from raw_game_tags.json')
+    parser.add_argument('--scrape-only', action='store_true',
+                        help='only update raw_game_tags.json, leaving the filtered tags alone')
+    parser.add_argument('--threshold', type=int,
+                        help='minimum tag frequency to keep, prompted for if omitted')
+    parser.add_argument('--bins', type=int,
+                        help='histogram bins, prompted for if neither this nor --threshold is given')
+    return parser.parse_args()
+
+
 def main():
+    args = parse_args()
     blacklist = ['Free to Play', 'Multiplayer',
                  'Early Access']  # Define your blacklist
+    raw_tag_file = '../data/raw_game_tags.json'
     game_appid_dict = load_game_appid_data('../data/game_ids.json')
-    game_tag_dict = get_game_tag_dict(game_appid_dict, blacklist)
-    tag_freq_dict = get_frequency_dict(game_tag_dict)
-    cleaned_tag_freq_dict = clean_tag_freq_dict(tag_freq_dict)
-    filtered_game_tag_dict = filter_game_tag_dict(
-        game_tag_dict, cleaned_tag_freq_dict)
+    raw_tags = load_raw_tags(raw_tag_file)
+
+    if not args.offline:
+        if args.full:
+            to_scrape = game_appid_dict
+        else:
+            to_scrape = find_stale_games(game_appid_dict, raw_tags, args.max_age_days)
+        print(len(to_scrape), 'of', len(game_appid_dict), 'games need their tags scraped.')
+        try:
+            with stage('scrape'):
+                if args.parallel:
+                    asyncio.run(async_get_game_tag_dict(
+                        to_scrape, raw_tags, args.rate, args.concurrency, args.retry_rounds))
+                else:
+                    get_game_tag_dict(to_scrape, raw_tags)
+        finally:
+            save_raw_tags(raw_tag_file, raw_tags)
+            print('Saved raw tags for', len(raw_tags), 'apps to raw_game_tags.json')
+        if args.scrape_only:
+            print(get_cache().summary())
+            return
+
+    if not raw_tags:
+        raise SystemExit('No scraped tags in raw_game_tags.json, run gettags without '
+                         '--offline (or with --scrape-only) first.')
+    with stage('filter_tags'):
+        game_tag_dict = build_game_tag_dict(game_appid_dict, raw_tags, blacklist)
+        tag_freq_dict = get_frequency_dict(game_tag_dict)
+        if not tag_freq_dict:
+            raise SystemExit('None of the games in game_ids.json have scraped tags, scrape '
+                             'their store pages before filtering.')
+        cleaned_tag_freq_dict = clean_tag_freq_dict(tag_freq_dict, args.threshold, args.bins)
+        filtered_game_tag_dict = filter_game_tag_dict(
+            game_tag_dict, cleaned_tag_freq_dict)
 
     with open('../data/game_tags.json', 'w', encoding='utf-8') as f:
         json.dump(filtered_game_tag_dict, f)
@@ -130,7 +346,9 @@ def main():
     with open('../data/tag_freqs.json', 'w', encoding='utf-8') as f:
         json.dump(cleaned_tag_freq_dict, f)
     print('Saved the tag frequencies for insights to tag_freqs.json')
+    print(get_cache().summary())
 
 
 if __name__ == '__main__':
-    main()
+    with run_report('gettags'):
+        main()
@@ -0,0 +1,13 @@
+_session = None
+
+
+def get_session():
+    global _session
+    if _session is None:
+        import requests
+        from requests.adapters import HTTPAdapter
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
@@ -0,0 +1,205 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+from decouple import config
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is left out there.
+    resource = None
+
+REPORT_DIR = config('METRICS_DIR', default='../data/run_reports')
+WRITE_PROMETHEUS = config('METRICS_PROMETHEUS', default=False, cast=bool)
+PREFIX = 'steamlibrec_'
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+NUMBER_RE = re.compile(r'/\d+')
+
+
+def endpoint_label(url):
+    # /app/570 and /app/730 are the same endpoint.
+    return NUMBER_RE.sub('/:id', urlsplit(url).path) or '/'
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def child_cpu_seconds():
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            yield bound, total
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.sum,
+                'mean': self.sum / self.count if self.count else 0.0,
+                'buckets': {str(bound): count for bound, count in self.cumulative()}}
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.histograms = {}
+        self.counters = {}
+        self.stages = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            key = self._key(name, labels)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def increment(self, name, amount=1, **labels):
+        with self.lock:
+            key = self._key(name, labels)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe_request(self, url, seconds, status):
+        endpoint = endpoint_label(url)
+        self.observe('http_request_seconds', seconds, endpoint=endpoint)
+        self.increment('http_requests_total', endpoint=endpoint, status=str(status))
+
+    @contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time() + child_cpu_seconds()
+        try:
+            yield
+        finally:
+            with self.lock:
+                stage = self.stages.setdefault(
+                    name, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0})
+                stage['calls'] += 1
+                stage['wall_seconds'] += time.perf_counter() - wall
+                stage['cpu_seconds'] += time.process_time() + child_cpu_seconds() - cpu
+                stage['peak_rss_mb'] = peak_rss_mb()
+
+    def report(self, script=None):
+        with self.lock:
+            return {
+                'script': script,
+                'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+                'wall_seconds': time.time() - self.started,
+                'peak_rss_mb': peak_rss_mb(),
+                'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'histograms': [dict(histogram.to_dict(), name=name, labels=dict(labels))
+                               for (name, labels), histogram
+                               in sorted(self.histograms.items(), key=lambda item: item[0])],
+            }
+
+    def prometheus(self):
+        def labels_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                                  for k, v in pairs) + '}'
+
+        lines = []
+        with self.lock:
+            for name in sorted({name for name, _ in self.counters}):
+                lines.append('# TYPE {}{} counter'.format(PREFIX, name))
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append('{}{}{} {}'.format(PREFIX, name, labels_text(labels), value))
+            for name in sorted({name for name, _ in self.histograms}):
+                lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+                for (histogram_name, labels), histogram in sorted(
+                        self.histograms.items(), key=lambda item: item[0]):
+                    if histogram_name != name:
+                        continue
+                    for bound, count in histogram.cumulative():
+                        lines.append('{}{}_bucket{} {}'.format(
+                            PREFIX, name, labels_text(labels, [('le', bound)]), count))
+                    lines.append('{}{}_sum{} {}'.format(PREFIX, name, labels_text(labels),
+                                                        histogram.sum))
+                    lines.append('{}{}_count{} {}'.format(PREFIX, name, labels_text(labels),
+                                                          histogram.count))
+            for field in ('wall_seconds', 'cpu_seconds'):
+                lines.append('# TYPE {}stage_{} gauge'.format(PREFIX, field))
+                for name, stage in sorted(self.stages.items()):
+                    lines.append('{}stage_{}{} {}'.format(
+                        PREFIX, field, labels_text([('stage', name)]), stage[field]))
+        rss = peak_rss_mb()
+        if rss is not None:
+            lines.append('# TYPE {}peak_rss_megabytes gauge'.format(PREFIX))
+            lines.append('{}peak_rss_megabytes {}'.format(PREFIX, rss))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, script, directory=REPORT_DIR, prometheus=WRITE_PROMETHEUS):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, script + '.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(script), f, indent=2)
+        if prometheus:
+            with open(os.path.join(directory, script + '.prom'), 'w', encoding='utf-8') as f:
+                f.write(self.prometheus())
+        return path
+
+
+_metrics = None
+
+
+def get_metrics():
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
+
+
+def stage(name):
+    return get_metrics().stage(name)
+
+
+@contextmanager
+def run_report(script):
+    # Wraps a script's main: the whole run is the 'total' stage and the
+    # report is written even when the run fails part way.
+    metrics = get_metrics()
+    try:
+        with metrics.stage('total'):
+            yield metrics
+    finally:
+        path = metrics.write(script)
+        print('Run report saved to', path)
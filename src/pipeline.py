@@ -0,0 +1,325 @@
+import argparse
+import ast
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from instrument import run_report, stage as timed_stage
+
+STATE_PATH = '../data/pipeline_state.json'
+LOG_DIR = '../data/pipeline_logs'
+
+
+class Stage:
+    # One script run. Dependencies are not listed, they come from which other
+    # stage writes each of the inputs. restart_args are added when the stage is
+    # forced or its inputs changed since it was last started, for scripts that
+    # would otherwise resume their own progress.
+    def __init__(self, name, script, args=(), inputs=(), outputs=(), restart_args=()):
+        self.name = name
+        self.script = script
+        self.args = [str(arg) for arg in args]
+        self.inputs = [os.path.normpath(path) for path in inputs]
+        self.outputs = [os.path.normpath(path) for path in outputs]
+        self.restart_args = [str(arg) for arg in restart_args]
+
+    def command(self, restart=False):
+        return [sys.executable, self.script] + self.args + (self.restart_args if restart else [])
+
+
+def build_stages(args):
+    ids_file = '../data/' + args.ids_file
+    stages = []
+    if args.group:
+        stages.append(Stage('group_ids', 'getgroupids.py',
+                            args.group + ['--count', args.count, '--output', ids_file],
+                            outputs=[ids_file]))
+    crawl = ['--async', '--rate', args.rate] if args.use_async else []
+    stages.append(Stage('libraries', 'getlibraries.py', [args.ids_file] + crawl,
+                        inputs=[ids_file],
+                        outputs=['../data/libraries', '../data/game_ids.json'],
+                        restart_args=['--fresh']))
+    stages.append(Stage('scrape_tags', 'gettags.py',
+                        ['--scrape-only'] + (['--parallel', '--rate', args.tag_rate]
+                                             if args.parallel_tags else []),
+                        inputs=['../data/game_ids.json'],
+                        outputs=['../data/raw_game_tags.json']))
+    stages.append(Stage('filter_tags', 'gettags.py', ['--offline', '--threshold', args.tag_threshold],
+                        inputs=['../data/game_ids.json', '../data/raw_game_tags.json'],
+                        outputs=['../data/game_tags.json', '../data/tag_freqs.json']))
+    stages.append(Stage('training_data', 'createinputdata.py',
+                        inputs=['../data/game_tags.json', '../data/libraries'],
+                        outputs=['../data/scaled_tag_time_matrix_excluded']))
+
+    cluster_args = ['--eps', args.eps, '--merge-threshold', args.merge_threshold]
+    if args.memory_limit_mb:
+        cluster_args += ['--memory-limit-mb', args.memory_limit_mb]
+    if args.n_jobs:
+        cluster_args += ['--n-jobs', args.n_jobs]
+    cluster_outputs = ['../data/dbscan_cluster_labels', '../data/merged_dbscan_cluster_labels',
+                       '../data/merged_clusters.json', '../data/dbscan_core_points',
+                       '../data/cluster_stats.json']
+    if args.eps == 'auto':
+        cluster_outputs.append('../models/eps_plot.png')
+    stages.append(Stage('clusters', 'createclusters.py', cluster_args,
+                        inputs=['../data/scaled_tag_time_matrix_excluded'],
+                        outputs=cluster_outputs))
+    stages.append(Stage('index', 'buildindex.py',
+                        inputs=['../data/merged_dbscan_cluster_labels', '../data/libraries'],
+                        outputs=['../data/cluster_game_index']))
+    if args.sweep_eps:
+        sweep_args = ['--eps', args.sweep_eps, '--min-samples', args.sweep_min_samples]
+        if args.n_jobs:
+            sweep_args += ['--n-jobs', args.n_jobs]
+        stages.append(Stage('sweep', 'sweepclusters.py', sweep_args,
+                            inputs=['../data/scaled_tag_time_matrix_excluded'],
+                            outputs=['../models/dbscan_sweep.csv']))
+    return stages
+
+
+def dependencies(stages):
+    producers = {path: stage.name for stage in stages for path in stage.outputs}
+    return {stage.name: {producers[path] for path in stage.inputs
+                         if path in producers and producers[path] != stage.name}
+            for stage in stages}
+
+
+def ancestors(name, deps):
+    found = {name}
+    for dep in deps[name]:
+        found |= ancestors(dep, deps)
+    return found
+
+
+def local_modules(script, found=None):
+    # The script plus every module from this folder it imports, directly or
+    # through other local modules, so a code change makes the stage stale.
+    found = set() if found is None else found
+    if script in found or not os.path.exists(script):
+        return found
+    found.add(script)
+    with open(script, 'rb') as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            local_modules(name.split('.')[0] + '.py', found)
+    return found
+
+
+class FileHasher:
+    # Content hashes keyed by path, reused while a file's size and mtime are
+    # unchanged so big artifacts are only re-read after they are rewritten.
+    def __init__(self, known):
+        self.known = known
+
+    def file(self, path):
+        info = os.stat(path)
+        entry = self.known.get(path)
+        if entry is not None and entry[:2] == [info.st_size, info.st_mtime_ns]:
+            return entry[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        self.known[path] = [info.st_size, info.st_mtime_ns, digest.hexdigest()]
+        return self.known[path][2]
+
+    def path(self, path):
+        if not os.path.exists(path):
+            return None
+        if not os.path.isdir(path):
+            return self.file(path)
+        digest = hashlib.sha256()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                full = os.path.join(root, name)
+                digest.update('{}\0{}\0'.format(os.path.relpath(full, path),
+                                                self.file(full)).encode())
+        return digest.hexdigest()
+
+
+def fingerprint(stage, hasher):
+    digest = hashlib.sha256(json.dumps([stage.script] + stage.args).encode())
+    for path in sorted(local_modules(stage.script)) + stage.inputs:
+        digest.update('{}\0{}\0'.format(path, hasher.path(path)).encode())
+    return digest.hexdigest()
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {'stages': {}, 'files': {}}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(path, state):
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, path)
+
+
+def run_stage(stage, restart=False):
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log = os.path.join(LOG_DIR, stage.name + '.log')
+    start = time.perf_counter()
+    # No stdin, so a stage that still prompts fails instead of hanging.
+    with timed_stage(stage.name), open(log, 'w', encoding='utf-8') as f:
+        result = subprocess.run(stage.command(restart), stdin=subprocess.DEVNULL,
+                                stdout=f, stderr=subprocess.STDOUT)
+    return result.returncode, time.perf_counter() - start, log
+
+
+def run_pipeline(stages, jobs=2, force=(), dry_run=False, state_path=STATE_PATH):
+    # Stages are checked once everything they depend on has finished, so their
+    # fingerprints cover the outputs upstream stages just wrote. A stage whose
+    # inputs came out byte for byte the same is skipped along with everything
+    # below it that is otherwise unchanged. The input hashes a stage was last
+    # started with are kept too, so a failed run is resumed unless the inputs
+    # moved on in between.
+    state = load_state(state_path)
+    hasher = FileHasher(state.setdefault('files', {}))
+    records = state.setdefault('stages', {})
+    deps = dependencies(stages)
+    by_name = {stage.name: stage for stage in stages}
+    pending = [stage.name for stage in stages]
+    status = {}
+    running = {}
+
+    def finish(name, result, message=''):
+        status[name] = result
+        print('[{}] {}{}'.format(result, name, message), flush=True)
+
+    with ThreadPoolExecutor(jobs) as pool:
+        while pending or running:
+            for name in list(pending):
+                if not deps[name] <= set(status):
+                    continue
+                pending.remove(name)
+                stage = by_name[name]
+                if any(status[dep] in ('failed', 'blocked') for dep in deps[name]):
+                    finish(name, 'blocked')
+                    continue
+                missing = [path for path in stage.inputs if not os.path.exists(path)]
+                if missing and not dry_run:
+                    finish(name, 'failed', ': missing ' + ', '.join(missing))
+                    continue
+                stage.fingerprint = fingerprint(stage, hasher)
+                stage.input_hashes = {path: hasher.path(path) for path in stage.inputs}
+                forced = name in force or 'all' in force
+                record = records.get(name, {})
+                stale = (forced or record.get('fingerprint') != stage.fingerprint
+                         or not all(os.path.exists(path) for path in stage.outputs))
+                if dry_run:
+                    upstream = any(status[dep] == 'would run' for dep in deps[name])
+                    finish(name, 'would run' if stale or upstream else 'fresh')
+                    continue
+                if not stale:
+                    finish(name, 'fresh')
+                    continue
+                restart = forced or record.get('inputs', stage.input_hashes) != stage.input_hashes
+                print('[running] {}: {}'.format(name, ' '.join(stage.command(restart)[1:])),
+                      flush=True)
+                record['inputs'] = stage.input_hashes
+                records[name] = record
+                save_state(state_path, state)
+                running[pool.submit(run_stage, stage, restart)] = name
+
+            if not running:
+                if pending:
+                    raise ValueError('Stages depend on each other in a cycle: ' +
+                                     ', '.join(pending))
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                code, seconds, log = future.result()
+                if code != 0:
+                    finish(name, 'failed', ' after {:.1f}s with exit code {}, see {}'.format(
+                        seconds, code, log))
+                    continue
+                records[name] = {'fingerprint': by_name[name].fingerprint,
+                                 'inputs': by_name[name].input_hashes,
+                                 'seconds': seconds, 'finished': time.time()}
+                save_state(state_path, state)
+                finish(name, 'ran', ' in {:.1f}s'.format(seconds))
+    if not dry_run:
+        save_state(state_path, state)
+    return status
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description='Run the whole pipeline without prompts, re-running only the stages '
+                    'whose inputs, parameters or code changed since their last run.')
+    parser.add_argument('--group', nargs='+',
+                        help='Steam group URLs or names to collect ids from; without them the '
+                             'existing id file is used')
+    parser.add_argument('--count', type=int, default=1000,
+                        help='unique member ids to collect across the --group groups')
+    parser.add_argument('--ids-file', default='user_ids.txt',
+                        help='id list file inside ../data/')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='crawl libraries concurrently')
+    parser.add_argument('--rate', type=float, default=65,
+                        help='Steam API requests per minute for an async crawl')
+    parser.add_argument('--parallel-tags', action='store_true',
+                        help='scrape store pages concurrently')
+    parser.add_argument('--tag-rate', type=float, default=1 / 3,
+                        help='store page requests per second when scraping concurrently')
+    parser.add_argument('--tag-threshold', type=int, required=True,
+                        help='minimum tag frequency to keep')
+    parser.add_argument('--eps', default='auto',
+                        help="DBSCAN eps, or 'auto' for the estimated elbow")
+    parser.add_argument('--merge-threshold', type=float, default=0.5,
+                        help='top tag similarity above which clusters are merged')
+    parser.add_argument('--memory-limit-mb', type=int,
+                        help='build the DBSCAN neighbor graph in chunks within this much memory')
+    parser.add_argument('--n-jobs', type=int,
+                        help='parallel jobs for the neighbor queries')
+    parser.add_argument('--sweep-eps',
+                        help='comma separated eps values for an extra sweepclusters stage')
+    parser.add_argument('--sweep-min-samples', default='3',
+                        help='comma separated min_samples values for the sweep stage')
+    parser.add_argument('--jobs', type=int, default=2,
+                        help='stages allowed to run at the same time')
+    parser.add_argument('--force', nargs='+', default=[],
+                        help="stage names to re-run even if fresh, or 'all'")
+    parser.add_argument('--until',
+                        help='only run this stage and the stages it depends on')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='show which stages would run without running them')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    stages = build_stages(args)
+    names = [stage.name for stage in stages]
+    for name in args.force + ([args.until] if args.until else []):
+        if name != 'all' and name not in names:
+            sys.exit('Unknown stage {}, stages are: {}'.format(name, ', '.join(names)))
+    if args.until:
+        keep = ancestors(args.until, dependencies(stages))
+        stages = [stage for stage in stages if stage.name in keep]
+
+    status = run_pipeline(stages, args.jobs, set(args.force), args.dry_run)
+    counts = {result: list(status.values()).count(result) for result in sorted(set(status.values()))}
+    print(', '.join('{} {}'.format(count, result) for result, count in counts.items()))
+    if any(result in ('failed', 'blocked') for result in status.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    with run_report('pipeline'):
+        main()
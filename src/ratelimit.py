@@ -0,0 +1,78 @@
+import asyncio
+import threading
+import time
+from urllib.parse import urlsplit
+from instrument import get_metrics
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=1, name='default'):
+        self.rate = rate
+        self.capacity = capacity
+        self.name = name
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def per_minute(cls, requests_per_minute, capacity=1, name='default'):
+        return cls(requests_per_minute / 60, capacity, name)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # Takes a token now, going into debt if needed, and returns how long
+        # the caller has to wait before the token is actually theirs.
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def pause(self, seconds):
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+        get_metrics().increment('rate_limit_pauses_total', limiter=self.name)
+
+    def _record(self, delay):
+        if delay > 0:
+            get_metrics().increment('throttle_seconds_total', delay, limiter=self.name)
+
+    def wait(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+        self._record(delay)
+        return delay
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._record(delay)
+        return delay
+
+
+class HostScheduler:
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.buckets = {}
+
+    def bucket(self, url):
+        host = urlsplit(url).netloc
+        if host not in self.buckets:
+            self.buckets[host] = TokenBucket(self.rate, self.capacity, host)
+        return self.buckets[host]
+
+    def pause(self, url, seconds):
+        self.bucket(url).pause(seconds)
+
+    async def acquire(self, url):
+        return await self.bucket(url).acquire()
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import time
+from collections import OrderedDict, deque
+import aiohttp
+import numpy as np
+from aiohttp import web
+from artifacts import load_libraries, pick_artifact
+from buildindex import build_index, load_cluster_members
+from getlibraries import async_single_library_fetch
+from instrument import get_metrics, run_report
+from ratelimit import TokenBucket
+from responsecache import disable_cache
+from singleuser import (BLACKLIST, load_json, load_recommendation_index, rank_clusters,
+                        recommend_games)
+from tagscoring import TagScorer
+
+
+class RecommendationModel:
+    def __init__(self, game_tags, cluster_tags, index):
+        self.game_tags = game_tags
+        self.cluster_tags = cluster_tags
+        self.index = index
+        self.scorer = TagScorer(cluster_tags, game_tags, BLACKLIST)
+
+    @classmethod
+    def load(cls, game_tags_file='../data/game_tags.json',
+             cluster_file='../data/merged_clusters.json'):
+        index = load_recommendation_index()
+        if index is None:
+            # No buildindex output for the current labels, build the same ranking in memory.
+            index = build_index(*load_cluster_members(
+                pick_artifact('../data/merged_dbscan_cluster_labels',
+                              '../data/merged_dbscan_cluster_labels.csv')),
+                load_libraries(pick_artifact('../data/libraries', '../data/libraries.json')))
+        return cls(load_json(game_tags_file), load_json(cluster_file), index)
+
+    def recommend_many(self, users):
+        # users holds (top game playtimes, owned games) pairs, scored together.
+        top_tags = self.scorer.top_tags([game_playtimes for game_playtimes, _ in users])
+        cluster_percentages = self.scorer.assign([[tag for tag, _ in tags] for tags in top_tags])
+        results = []
+        for (_, user_games), tags, percentages in zip(users, top_tags, cluster_percentages):
+            ranked_clusters, top_clusters = rank_clusters(percentages)
+            results.append({'top_tags': tags,
+                            'clusters': [{'cluster': cluster_id, 'similarity': percentage}
+                                         for cluster_id, percentage in ranked_clusters],
+                            'games': recommend_games(top_clusters, user_games, self.index)})
+        return results
+
+    def recommend(self, game_playtimes, user_games):
+        return self.recommend_many([(game_playtimes, user_games)])[0]
+
+
+class LibraryCache:
+    # Small LRU of recently seen users' libraries. Unknown, private and hidden
+    # profiles are kept as False for a shorter time so they don't hit the API
+    # each time. Requests Steam did not answer are not cached at all.
+    def __init__(self, max_entries=10000, ttl=600, failure_ttl=60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, steamid):
+        entry = self.entries.get(steamid)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.monotonic() > expires_at:
+            del self.entries[steamid]
+            return None
+        self.entries.move_to_end(steamid)
+        return value
+
+    def set(self, steamid, value):
+        ttl = self.ttl if value else self.failure_ttl
+        self.entries[steamid] = (time.monotonic() + ttl, value)
+        self.entries.move_to_end(steamid)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class LatencyStats:
+    def __init__(self, window=10000):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def summary(self):
+        if not self.samples:
+            return {'count': self.count}
+        ms = np.array(self.samples) * 1000
+        return {'count': self.count, 'mean_ms': float(ms.mean()),
+                'p50_ms': float(np.percentile(ms, 50)),
+                'p90_ms': float(np.percentile(ms, 90)),
+                'p99_ms': float(np.percentile(ms, 99)),
+                'max_ms': float(ms.max())}
+
+
+class LibraryFetcher:
+    def __init__(self, session, limiter, cache):
+        self.session = session
+        self.limiter = limiter
+        self.cache = cache
+        self.in_flight = {}
+        self.latency = LatencyStats()
+        self.counts = {'fetches': 0, 'failures': 0, 'upstream_failures': 0, 'cache_hits': 0,
+                       'coalesced': 0}
+
+    async def get(self, steamid):
+        # (top games, library), False for a profile without a visible library,
+        # or None when Steam could not be asked.
+        cached = self.cache.get(steamid)
+        if cached is not None:
+            self.counts['cache_hits'] += 1
+            return cached
+        task = self.in_flight.get(steamid)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(steamid))
+            self.in_flight[steamid] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(steamid, None))
+        else:
+            # Someone is already fetching this library, wait on their request.
+            self.counts['coalesced'] += 1
+        # Shielded so one caller going away does not cancel the shared fetch.
+        return await asyncio.shield(task)
+
+    async def _fetch(self, steamid):
+        self.counts['fetches'] += 1
+        start = time.perf_counter()
+        top_games, library = await async_single_library_fetch(
+            self.session, self.limiter, steamid)
+        self.latency.record(time.perf_counter() - start)
+        if top_games is None:
+            self.counts['upstream_failures'] += 1
+            return None
+        if not top_games:
+            self.counts['failures'] += 1
+            self.cache.set(steamid, False)
+            return False
+        self.cache.set(steamid, (top_games, library))
+        return top_games, library
+
+
+async def recommend_handler(request):
+    app = request.app
+    start = time.perf_counter()
+    steamid = request.match_info['steamid']
+    try:
+        fetched = await app['fetcher'].get(steamid)
+        if fetched is None:
+            app['errors'] += 1
+            return web.json_response(
+                {'steamid': steamid, 'error': 'The Steam API did not answer, try again later.'},
+                status=503)
+        if not fetched:
+            app['errors'] += 1
+            return web.json_response(
+                {'steamid': steamid,
+                 'error': 'Library could not be fetched, the profile may be private or hidden.'},
+                status=404)
+        top_games, library = fetched
+        result = app['model'].recommend(top_games, set(library.keys()))
+        return web.json_response(dict(result, steamid=steamid))
+    finally:
+        app['latency'].record(time.perf_counter() - start)
+
+
+@web.middleware
+async def instrument_middleware(request, handler):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        # Route patterns, not raw paths, so every steamid shares one histogram.
+        resource = request.match_info.route.resource
+        endpoint = resource.canonical if resource is not None else 'unmatched'
+        metrics = get_metrics()
+        metrics.observe('server_request_seconds', time.perf_counter() - start,
+                        endpoint=endpoint)
+        metrics.increment('server_requests_total', endpoint=endpoint, status=str(status))
+
+
+async def metrics_handler(request):
+    app = request.app
+    fetcher = app['fetcher']
+    if request.query.get('format') == 'prometheus':
+        return web.Response(text=get_metrics().prometheus(),
+                            content_type='text/plain', charset='utf-8')
+    return web.json_response({
+        'uptime_seconds': time.monotonic() - app['started'],
+        'recommend': app['latency'].summary(),
+        'library_fetch': fetcher.latency.summary(),
+        'libraries': dict(fetcher.counts, cached=len(fetcher.cache),
+                          in_flight=len(fetcher.in_flight)),
+        'errors': app['errors'],
+        'instrumentation': get_metrics().report('recommendserver')})
+
+
+async def health_handler(request):
+    return web.json_response({'status': 'ok', 'clusters': len(request.app['model'].cluster_tags)})
+
+
+def create_app(model, requests_per_minute=65, burst=1, concurrency=8, cache_size=10000,
+               cache_ttl=600):
+    app = web.Application(middlewares=[instrument_middleware])
+    app['model'] = model
+    app['latency'] = LatencyStats()
+    app['errors'] = 0
+    app['started'] = time.monotonic()
+
+    async def start_session(app):
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        app['session'] = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=30))
+        app['fetcher'] = LibraryFetcher(
+            app['session'], TokenBucket.per_minute(requests_per_minute, burst, 'steam_api'),
+            LibraryCache(cache_size, cache_ttl))
+
+    async def close_session(app):
+        await app['session'].close()
+
+    app.on_startup.append(start_session)
+    app.on_cleanup.append(close_session)
+    app.router.add_get('/recommend/{steamid}', recommend_handler)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/health', health_handler)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve recommendations over HTTP with the model kept in memory: '
+                    'GET /recommend/<steamid>, /metrics and /health.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--rate', type=float, default=65,
+                        help='Steam API requests per minute')
+    parser.add_argument('--burst', type=int, default=1,
+                        help='requests allowed back to back before the rate applies')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='open connections to the Steam API')
+    parser.add_argument('--cache-size', type=int, default=10000,
+                        help='recent user libraries kept in memory')
+    parser.add_argument('--cache-ttl', type=float, default=600,
+                        help='seconds a cached user library stays valid')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='bypass the on-disk HTTP response cache')
+    args = parser.parse_args()
+
+    if args.no_cache:
+        disable_cache()
+    model = RecommendationModel.load()
+    print('Loaded', len(model.game_tags), 'game tags and', len(model.cluster_tags), 'clusters.')
+    web.run_app(create_app(model, args.rate, args.burst, args.concurrency,
+                           args.cache_size, args.cache_ttl),
+                host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    with run_report('recommendserver'):
+        main()
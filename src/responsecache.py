@@ -0,0 +1,181 @@
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from decouple import config
+
+CACHE_PATH = config('HTTP_CACHE_PATH', default='../data/http_cache.sqlite')
+CACHE_MAX_MB = config('HTTP_CACHE_MAX_MB', default=1024, cast=int)
+
+DAY = 24 * 60 * 60
+# Matched against the request url, first hit wins. None is never cached:
+# vanity names have their own cache with separate TTLs for unresolved names.
+ENDPOINT_TTLS = [
+    ('ResolveVanityURL', None),
+    ('GetPlayerSummaries', DAY / 4),
+    ('GetOwnedGames', DAY),
+    ('/app/', 7 * DAY),
+]
+DEFAULT_TTL = DAY
+UNCACHED_PARAMETERS = {'key'}
+
+
+class CachedResponse:
+    from_cache = True
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ResponseCache:
+    def __init__(self, path=CACHE_PATH, max_bytes=CACHE_MAX_MB * 1024 * 1024,
+                 ttls=ENDPOINT_TTLS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttls = ttls
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            status INTEGER,
+            body BLOB,
+            size INTEGER,
+            created REAL,
+            accessed REAL)''')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.total_bytes = self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def make_key(self, url, parameters=None):
+        parameters = {k: str(v) for k, v in (parameters or {}).items()
+                      if k not in UNCACHED_PARAMETERS}
+        return url + '?' + json.dumps(parameters, sort_keys=True)
+
+    def ttl_for(self, url):
+        for endpoint, ttl in self.ttls:
+            if endpoint in url:
+                return ttl
+        return DEFAULT_TTL
+
+    def get(self, url, parameters=None):
+        ttl = self.ttl_for(url)
+        if ttl is None:
+            return None
+        key = self.make_key(url, parameters)
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT status, body, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            status, body, created = row
+            if now - created > ttl:
+                self.expired += 1
+                self.misses += 1
+                self._delete(key)
+                return None
+            self.conn.execute(
+                'UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self.conn.commit()
+            self.hits += 1
+        return CachedResponse(status, zlib.decompress(body))
+
+    def set(self, url, parameters, status, content):
+        if status != 200 or self.ttl_for(url) is None:
+            return
+        key = self.make_key(url, parameters)
+        body = zlib.compress(content)
+        now = time.time()
+        with self.lock:
+            self._delete(key)
+            self.conn.execute('INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                              (key, status, body, len(body), now, now))
+            self.total_bytes += len(body)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def _delete(self, key):
+        row = self.conn.execute(
+            'SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.total_bytes -= row[0]
+
+    def _evict(self):
+        # Least recently used entries go first, down to 90% of the budget so
+        # that eviction does not run again on the very next insert.
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute(
+            'SELECT key, size FROM responses ORDER BY accessed').fetchall()
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            self.conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.total_bytes -= size
+            self.evicted += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size_mb': self.total_bytes / (1024 * 1024),
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return ('HTTP cache: {hits} hits, {misses} misses ({expired} expired), '
+                '{hit_rate:.1%} hit rate, {evicted} evicted, {size_mb:.1f} MB on disk'
+                .format(**stats))
+
+    def close(self):
+        self.conn.close()
+
+
+class NullCache:
+    def get(self, url, parameters=None):
+        return None
+
+    def set(self, url, parameters, status, content):
+        pass
+
+    def stats(self):
+        return {}
+
+    def summary(self):
+        return 'HTTP cache disabled.'
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache()
+    return _cache
+
+
+def disable_cache():
+    global _cache
+    _cache = NullCache()
@@ -1,17 +1,30 @@
 import json
-from getlibraries import single_library_fetch
-import pandas as pd
+import os
+from artifacts import (fingerprint, is_artifact, load_columns, load_libraries,
+                       load_ranked_games, pick_artifact)
+from instrument import run_report, stage
+
+INDEX_PATH = '../data/cluster_game_index'
+BLACKLIST = ['Free to Play', 'Multiplayer',
+             'Early Access', 'Action', 'RPG', 'Adventure',
+             'Indie', 'Strategy', 'Open World',
+             'Simulation', 'Singleplayer', 'Casual', 'FPS']
+SIMILARITY_CUTOFF = 10.00
 
 
 def fetch_library_ids_by_cluster(cluster_number, cluster_label_file):
-    cluster_df = pd.read_csv(cluster_label_file)
+    if is_artifact(cluster_label_file):
+        labels = load_columns(cluster_label_file)
+        return labels['LibraryID'][labels['MergedCluster'] == cluster_number].tolist()
+    import pandas as pd
+    cluster_df = pd.read_csv(cluster_label_file, dtype={'LibraryID': str})
     libraries_in_cluster = cluster_df[cluster_df['MergedCluster']
                                       == cluster_number]['LibraryID'].tolist()
     return libraries_in_cluster
 
 
 def get_libraries_games(library_ids, library_file):
-    all_libraries = load_json(library_file)
+    all_libraries = load_libraries(library_file).top()
     libraries_games = {lib_id: all_libraries.get(
         str(lib_id), {}) for lib_id in library_ids}
     return libraries_games
@@ -33,6 +46,21 @@ def find_top_games(libraries_games, user_games):
     return top_games
 
 
+def load_recommendation_index(index_path=INDEX_PATH, labels_path=None):
+    # Written by buildindex; without it recommendations are aggregated from
+    # the training libraries on every run.
+    if not is_artifact(index_path):
+        return None
+    index = load_ranked_games(index_path)
+    labels_path = labels_path or pick_artifact('../data/merged_dbscan_cluster_labels',
+                                               '../data/merged_dbscan_cluster_labels.csv')
+    if os.path.exists(labels_path) and index.labels != fingerprint(labels_path):
+        print("'{}/' was built from other cluster labels, ignoring it. "
+              "Re-run buildindex to use it again.".format(index_path.split('/')[-1]))
+        return None
+    return index
+
+
 def load_json(filename):
     with open(filename, 'r') as f:
         return json.load(f)
@@ -85,41 +113,59 @@ def get_top_tags_by_playtime(game_playtimes, game_tags, blacklist=[]):
     return top_tags
 
 
+def cluster_top_games(cluster_number, user_games, index=None):
+    if index is not None:
+        return index.top_games(int(cluster_number), user_games)
+    library_ids = fetch_library_ids_by_cluster(
+        int(cluster_number), pick_artifact('../data/merged_dbscan_cluster_labels',
+                                           '../data/merged_dbscan_cluster_labels.csv'))
+    libraries_games = get_libraries_games(
+        library_ids, pick_artifact('../data/libraries', '../data/libraries.json'))
+    return find_top_games(libraries_games, user_games)
+
+
+def rank_clusters(cluster_percentages):
+    ranked_clusters = sorted(cluster_percentages.items(), key=lambda x: x[1], reverse=True)
+    top_clusters = [cluster_id for cluster_id, percentage in ranked_clusters
+                    if float(percentage * 100) > SIMILARITY_CUTOFF]
+    return ranked_clusters, top_clusters
+
+
+def recommend_games(top_clusters, user_games, index=None):
+    games = []
+    seen = set()
+    for cluster_number in top_clusters:
+        for game, playtime in cluster_top_games(cluster_number, user_games, index):
+            if game not in seen:
+                seen.add(game)
+                games.append(game)
+    return games
+
+
 def main():
+    from getlibraries import single_library_fetch
     steamid = input('Input steamid for user: ')
-    userlib, all_lib = single_library_fetch(steamid)
+    with stage('fetch'):
+        userlib, all_lib = single_library_fetch(steamid)
     game_playtimes = userlib[next(iter(userlib))]
     user_games = set(all_lib.keys())
-    game_tags = load_json('../data/game_tags.json')
-
-    blacklist = ['Free to Play', 'Multiplayer',
-                 'Early Access', 'Action', 'RPG', 'Adventure',
-                 'Indie', 'Strategy', 'Open World',
-                 'Simulation', 'Singleplayer', 'Casual', 'FPS']
-
-    top_tags = get_top_tags_by_playtime(game_playtimes, game_tags, blacklist)
+    with stage('assign'):
+        game_tags = load_json('../data/game_tags.json')
+        top_tags = get_top_tags_by_playtime(game_playtimes, game_tags, BLACKLIST)
+        cluster_percentages = assign_clusters(
+            [tag for tag, _ in top_tags], '../data/merged_clusters.json')
     print(top_tags)
-    cluster_percentages = assign_clusters(
-        [tag for tag, _ in top_tags], '../data/merged_clusters.json')
 
-    top_clusters = []
-    games = set()
-    for cluster_id, percentage in sorted(cluster_percentages.items(), key=lambda x: x[1], reverse=True):
+    ranked_clusters, top_clusters = rank_clusters(cluster_percentages)
+    for cluster_id, percentage in ranked_clusters:
         print(f"Cluster {cluster_id}: {percentage:.2%} similarity")
-        if float(percentage * 100) > 10.00:
-            top_clusters.append(cluster_id)
     print("Based on your preferences and similarity alignment you are most likely to enjoy in order:")
-    for cluster_number in top_clusters:
-        library_ids = fetch_library_ids_by_cluster(
-            int(cluster_number), '../data/merged_dbscan_cluster_labels.csv')
-        libraries_games = get_libraries_games(
-            library_ids, '../data/libraries.json')
-        top_games = find_top_games(libraries_games, user_games)
-        for game, playtime in top_games:
-            if game not in games:
-                games.add(game)
-                print(f'{game}')
+    with stage('recommend'):
+        games = recommend_games(top_clusters, user_games, load_recommendation_index())
+    for game in games:
+        print(f'{game}')
 
 
 if __name__ == '__main__':
-    main()
+    with run_report('singleuser'):
+        main()
@@ -0,0 +1,197 @@
+import argparse
+import asyncio
+import os
+import random
+
+STUB_TAGS = ['Action', 'RPG', 'Adventure', 'Indie', 'Strategy', 'Open World',
+             'Simulation', 'Singleplayer', 'Casual', 'FPS', 'Free to Play',
+             'Multiplayer', 'Early Access', 'Shooter', 'Survival', 'Horror',
+             'Puzzle', 'Platformer', 'Roguelike', 'Racing', 'Sports', 'Sandbox',
+             'Crafting', 'Co-op', 'Story Rich', 'Atmospheric', 'Pixel Graphics',
+             'Anime', 'Sci-fi', 'Fantasy', 'Turn-Based', 'Card Game', 'MMORPG',
+             'Battle Royale', 'Tactical', 'Metroidvania', 'Souls-like', 'Building']
+
+
+def build_fake_store(games, seed):
+    rng = random.Random(seed)
+    return {game['appid']: rng.sample(STUB_TAGS, rng.randint(3, 15)) for game in games}
+
+
+def render_store_page(appid, tags):
+    # Roughly the shape of a real store page: lots of markup around one small
+    # glance_tags block.
+    filler = ''.join('<div class="game_area_description"><p>Filler paragraph ' + str(i) +
+                     ' for app ' + str(appid) + '.</p></div>\n' for i in range(400))
+    tag_links = ''.join(
+        '<a href="https://store.steampowered.com/tags/en/' + tag + '/?snr=1_5_9__409" '
+        'class="app_tag" style="display: none;">\n\t\t\t\t\t\t\t\t\t\t\t\t\t' + tag +
+        '\t\t\t\t\t\t\t\t\t\t\t\t</a>' for tag in tags)
+    return ('<!DOCTYPE html><html><head><title>Stub app ' + str(appid) + '</title></head>'
+            '<body><div class="page_content">' + filler +
+            '<div class="glance_ctn_responsive_right"><div class="glance_tags_label">'
+            'Popular user-defined tags for this product:</div>'
+            '<div class="glance_tags popular_tags" data-appid="' + str(appid) + '">' +
+            tag_links + '<div class="app_tag add_button">+</div></div></div>' +
+            filler + '</div></body></html>')
+
+
+def build_fake_steam(num_users, num_games, seed):
+    rng = random.Random(seed)
+    games = [{'appid': 10 * (i + 1), 'name': 'Stub Game ' + str(i)}
+             for i in range(num_games)]
+    users = {}
+    vanity = {}
+    for i in range(num_users):
+        steamid = str(76561197960265728 + i)
+        owned = rng.sample(games, rng.randint(1, min(60, num_games)))
+        hidden = rng.random() < 0.05
+        users[steamid] = {
+            'visibility': 3 if rng.random() < 0.8 else 1,
+            'games': [dict(game, playtime_forever=0 if hidden else rng.randint(0, 50000))
+                      for game in owned]
+        }
+        if rng.random() < 0.3:
+            vanity['stubuser' + str(i)] = steamid
+    return users, vanity, games
+
+
+def build_fake_groups(users, num_groups, seed):
+    # Groups overlap heavily, like real ones, so ids need deduplicating.
+    rng = random.Random(seed)
+    steamids = list(users)
+    return {'stubgroup' + str(i): rng.sample(steamids, rng.randint(len(steamids) * 2 // 5,
+                                                                   len(steamids) * 7 // 10))
+            for i in range(num_groups)}
+
+
+def render_member_page(name, members, page, page_size):
+    total_pages = max(1, -(-len(members) // page_size))
+    start = (page - 1) * page_size
+    return ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?><memberList>'
+            '<groupID64>103582791429521408</groupID64><groupDetails><groupName><![CDATA[' +
+            name + ']]></groupName><memberCount>' + str(len(members)) +
+            '</memberCount></groupDetails><memberCount>' + str(len(members)) +
+            '</memberCount><totalPages>' + str(total_pages) + '</totalPages><currentPage>' +
+            str(page) + '</currentPage><startingMember>' + str(start) +
+            '</startingMember><members>' +
+            ''.join('<steamID64>' + steamid + '</steamID64>'
+                    for steamid in members[start:start + page_size]) +
+            '</members></memberList>')
+
+
+def create_app(users, vanity, store_tags=None, store_pages=None, error_rate=0.0,
+               latency=0.0, seed=0, groups=None, member_page_size=1000):
+    from aiohttp import web
+    rng = random.Random(seed)
+    app = web.Application()
+    app['requests'] = 0
+
+    @web.middleware
+    async def flaky(request, handler):
+        app['requests'] += 1
+        if latency:
+            await asyncio.sleep(latency)
+        if rng.random() < error_rate:
+            status = rng.choice([429, 503])
+            return web.Response(status=status, headers={'Retry-After': '1'})
+        return await handler(request)
+
+    app.middlewares.append(flaky)
+
+    async def resolve_vanity(request):
+        steamid = vanity.get(request.query.get('vanityurl', ''))
+        if steamid is None:
+            return web.json_response({'response': {'success': 42, 'message': 'No match'}})
+        return web.json_response({'response': {'success': 1, 'steamid': steamid}})
+
+    async def player_summaries(request):
+        players = []
+        for steamid in request.query.get('steamids', '').split(','):
+            if steamid in users:
+                players.append({'steamid': steamid,
+                                'communityvisibilitystate': users[steamid]['visibility']})
+        return web.json_response({'response': {'players': players}})
+
+    async def owned_games(request):
+        user = users.get(request.query.get('steamid', ''))
+        if user is None or user['visibility'] != 3:
+            return web.json_response({'response': {}})
+        return web.json_response({'response': {'game_count': len(user['games']),
+                                               'games': user['games']}})
+
+    async def store_page(request):
+        appid = request.match_info['appid']
+        if store_pages is not None:
+            path = os.path.join(store_pages, appid + '.html')
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    return web.Response(body=f.read(), content_type='text/html')
+        if store_tags is not None and appid.isdigit() and int(appid) in store_tags:
+            return web.Response(text=render_store_page(appid, store_tags[int(appid)]),
+                                content_type='text/html')
+        # The real store redirects removed apps to the front page.
+        return web.Response(text='<html><body>Welcome to Steam</body></html>',
+                            content_type='text/html')
+
+    async def member_list(request):
+        members = (groups or {}).get(request.match_info['name'])
+        page = request.query.get('p', '1')
+        if members is None or not page.isdigit():
+            # The community site answers unknown groups with an HTML error page.
+            return web.Response(text='<html><body>No group could be retrieved</body></html>',
+                                content_type='text/html')
+        return web.Response(text=render_member_page(request.match_info['name'], members,
+                                                    int(page), member_page_size),
+                            content_type='text/xml')
+
+    app.router.add_get('/ISteamUser/ResolveVanityURL/v0001/', resolve_vanity)
+    app.router.add_get('/ISteamUser/GetPlayerSummaries/v0002/', player_summaries)
+    app.router.add_get('/IPlayerService/GetOwnedGames/v0001/', owned_games)
+    app.router.add_get('/app/{appid}', store_page)
+    app.router.add_get('/groups/{name}/memberslistxml/', member_list)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Serve a fake Steam Web API, store and community site for offline crawl '
+                    'testing. Point STEAM_API_BASE, STEAM_STORE_BASE and STEAM_COMMUNITY_BASE '
+                    'at http://HOST:PORT to use it.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--games', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with 429/503')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added to every response')
+    parser.add_argument('--store-pages',
+                        help='directory of saved <appid>.html store pages to serve '
+                             'instead of generated ones')
+    parser.add_argument('--groups', type=int, default=3,
+                        help='community groups to serve, named stubgroup0, stubgroup1, ...')
+    parser.add_argument('--member-page-size', type=int, default=1000,
+                        help='members per member list page')
+    parser.add_argument('--write-ids',
+                        help='write the stub user ids (some as vanity names) to this file')
+    args = parser.parse_args()
+
+    users, vanity, games = build_fake_steam(args.users, args.games, args.seed)
+    store_tags = build_fake_store(games, args.seed)
+    if args.write_ids:
+        custom_names = {steamid: name for name, steamid in vanity.items()}
+        with open(args.write_ids, 'w') as f:
+            for steamid in users:
+                f.write(custom_names.get(steamid, steamid) + '\n')
+        print('Saved', len(users), 'stub ids to', args.write_ids)
+
+    groups = build_fake_groups(users, args.groups, args.seed)
+    app = create_app(users, vanity, store_tags, args.store_pages,
+                     args.error_rate, args.latency, args.seed, groups, args.member_page_size)
+    from aiohttp import web
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
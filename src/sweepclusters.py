@@ -0,0 +1,130 @@
+import argparse
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from sklearn.cluster import DBSCAN
+from sklearn.metrics import silhouette_score
+from artifacts import pick_artifact
+from createclusters import as_matrix, build_radius_graph, load_data, matrix_bytes
+from instrument import run_report, stage
+
+_sweep_worker = {}
+
+
+def _init_sweep_worker(graph, matrix, silhouette_sample, seed):
+    _sweep_worker['graph'] = graph
+    _sweep_worker['matrix'] = matrix
+    _sweep_worker['silhouette_sample'] = silhouette_sample
+    _sweep_worker['seed'] = seed
+
+
+def cluster_quality(matrix, labels, sample_size, seed=0):
+    # Silhouette over the clustered rows only, noise has no cluster to score.
+    clustered = np.flatnonzero(labels >= 0)
+    if len(np.unique(labels[clustered])) < 2:
+        return float('nan')
+    if len(clustered) > sample_size:
+        rng = np.random.default_rng(seed)
+        clustered = np.sort(rng.choice(clustered, sample_size, replace=False))
+        if len(np.unique(labels[clustered])) < 2:
+            return float('nan')
+    return float(silhouette_score(matrix[clustered], labels[clustered]))
+
+
+def _sweep_setting(setting):
+    eps, min_samples = setting
+    start = time.perf_counter()
+    # DBSCAN only follows graph edges within eps, so one graph built at the
+    # largest eps serves every smaller one.
+    labels = DBSCAN(eps=eps, min_samples=min_samples,
+                    metric='precomputed').fit(_sweep_worker['graph']).labels_
+    clusters = len(set(labels)) - (1 if -1 in labels else 0)
+    return {'eps': eps, 'min_samples': min_samples, 'clusters': clusters,
+            'noise_fraction': float(np.mean(labels == -1)),
+            'silhouette': cluster_quality(_sweep_worker['matrix'], labels,
+                                          _sweep_worker['silhouette_sample'],
+                                          _sweep_worker['seed']),
+            'seconds': time.perf_counter() - start}
+
+
+def sweep_workers(graph, matrix, memory_limit_mb, n_jobs, settings, shared):
+    # DBSCAN on a precomputed graph copies its edges into per-row neighbor
+    # arrays, about one more graph per running worker. Workers that are not
+    # forked also get their own pickled graph and matrix.
+    graph_size = matrix_bytes(graph)
+    per_worker = graph_size if shared else 2 * graph_size + matrix_bytes(matrix)
+    available = memory_limit_mb * 1024 * 1024 - graph_size - matrix_bytes(matrix)
+    fit = int(available // per_worker) if per_worker else n_jobs
+    return max(1, min(n_jobs, len(settings), fit))
+
+
+def sweep(data, eps_values, min_samples_values, memory_limit_mb=1024, n_jobs=None,
+          silhouette_sample=5000, seed=0):
+    n_jobs = os.cpu_count() if n_jobs in (None, -1) else n_jobs
+    matrix = as_matrix(data, dense_limit=memory_limit_mb * 1024 * 1024 // 4)
+    graph = build_radius_graph(matrix, max(eps_values), memory_limit_mb, n_jobs)
+    settings = [(eps, min_samples) for eps in sorted(eps_values)
+                for min_samples in sorted(min_samples_values)]
+    # Set here so forked workers share the graph and matrix instead of each
+    # unpickling a copy.
+    _init_sweep_worker(graph, matrix, silhouette_sample, seed)
+    shared = 'fork' in multiprocessing.get_all_start_methods()
+    workers = sweep_workers(graph, matrix, memory_limit_mb, n_jobs, settings, shared)
+    if workers < min(n_jobs, len(settings)):
+        print('Running {} settings at a time to stay within {} MB.'.format(
+            workers, memory_limit_mb))
+    if workers == 1:
+        results = [_sweep_setting(setting) for setting in settings]
+    elif shared:
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+            results = list(pool.map(_sweep_setting, settings))
+    else:
+        with ProcessPoolExecutor(workers, initializer=_init_sweep_worker,
+                                 initargs=(graph, matrix, silhouette_sample, seed)) as pool:
+            results = list(pool.map(_sweep_setting, settings))
+    return pd.DataFrame(results)
+
+
+def parse_values(text, cast):
+    return [cast(value) for value in text.split(',') if value.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run DBSCAN over a grid of eps/min_samples values on one shared '
+                    'neighbor graph and report cluster counts, noise and silhouette.')
+    parser.add_argument('--eps', required=True,
+                        help='comma separated eps values, e.g. 0.05,0.1,0.15')
+    parser.add_argument('--min-samples', default='3',
+                        help='comma separated min_samples values, e.g. 3,5,10')
+    parser.add_argument('--n-jobs', type=int, default=-1,
+                        help='worker processes for the graph and the grid, -1 for all cores')
+    parser.add_argument('--memory-limit-mb', type=int, default=1024,
+                        help='memory ceiling for the neighbor graph and the parallel DBSCAN '
+                             'runs on it, which may run fewer settings at a time to fit')
+    parser.add_argument('--silhouette-sample', type=int, default=5000,
+                        help='clustered rows sampled for the silhouette score')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='../models/dbscan_sweep.csv',
+                        help='where to save the results table')
+    args = parser.parse_args()
+
+    with stage('load'):
+        data = load_data(pick_artifact('../data/scaled_tag_time_matrix_excluded',
+                                       '../data/scaled_tag_time_matrix_excluded.csv'))
+    start = time.perf_counter()
+    with stage('sweep'):
+        results = sweep(data, parse_values(args.eps, float), parse_values(args.min_samples, int),
+                        args.memory_limit_mb, args.n_jobs, args.silhouette_sample, args.seed)
+    print(results.to_string(index=False, float_format='{:.4f}'.format))
+    print('{} settings in {:.1f}s'.format(len(results), time.perf_counter() - start))
+    results.to_csv(args.output, index=False)
+    print("Sweep results saved to '{}'.".format(args.output))
+
+
+if __name__ == '__main__':
+    with run_report('sweepclusters'):
+        main()
@@ -0,0 +1,107 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+from artifacts import LibraryTable, save_library_table
+from stubsteam import STUB_TAGS
+
+FIRST_STEAMID = 76561197960265728
+
+
+def generate_games(num_games, num_tags=300, seed=0):
+    # Game names and appids follow stubsteam ('Stub Game N', appid 10 * (N + 1)),
+    # so generated data lines up with what the stub serves.
+    rng = np.random.default_rng(seed)
+    vocabulary = (STUB_TAGS + ['Synthetic Tag ' + str(i)
+                               for i in range(max(0, num_tags - len(STUB_TAGS)))])[:num_tags]
+    # A few tags are very common and most are rare, like on the real store.
+    popularity = 1 / np.arange(1, len(vocabulary) + 1)
+    popularity /= popularity.sum()
+    names = ['Stub Game ' + str(i) for i in range(num_games)]
+    game_tags = {}
+    for name, count in zip(names, rng.integers(1, 6, num_games)):
+        chosen = rng.choice(len(vocabulary), size=min(count, len(vocabulary)),
+                            replace=False, p=popularity)
+        game_tags[name] = [vocabulary[tag] for tag in chosen]
+    game_appids = {name: 10 * (i + 1) for i, name in enumerate(names)}
+    return game_tags, game_appids
+
+
+def generate_libraries(num_users, games, seed=0, archetypes=20, pool_size=40,
+                       stray_fraction=0.2):
+    # Each user belongs to an archetype and mostly plays games from that
+    # archetype's pool, with some strays from the whole catalogue, so the
+    # data actually has clusters to find. Built with array ops so a million
+    # users only takes seconds.
+    rng = np.random.default_rng(seed)
+    num_games = len(games)
+    pool_size = min(pool_size, num_games)
+    pools = np.array([rng.choice(num_games, pool_size, replace=False)
+                      for _ in range(archetypes)])
+
+    counts = rng.integers(1, 11, num_users)
+    users = np.repeat(np.arange(num_users), counts)
+    archetype = rng.integers(0, archetypes, num_users)[users]
+    # Consecutive slots of the pool, so a user's pool games never repeat.
+    start = rng.integers(0, pool_size, num_users)[users]
+    slot = (start + np.arange(len(users)) - np.repeat(np.cumsum(counts) - counts, counts))
+    game_index = pools[archetype, slot % pool_size]
+    strays = rng.random(len(users)) < stray_fraction
+    game_index[strays] = rng.integers(0, num_games, strays.sum())
+    playtimes = np.round(rng.lognormal(7, 1.5, len(users))).astype(np.int64)
+
+    # Drop repeated games and keep each library sorted by playtime, like the
+    # top ten lists getlibraries stores.
+    _, first = np.unique(users * num_games + game_index, return_index=True)
+    first = np.sort(first)
+    users, game_index, playtimes = users[first], game_index[first], playtimes[first]
+    order = np.lexsort((-playtimes, users))
+    users, game_index, playtimes = users[order], game_index[order], playtimes[order]
+
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(users, minlength=num_users))))
+    steamids = np.array([str(FIRST_STEAMID + i) for i in range(num_users)])
+    return LibraryTable(steamids, list(games), indptr.astype(np.int64),
+                        game_index.astype(np.int32), playtimes)
+
+
+def generate_dataset(num_users, num_games=2000, num_tags=300, seed=0, archetypes=20):
+    game_tags, game_appids = generate_games(num_games, num_tags, seed)
+    libraries = generate_libraries(num_users, game_tags, seed + 1, archetypes)
+    libraries.appids = np.array([game_appids[game] for game in libraries.games], dtype=np.int32)
+    return libraries, game_tags, game_appids
+
+
+def save_dataset(directory, libraries, game_tags, game_appids):
+    os.makedirs(directory, exist_ok=True)
+    save_library_table(os.path.join(directory, 'libraries'), libraries)
+    with open(os.path.join(directory, 'game_tags.json'), 'w', encoding='utf-8') as f:
+        json.dump(game_tags, f)
+    with open(os.path.join(directory, 'game_ids.json'), 'w', encoding='utf-8') as f:
+        json.dump(game_appids, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate seeded synthetic libraries, game tags and appids in the '
+                    'same formats the pipeline reads.')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--games', type=int, default=2000)
+    parser.add_argument('--tags', type=int, default=300)
+    parser.add_argument('--archetypes', type=int, default=20,
+                        help='player archetypes the libraries are drawn from')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='../data/synthetic',
+                        help='directory for libraries/, game_tags.json and game_ids.json')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    libraries, game_tags, game_appids = generate_dataset(
+        args.users, args.games, args.tags, args.seed, args.archetypes)
+    save_dataset(args.output, libraries, game_tags, game_appids)
+    print('Generated {} libraries over {} games in {:.1f}s, saved to {}'.format(
+        len(libraries), len(game_tags), time.perf_counter() - start, args.output))
+
+
+if __name__ == '__main__':
+    main()
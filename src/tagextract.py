@@ -0,0 +1,107 @@
+import html
+import re
+from importlib.util import find_spec
+
+SNIPPET_PARSER = 'lxml' if find_spec('lxml') is not None else 'html.parser'
+
+CONTAINER_MARKER = b'class="glance_tags popular_tags"'
+LOOSE_MARKER = b'glance_tags'
+DIV_RE = re.compile(rb'<div\b|</div\s*>', re.IGNORECASE)
+ANCHOR_RE = re.compile(r'<a\b([^>]*)>(.*?)</a\s*>', re.IGNORECASE | re.DOTALL)
+CLASS_RE = re.compile(r'\bclass\s*=\s*(?:"([^"]*)"|\'([^\']*)\')', re.IGNORECASE)
+TAG_RE = re.compile(r'<[^>]*>')
+
+
+def extract_tags_soup(content, blacklist):
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(content, 'html.parser')
+    tags_container = soup.find('div', class_='glance_tags popular_tags')
+    if tags_container is None:
+        return None
+    return tags_from_container(tags_container, blacklist)
+
+
+def tags_from_container(tags_container, blacklist):
+    tags = tags_container.find_all(
+        'a', class_='app_tag', limit=5 + len(blacklist))
+    return [tag.get_text(strip=True) for tag in tags if tag.get_text(
+        strip=True) not in blacklist][:5]
+
+
+def apply_blacklist(raw_tags, blacklist):
+    # Same cut as tags_from_container: look at the first 5 + len(blacklist)
+    # tags only, drop blacklisted ones, keep at most five.
+    return [tag for tag in raw_tags[:5 + len(blacklist)] if tag not in blacklist][:5]
+
+
+def find_container(content):
+    start = content.find(CONTAINER_MARKER)
+    if start == -1:
+        return None
+    start = content.rfind(b'<div', 0, start)
+    if start == -1:
+        return None
+    # The closing tag is found on the raw bytes, so only the container itself
+    # is decoded, never the rest of the page.
+    depth = 0
+    for match in DIV_RE.finditer(content, start):
+        if match.group(0).startswith(b'</'):
+            depth -= 1
+            if depth == 0:
+                return content[start:match.end()].decode('utf-8', errors='replace')
+        else:
+            depth += 1
+    return None
+
+
+def anchor_text(inner):
+    # Matches get_text(strip=True): every text node is stripped on its own and
+    # the pieces are joined without a separator.
+    pieces = (html.unescape(piece).strip() for piece in TAG_RE.split(inner))
+    return ''.join(piece for piece in pieces if piece)
+
+
+def scan_container(snippet, limit=None):
+    tags = []
+    for match in ANCHOR_RE.finditer(snippet):
+        class_match = CLASS_RE.search(match.group(1))
+        if class_match is None:
+            continue
+        classes = (class_match.group(1) or class_match.group(2) or '').split()
+        if 'app_tag' not in classes:
+            continue
+        tags.append(anchor_text(match.group(2)))
+        if len(tags) == limit:
+            break
+    return tags
+
+
+def extract_raw_tags(content, limit=None):
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    if LOOSE_MARKER not in content:
+        return None
+
+    snippet = find_container(content)
+    if snippet is not None and '<!--' not in snippet and '<script' not in snippet:
+        return scan_container(snippet, limit)
+    from bs4 import BeautifulSoup
+    if snippet is None:
+        # Unusual markup around the container, let a real parser deal with it.
+        soup = BeautifulSoup(content, 'html.parser')
+        tags_container = soup.find('div', class_='glance_tags popular_tags')
+        if tags_container is None:
+            return None
+    else:
+        # Comments and scripts can hide markup from the regexes, so the small
+        # snippet gets a proper parse instead.
+        tags_container = BeautifulSoup(snippet, SNIPPET_PARSER)
+    return [tag.get_text(strip=True) for tag in tags_container.find_all(
+        'a', class_='app_tag', limit=limit)]
+
+
+def extract_tags_fast(content, blacklist):
+    raw_tags = extract_raw_tags(content, 5 + len(blacklist))
+    if raw_tags is None:
+        return None
+    return apply_blacklist(raw_tags, blacklist)
@@ -0,0 +1,141 @@
+import numpy as np
+from scipy import sparse
+
+
+class TagScorer:
+    # Matrix versions of singleuser's get_top_tags_by_playtime, assign_clusters
+    # and calculate_similarity_scores for many users at once. Results are
+    # exactly what the dict based functions return, ties and rounding included.
+    def __init__(self, cluster_tags, game_tags=None, blacklist=()):
+        self.cluster_ids = list(cluster_tags)
+        self.vocabulary = {}
+        self.tags = []
+        self.clusters = self._incidence(cluster_tags.values())
+        self.cluster_sizes = np.diff(self.clusters.indptr)
+
+        self.games = {}
+        if game_tags is not None:
+            blacklist = set(blacklist)
+            indptr = [0]
+            indices = []
+            for game, tags in game_tags.items():
+                self.games[game] = len(self.games)
+                # Repeats are kept, the dict version counts them twice too.
+                indices.extend(self._column(tag) for tag in tags if tag not in blacklist)
+                indptr.append(len(indices))
+            self.game_tag_indptr = np.array(indptr, dtype=np.int64)
+            self.game_tag_indices = np.array(indices, dtype=np.int64)
+
+    def _column(self, tag):
+        column = self.vocabulary.get(tag)
+        if column is None:
+            column = self.vocabulary[tag] = len(self.tags)
+            self.tags.append(tag)
+        return column
+
+    def _incidence(self, tag_lists):
+        rows, cols = [], []
+        for row, tags in enumerate(tag_lists):
+            for column in {self._column(tag) for tag in tags}:
+                rows.append(row)
+                cols.append(column)
+        return sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                                 shape=(len(tag_lists), len(self.tags)))
+
+    def _user_matrix(self, user_tag_lists):
+        # Tags no cluster has only matter for the union size, so they are
+        # counted but get no column.
+        rows, cols = [], []
+        sizes = np.zeros(len(user_tag_lists), dtype=np.int64)
+        for row, tags in enumerate(user_tag_lists):
+            tags = set(tags)
+            sizes[row] = len(tags)
+            for tag in tags:
+                column = self.vocabulary.get(tag)
+                if column is not None and column < self.clusters.shape[1]:
+                    rows.append(row)
+                    cols.append(column)
+        users = sparse.csr_matrix((np.ones(len(rows), dtype=np.int64), (rows, cols)),
+                                  shape=(len(user_tag_lists), self.clusters.shape[1]))
+        return users, sizes
+
+    def jaccard(self, user_tag_lists):
+        users, sizes = self._user_matrix(user_tag_lists)
+        intersection = (users @ self.clusters.T).toarray()
+        union = sizes[:, None] + self.cluster_sizes[None, :] - intersection
+        scores = np.zeros(intersection.shape)
+        np.divide(intersection, union, out=scores, where=union > 0)
+        return scores
+
+    def cosine(self, user_tag_lists, user_weights=None):
+        # Binary cosine, or weighted on the user side when user_weights gives
+        # a weight per tag (e.g. the playtimes from top_tags).
+        if user_weights is None:
+            users, sizes = self._user_matrix(user_tag_lists)
+            norms = np.sqrt(sizes)
+        else:
+            users, _ = self._user_matrix(user_tag_lists)
+            users = users.astype(np.float64)
+            for row, (tags, weights) in enumerate(zip(user_tag_lists, user_weights)):
+                for tag, weight in zip(tags, weights):
+                    column = self.vocabulary.get(tag)
+                    if column is not None and column < self.clusters.shape[1]:
+                        users[row, column] = weight
+            norms = np.sqrt(np.array([sum(w * w for w in weights) for weights in user_weights]))
+        dot = (users @ self.clusters.T).toarray()
+        denominator = norms[:, None] * np.sqrt(self.cluster_sizes)[None, :]
+        scores = np.zeros(dot.shape)
+        np.divide(dot, denominator, out=scores, where=denominator > 0)
+        return scores
+
+    @staticmethod
+    def normalize(scores):
+        # Totals come from Python's sum() on each row, the same call
+        # normalize_scores makes, so they match on every Python version
+        # (3.12 made sum() of floats compensated).
+        totals = np.array([sum(row) for row in scores.tolist()], dtype=np.float64)
+        normalized = np.zeros(scores.shape)
+        np.divide(scores, totals[:, None], out=normalized, where=totals[:, None] > 0)
+        return normalized, totals > 0
+
+    def assign(self, user_tag_lists):
+        normalized, scored = self.normalize(self.jaccard(user_tag_lists))
+        return [dict(zip(self.cluster_ids, row.tolist())) if ok else {}
+                for row, ok in zip(normalized, scored)]
+
+    def top_tags(self, libraries, count=10):
+        # Flatten every (user, tag, playtime) occurrence in iteration order,
+        # sum per user and tag, then rank by total with first appearance
+        # breaking ties, which is what sorting the insertion ordered dict does.
+        entry_users, entry_games, entry_playtimes = [], [], []
+        for user, library in enumerate(libraries):
+            for game, playtime in library.items():
+                game_index = self.games.get(game)
+                if game_index is not None:
+                    entry_users.append(user)
+                    entry_games.append(game_index)
+                    entry_playtimes.append(playtime)
+        results = [[] for _ in libraries]
+        if not entry_games:
+            return results
+
+        entry_games = np.array(entry_games, dtype=np.int64)
+        starts = self.game_tag_indptr[entry_games]
+        lengths = self.game_tag_indptr[entry_games + 1] - starts
+        offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        tags = self.game_tag_indices[offsets + np.arange(lengths.sum())]
+        users = np.repeat(np.array(entry_users, dtype=np.int64), lengths)
+        playtimes = np.repeat(np.array(entry_playtimes), lengths)
+
+        keys, first, inverse = np.unique(users * len(self.tags) + tags,
+                                         return_index=True, return_inverse=True)
+        totals = np.zeros(len(keys), dtype=playtimes.dtype)
+        np.add.at(totals, inverse, playtimes)
+        key_users = keys // len(self.tags)
+        order = np.lexsort((first, -totals, key_users))
+        group_starts = np.searchsorted(key_users[order], np.arange(len(libraries)))
+        rank = np.arange(len(order)) - group_starts[key_users[order]]
+        for key in order[rank < count]:
+            results[key_users[key]].append((self.tags[keys[key] % len(self.tags)],
+                                            totals[key].item()))
+        return results
@@ -0,0 +1,99 @@
+import sqlite3
+import threading
+import time
+from decouple import config
+from responsecache import DAY
+
+VANITY_CACHE_PATH = config('VANITY_CACHE_PATH', default='../data/vanity_cache.sqlite')
+RESOLVED_TTL = config('VANITY_RESOLVED_TTL_DAYS', default=30, cast=float) * DAY
+# Shorter, since a name nobody holds today can be claimed tomorrow.
+UNRESOLVED_TTL = config('VANITY_UNRESOLVED_TTL_DAYS', default=7, cast=float) * DAY
+
+
+class VanityCache:
+    # Custom profile name to steamid64, with None kept for names the API said
+    # do not exist. Steam treats custom URLs case-insensitively, so keys are
+    # lowercased. Failed requests are never stored.
+    def __init__(self, path=VANITY_CACHE_PATH, resolved_ttl=RESOLVED_TTL,
+                 unresolved_ttl=UNRESOLVED_TTL):
+        self.path = path
+        self.resolved_ttl = resolved_ttl
+        self.unresolved_ttl = unresolved_ttl
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS vanity (
+            name TEXT PRIMARY KEY,
+            steamid TEXT,
+            resolved REAL)''')
+
+    def lookup(self, name):
+        # (True, steamid or None) when the answer is known, (False, None) when
+        # the name has to be resolved.
+        with self.lock:
+            row = self.conn.execute('SELECT steamid, resolved FROM vanity WHERE name = ?',
+                                    (name.lower(),)).fetchone()
+            if row is not None:
+                steamid, resolved = row
+                ttl = self.resolved_ttl if steamid is not None else self.unresolved_ttl
+                if time.time() - resolved <= ttl:
+                    if steamid is None:
+                        self.negative_hits += 1
+                    else:
+                        self.hits += 1
+                    return True, steamid
+            self.misses += 1
+        return False, None
+
+    def store(self, name, steamid):
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO vanity VALUES (?, ?, ?)',
+                              (name.lower(), steamid, time.time()))
+            self.conn.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute('SELECT COUNT(*) FROM vanity').fetchone()[0]
+
+    def stats(self):
+        return {'hits': self.hits, 'negative_hits': self.negative_hits, 'misses': self.misses,
+                'entries': len(self)}
+
+    def summary(self):
+        return ('Vanity cache: {hits} resolved and {negative_hits} unresolvable names answered, '
+                '{misses} not cached, {entries} names stored'.format(**self.stats()))
+
+    def close(self):
+        self.conn.close()
+
+
+class NullVanityCache:
+    def lookup(self, name):
+        return False, None
+
+    def store(self, name, steamid):
+        pass
+
+    def stats(self):
+        return {}
+
+    def summary(self):
+        return 'Vanity cache disabled.'
+
+
+_cache = None
+
+
+def get_vanity_cache():
+    global _cache
+    if _cache is None:
+        _cache = VanityCache()
+    return _cache
+
+
+def disable_vanity_cache():
+    global _cache
+    _cache = NullVanityCache()
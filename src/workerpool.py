@@ -0,0 +1,13 @@
+import asyncio
+
+
+async def run_pool(items, concurrency, handle):
+    queue = asyncio.Queue()
+    for item in items:
+        queue.put_nowait(item)
+
+    async def worker():
+        while not queue.empty():
+            await handle(queue.get_nowait())
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
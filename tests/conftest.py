@@ -0,0 +1,65 @@
+import os
+import sys
+
+import pytest
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC_DIR)
+# getlibraries reads the key on import; the tests only ever talk to stubsteam.
+os.environ.setdefault('STEAM_API_KEY', 'test')
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    # The scripts read and write ../data and ../models, so every test runs
+    # from the src folder of its own scratch copy of the layout.
+    for name in ('src', 'data', 'models'):
+        (tmp_path / name).mkdir()
+    monkeypatch.chdir(tmp_path / 'src')
+    return tmp_path
+
+
+@pytest.fixture
+def caches(tmp_path, monkeypatch):
+    # No response cache, so every call reaches the stub, and a vanity cache of
+    # the test's own.
+    import responsecache
+    import vanitycache
+    monkeypatch.setattr(responsecache, '_cache', responsecache.NullCache())
+    cache = vanitycache.VanityCache(str(tmp_path / 'vanity.sqlite'))
+    monkeypatch.setattr(vanitycache, '_cache', cache)
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def serve(monkeypatch):
+    # Starts a stubsteam app inside the running event loop and points the
+    # getlibraries API urls at it.
+    import contextlib
+    from aiohttp.test_utils import TestServer
+    import getlibraries
+
+    urls = {name: getattr(getlibraries, name)
+            for name in ('VANITY_URL', 'SUMMARIES_URL', 'OWNED_GAMES_URL')}
+
+    @contextlib.asynccontextmanager
+    async def start(app):
+        server = TestServer(app)
+        await server.start_server()
+        base = str(server.make_url('')).rstrip('/')
+        for name, url in urls.items():
+            monkeypatch.setattr(getlibraries, name, url.replace(getlibraries.API_BASE, base))
+        try:
+            yield base
+        finally:
+            await server.close()
+    return start
+
+
+def run_script(script, *args):
+    import subprocess
+    result = subprocess.run([sys.executable, os.path.join(SRC_DIR, script)] + list(args),
+                            stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout[-2000:] + result.stderr[-2000:]
+    return result.stdout
@@ -0,0 +1,65 @@
+import json
+
+import numpy as np
+
+from artifacts import load_columns, load_libraries
+from conftest import run_script
+from synthdata import generate_dataset, save_dataset
+
+
+def fit(workspace, users=600):
+    libraries, game_tags, game_appids = generate_dataset(users, num_games=300, num_tags=40,
+                                                         seed=3, archetypes=6)
+    save_dataset(str(workspace / 'data'), libraries, game_tags, game_appids)
+    run_script('createinputdata.py')
+    run_script('createclusters.py', '--eps', '0.3', '--merge-threshold', '0.5')
+    return libraries
+
+
+def write_checkpoint(path, libraries, rows):
+    with open(path, 'w', encoding='utf-8') as f:
+        for row in rows:
+            steamid = str(libraries.steamids[row])
+            f.write(json.dumps({'id': steamid, 'steamid': steamid,
+                                'library': libraries.library(row), 'appids': {}}) + '\n')
+
+
+def stats(workspace):
+    with open(workspace / 'data' / 'cluster_stats.json', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def test_training_rows_keep_their_labels_and_stats(workspace):
+    libraries = fit(workspace)
+    fitted_labels = load_columns('../data/dbscan_cluster_labels', mmap=False)
+    before = stats(workspace)
+
+    write_checkpoint(workspace / 'data' / 'again.jsonl', libraries, range(len(libraries)))
+    run_script('assignclusters.py', '../data/again.jsonl')
+
+    labels = load_columns('../data/dbscan_cluster_labels', mmap=False)
+    assert list(labels['LibraryID']) == list(fitted_labels['LibraryID'])
+    fitted_core = np.asarray(fitted_labels['Cluster']) >= 0
+    assert (labels['Cluster'][fitted_core] == fitted_labels['Cluster'][fitted_core]).all()
+    after = stats(workspace)
+    assert after['clusters'] == before['clusters']
+    assert after['assigned'] == before['assigned']
+    assert not after['refit_recommended']
+
+
+def test_assigning_the_same_libraries_twice_counts_them_once(workspace):
+    fitted = fit(workspace)
+    extra, _, _ = generate_dataset(700, num_games=300, num_tags=40, seed=3, archetypes=6)
+    new_rows = range(len(fitted), len(extra))
+    write_checkpoint(workspace / 'data' / 'new.jsonl', extra, new_rows)
+
+    run_script('assignclusters.py', '../data/new.jsonl')
+    once = stats(workspace)
+    assert once['assigned']['libraries'] == len(new_rows)
+    run_script('assignclusters.py', '../data/new.jsonl')
+    twice = stats(workspace)
+
+    assert twice['assigned'] == once['assigned']
+    assert twice['clusters'] == once['clusters']
+    assert len(load_libraries('../data/libraries')) == len(extra)
+    assert len(load_columns('../data/merged_dbscan_cluster_labels')['LibraryID']) == len(extra)
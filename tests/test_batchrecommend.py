@@ -0,0 +1,44 @@
+import asyncio
+import collections
+import json
+
+from aiohttp import web
+
+from batchrecommend import batch_recommend
+from stubsteam import build_fake_steam, create_app
+
+
+class CountingModel:
+    def recommend_many(self, users):
+        return [{'games': len(user_games)} for _, user_games in users]
+
+
+def test_visibility_and_names_are_checked_in_bulk(serve, caches, tmp_path):
+    users, vanity, _ = build_fake_steam(150, 30, seed=8)
+    by_name = {steamid: name for name, steamid in vanity.items()}
+    ids = [by_name.get(steamid, steamid) for steamid in users] + ['nobodyhere']
+    app = create_app(users, vanity)
+    calls = collections.Counter()
+
+    @web.middleware
+    async def count(request, handler):
+        calls[request.path.split('/')[2]] += 1
+        return await handler(request)
+    app.middlewares.append(count)
+
+    output = str(tmp_path / 'recommendations.jsonl')
+
+    async def run():
+        async with serve(app):
+            return await batch_recommend(ids, output, CountingModel(), processes=2,
+                                         requests_per_minute=60000, burst=100)
+    counts = asyncio.run(run())
+
+    public = [steamid for steamid, user in users.items() if user['visibility'] == 3]
+    assert calls['GetPlayerSummaries'] == 2
+    assert calls['ResolveVanityURL'] == len(vanity) + 1
+    assert calls['GetOwnedGames'] == len(public)
+    with open(output, encoding='utf-8') as f:
+        records = {record['id']: record for record in map(json.loads, f)}
+    assert len(records) == len(ids) == counts['recommended'] + counts['failed']
+    assert records['nobodyhere']['error'] == 'Custom URL could not be resolved.'
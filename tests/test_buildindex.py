@@ -0,0 +1,25 @@
+from artifacts import load_columns, save_columns
+from conftest import run_script
+from singleuser import load_recommendation_index
+from synthdata import generate_dataset, save_dataset
+
+
+def test_index_is_ignored_once_the_cluster_labels_change(workspace, capsys):
+    libraries, game_tags, game_appids = generate_dataset(300, num_games=200, num_tags=30,
+                                                         seed=5, archetypes=4)
+    save_dataset(str(workspace / 'data'), libraries, game_tags, game_appids)
+    run_script('createinputdata.py')
+    run_script('createclusters.py', '--eps', '0.3', '--merge-threshold', '0.5')
+    run_script('buildindex.py')
+    assert load_recommendation_index() is not None
+
+    # Stands in for a createclusters re-run without buildindex.
+    labels = load_columns('../data/merged_dbscan_cluster_labels', mmap=False)
+    labels['MergedCluster'] = labels['MergedCluster'][::-1].copy()
+    save_columns('../data/merged_dbscan_cluster_labels', labels)
+    capsys.readouterr()
+
+    assert load_recommendation_index() is None
+    assert 'Re-run buildindex' in capsys.readouterr().out
+    run_script('buildindex.py')
+    assert load_recommendation_index() is not None
@@ -0,0 +1,97 @@
+import asyncio
+import json
+
+import getlibraries
+from artifacts import load_libraries
+from getlibraries import LibraryCheckpoint, async_fetch_libraries, compact_checkpoint
+from stubsteam import build_fake_steam, create_app
+
+
+def crawl(serve, app, batches, checkpoint_path):
+    # Each batch is one run of the crawl, reopening the checkpoint like a
+    # restarted getlibraries would, and only asking for ids not in it yet.
+    async def run():
+        async with serve(app):
+            for ids in batches:
+                checkpoint = LibraryCheckpoint(checkpoint_path)
+                try:
+                    await async_fetch_libraries(
+                        [id for id in ids if id not in checkpoint.completed], checkpoint,
+                        requests_per_minute=60000, burst=100)
+                finally:
+                    checkpoint.close()
+    asyncio.run(run())
+
+
+def expected_libraries(users):
+    return {steamid: {game['name']: game['playtime_forever'] for game in user['games']}
+            for steamid, user in users.items()
+            if user['visibility'] == 3 and any(game['playtime_forever'] for game in user['games'])}
+
+
+def test_interrupted_crawl_resumes_from_the_checkpoint(serve, caches, tmp_path):
+    users, vanity, _ = build_fake_steam(120, 40, seed=4)
+    by_name = {steamid: name for name, steamid in vanity.items()}
+    ids = [by_name.get(steamid, steamid) for steamid in users]
+    path = str(tmp_path / 'libraries_ids.jsonl')
+
+    crawl(serve, create_app(users, vanity), [ids[:50]], path)
+    # A crash in the middle of a write leaves a partial last line behind.
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('{"id": "' + ids[50])
+    crawl(serve, create_app(users, vanity), [ids, ids], path)
+
+    with open(path, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert sorted(record['id'] for record in records) == sorted(ids)
+
+    fetched, total = compact_checkpoint(path, str(tmp_path / 'libraries'),
+                                        str(tmp_path / 'game_ids.json'))
+    expected = expected_libraries(users)
+    assert (fetched, total) == (len(expected), len(ids))
+    table = load_libraries(str(tmp_path / 'libraries'))
+    assert {str(table.steamids[row]): table.library(row) for row in range(len(table))} == expected
+
+
+def test_crawl_survives_rate_limits(serve, caches, tmp_path, monkeypatch):
+    users, vanity, _ = build_fake_steam(30, 20, seed=5)
+    # Skip the Retry-After waits, only the retry logic is under test.
+    sleep = asyncio.sleep
+    monkeypatch.setattr(getlibraries.asyncio, 'sleep', lambda seconds: sleep(0))
+    path = str(tmp_path / 'libraries_ids.jsonl')
+
+    crawl(serve, create_app(users, {}, error_rate=0.3, seed=5), [list(users)], path)
+
+    fetched, _ = compact_checkpoint(path, str(tmp_path / 'libraries'),
+                                    str(tmp_path / 'game_ids.json'))
+    assert fetched == len(expected_libraries(users))
+
+
+def test_malformed_replies_are_retried(serve, caches, tmp_path, monkeypatch):
+    from aiohttp import web
+    users, vanity, _ = build_fake_steam(30, 20, seed=6)
+    sleep = asyncio.sleep
+    monkeypatch.setattr(getlibraries.asyncio, 'sleep', lambda seconds: sleep(0))
+    app = create_app(users, {})
+    broken = set()
+
+    @web.middleware
+    async def truncate(request, handler):
+        # The first reply for every library is cut off halfway, or is an HTML
+        # error page for the summaries.
+        key = request.path + request.query.get('steamid', '')
+        if key not in broken:
+            broken.add(key)
+            if 'GetOwnedGames' in request.path:
+                return web.Response(text='{"response": {"games": [',
+                                    content_type='application/json')
+            return web.Response(text='<html>Error</html>', content_type='text/html')
+        return await handler(request)
+    app.middlewares.append(truncate)
+    path = str(tmp_path / 'libraries_ids.jsonl')
+
+    crawl(serve, app, [list(users)], path)
+
+    fetched, _ = compact_checkpoint(path, str(tmp_path / 'libraries'),
+                                    str(tmp_path / 'game_ids.json'))
+    assert fetched == len(expected_libraries(users))
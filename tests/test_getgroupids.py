@@ -0,0 +1,103 @@
+import asyncio
+import json
+
+from aiohttp.test_utils import TestServer
+
+from getgroupids import SteamIdSet, async_collect_group_ids
+from getlibraries import LibraryCheckpoint, async_fetch_stream
+from ratelimit import TokenBucket
+from stubsteam import build_fake_groups, build_fake_steam, create_app
+
+
+def collect(app, names, goal, output):
+    async def run():
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            groups = [str(server.make_url('/groups/' + name)) for name in names]
+            return await async_collect_group_ids(groups, goal, output,
+                                                 requests_per_minute=60000)
+        finally:
+            await server.close()
+    return asyncio.run(run())
+
+
+def read_ids(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read().split()
+
+
+def test_every_page_of_every_group_is_collected_once(tmp_path):
+    users, vanity, _ = build_fake_steam(500, 10, seed=6)
+    groups = build_fake_groups(users, 3, seed=6)
+    app = create_app(users, vanity, groups=groups, member_page_size=40)
+    output = str(tmp_path / 'ids.txt')
+
+    seen = collect(app, sorted(groups), 10 ** 6, output)
+
+    members = set().union(*groups.values())
+    ids = read_ids(output)
+    assert len(ids) == len(set(ids)) == len(seen)
+    assert set(ids) == members
+    assert app['requests'] == sum(-(-len(group) // 40) for group in groups.values())
+
+
+def test_collection_stops_at_the_goal(tmp_path):
+    users, vanity, _ = build_fake_steam(500, 10, seed=7)
+    groups = build_fake_groups(users, 2, seed=7)
+    output = str(tmp_path / 'ids.txt')
+
+    collect(create_app(users, vanity, groups=groups, member_page_size=40),
+            sorted(groups), 75, output)
+
+    ids = read_ids(output)
+    assert len(ids) == len(set(ids)) == 75
+    assert set(ids) <= set().union(*groups.values())
+
+
+def test_steamid_set_dedupes_across_flushes():
+    seen = SteamIdSet(min_flush=4)
+    base = 76561197960265728
+    first = seen.add_many([str(base + i) for i in (5, 1, 5, 9, 3)], 100)
+    second = seen.add_many([str(base + i) for i in (1, 2, 9, 7, 2)], 3)
+    assert first == [str(base + i) for i in (5, 1, 9, 3)]
+    assert second == [str(base + i) for i in (2, 7)]
+    assert len(seen) == 6
+
+
+def test_fetch_consumes_ids_as_they_are_collected(serve, caches, tmp_path):
+    users, vanity, _ = build_fake_steam(300, 20, seed=9)
+    groups = build_fake_groups(users, 2, seed=9)
+    app = create_app(users, vanity, groups=groups, member_page_size=25)
+    output = str(tmp_path / 'ids.txt')
+    checkpoint = LibraryCheckpoint(str(tmp_path / 'libraries_ids.jsonl'))
+    queues = []
+
+    async def fetch(session, queue):
+        queues.append(queue)
+        await async_fetch_stream(session, TokenBucket.per_minute(60000, 100, 'steam_api'),
+                                 queue, checkpoint, concurrency=4)
+
+    async def run():
+        async with serve(app) as base:
+            return await async_collect_group_ids(
+                [base + '/groups/' + name for name in sorted(groups)], 200, output,
+                fetch, queue_size=5, requests_per_minute=60000)
+    try:
+        seen = asyncio.run(run())
+    finally:
+        checkpoint.close()
+
+    assert queues[0].maxsize == 5 and queues[0].empty()
+    ids = read_ids(output)
+    assert len(ids) == len(set(ids)) == len(seen) == 200
+    with open(tmp_path / 'libraries_ids.jsonl', encoding='utf-8') as f:
+        records = {record['id']: record for record in map(json.loads, f)}
+    assert set(records) == set(ids)
+    for steamid, record in records.items():
+        user = users[steamid]
+        playtimes = {game['name']: game['playtime_forever'] for game in user['games']}
+        if user['visibility'] == 3 and any(playtimes.values()):
+            assert record['library'] == playtimes
+        else:
+            assert record['library'] is None
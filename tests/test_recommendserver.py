@@ -0,0 +1,74 @@
+import asyncio
+import collections
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from recommendserver import RecommendationModel, create_app
+from stubsteam import build_fake_steam, create_app as create_stub
+
+
+class StubIndex:
+    def top_games(self, cluster_number, user_games):
+        return [('Recommended ' + str(cluster_number), 1)]
+
+
+def test_recommendations_share_fetches_and_cache_failures(serve, caches):
+    users, vanity, games = build_fake_steam(40, 20, seed=10)
+    public = next(steamid for steamid, user in users.items() if user['visibility'] == 3 and
+                  any(game['playtime_forever'] for game in user['games']))
+    private = next(steamid for steamid, user in users.items() if user['visibility'] != 3)
+    down = next(steamid for steamid in users if steamid not in (public, private))
+    game_tags = {game['name']: ['Tag ' + str(i % 5), 'Tag ' + str(i % 3)]
+                 for i, game in enumerate(games)}
+    model = RecommendationModel(game_tags, {'0': ['Tag 0', 'Tag 1'], '1': ['Tag 2']},
+                                StubIndex())
+
+    stub = create_stub(users, vanity)
+    calls = collections.Counter()
+
+    @web.middleware
+    async def count(request, handler):
+        steamid = request.query.get('steamid', request.query.get('steamids', ''))
+        calls[request.path.split('/')[2], steamid] += 1
+        if steamid == down:
+            # A status that is not retried, so the fetch gives up at once.
+            return web.Response(status=404)
+        return await handler(request)
+    stub.middlewares.append(count)
+
+    async def run():
+        async with serve(stub):
+            server = TestServer(create_app(model, requests_per_minute=60000, burst=100))
+            await server.start_server()
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async def get(steamid):
+                        async with session.get(server.make_url('/recommend/' + steamid)) as r:
+                            return r.status, await r.json()
+
+                    together = await asyncio.gather(*(get(public) for _ in range(5)))
+                    again = await get(public)
+                    missing = [await get(private), await get(private)]
+                    failing = [await get(down), await get(down)]
+                    fetcher = server.app['fetcher']
+                    fetcher.cache.entries[private] = (0, False)
+                    expired = await get(private)
+                    return together, again, missing, failing, expired, dict(fetcher.counts)
+            finally:
+                await server.close()
+    together, again, missing, failing, expired, counts = asyncio.run(run())
+
+    assert [status for status, _ in together] == [200] * 5
+    assert all(body == together[0][1] for _, body in together + [again])
+    assert calls['GetOwnedGames', public] == 1
+    assert counts['coalesced'] == 4 and counts['cache_hits'] >= 1
+
+    assert [status for status, _ in missing] == [404, 404]
+    assert calls['GetPlayerSummaries', private] == 2
+    assert expired[0] == 404
+
+    assert [status for status, _ in failing] == [503, 503]
+    assert calls['GetPlayerSummaries', down] == 2
+    assert counts['upstream_failures'] == 2
@@ -0,0 +1,49 @@
+import json
+import random
+
+from singleuser import BLACKLIST, assign_clusters, get_top_tags_by_playtime
+from synthdata import generate_dataset
+from tagscoring import TagScorer
+
+
+def sample_users(count=300):
+    libraries, game_tags, _ = generate_dataset(count, num_games=200, num_tags=30, seed=11,
+                                               archetypes=5)
+    rng = random.Random(11)
+    users = [libraries.top().library(row) for row in range(len(libraries))]
+    games = list(game_tags)
+    # Equal playtimes tie on tag totals, and libraries without any tagged
+    # game have no top tags at all.
+    users += [{game: 600 for game in rng.sample(games, 4)} for _ in range(20)]
+    users += [{}, {'Not A Real Game': 100}, {games[0]: 0}]
+    return users, game_tags
+
+
+def cluster_tags(game_tags, count=25):
+    rng = random.Random(12)
+    tags = sorted({tag for values in game_tags.values() for tag in values})
+    clusters = {str(i): rng.sample(tags, rng.randint(3, 8)) for i in range(count)}
+    clusters[str(count)] = []
+    return clusters
+
+
+def test_top_tags_match_the_dict_version():
+    users, game_tags = sample_users()
+    scorer = TagScorer(cluster_tags(game_tags), game_tags, BLACKLIST)
+
+    assert scorer.top_tags(users) == [get_top_tags_by_playtime(user, game_tags, BLACKLIST)
+                                      for user in users]
+
+
+def test_cluster_assignment_matches_the_dict_version(tmp_path):
+    users, game_tags = sample_users()
+    clusters = cluster_tags(game_tags)
+    cluster_file = str(tmp_path / 'merged_clusters.json')
+    with open(cluster_file, 'w', encoding='utf-8') as f:
+        json.dump(clusters, f)
+    scorer = TagScorer(clusters, game_tags, BLACKLIST)
+    user_tags = [[tag for tag, _ in tags] for tags in scorer.top_tags(users)]
+    user_tags.append(['No Cluster Has This'])
+
+    assert scorer.assign(user_tags) == [assign_clusters(tags, cluster_file)
+                                        for tags in user_tags]
@@ -0,0 +1,88 @@
+import asyncio
+
+import getlibraries
+from stubsteam import build_fake_steam, create_app
+from vanitycache import DAY
+
+
+def resolve(serve, app, *batches):
+    # One event loop for every batch, an aiohttp app cannot move between loops.
+    async def run():
+        async with serve(app):
+            return [await getlibraries.async_resolve_only(ids, requests_per_minute=60000,
+                                                          burst=100)
+                    for ids in batches]
+    return asyncio.run(run())
+
+
+def test_second_resolution_is_answered_from_the_cache(serve, caches):
+    users, vanity, _ = build_fake_steam(200, 20, seed=1)
+    names = sorted(vanity)[:10]
+    app = create_app(users, vanity)
+
+    first, second = resolve(serve, app,
+                            names + [name.upper() for name in names] + ['nobodyhere'],
+                            names + ['nobodyhere'])
+
+    assert all(first[name] == vanity[name] for name in names)
+    assert first['nobodyhere'] is None
+    assert app['requests'] == len(names) + 1
+    assert second == {name: first[name] for name in names + ['nobodyhere']}
+    assert caches.stats()['hits'] == len(names)
+    assert caches.stats()['negative_hits'] == 1
+
+
+def test_unresolved_names_expire_sooner(caches):
+    caches.store('taken', '76561197960265728')
+    caches.store('unclaimed', None)
+    caches.conn.execute('UPDATE vanity SET resolved = resolved - ?', (8 * DAY,))
+
+    assert caches.lookup('taken') == (True, '76561197960265728')
+    assert caches.lookup('UNCLAIMED') == (False, None)
+
+
+def test_only_a_no_match_answer_is_negatively_cached(caches):
+    resolve = getlibraries.resolve_vanity_response
+    assert resolve('gone', {'response': {'success': 42}}) == (None, True)
+    assert resolve('failed', {}) == (None, False)
+    assert resolve('odd', {'response': {'success': 2}}) == (None, False)
+
+    assert caches.lookup('gone') == (True, None)
+    assert caches.lookup('failed') == (False, None)
+    assert caches.lookup('odd') == (False, None)
+
+
+def test_failed_requests_are_asked_again(serve, caches):
+    from aiohttp import web
+    users, vanity, _ = build_fake_steam(50, 10, seed=2)
+    name = sorted(vanity)[0]
+
+    async def not_found(request):
+        return web.Response(status=404)
+    broken = web.Application()
+    broken.router.add_get('/ISteamUser/ResolveVanityURL/v0001/', not_found)
+
+    assert resolve(serve, broken, [name]) == [{name: None}]
+    assert len(caches) == 0
+    assert resolve(serve, create_app(users, vanity), [name]) == [{name: vanity[name]}]
+
+
+def test_expired_unresolved_name_is_requested_again(serve, caches, tmp_path, monkeypatch):
+    import responsecache
+    http_cache = responsecache.ResponseCache(str(tmp_path / 'http_cache.sqlite'))
+    monkeypatch.setattr(responsecache, '_cache', http_cache)
+    users, vanity, _ = build_fake_steam(20, 5, seed=3)
+    app = create_app(users, vanity)
+
+    async def run():
+        async with serve(app):
+            first = await getlibraries.async_resolve_only(['nobodyhere'])
+            again = await getlibraries.async_resolve_only(['nobodyhere'])
+            caches.conn.execute('UPDATE vanity SET resolved = resolved - ?', (8 * DAY,))
+            expired = await getlibraries.async_resolve_only(['nobodyhere'])
+            return first, again, expired, app['requests']
+    first, again, expired, requests = asyncio.run(run())
+    http_cache.close()
+
+    assert first == again == expired == {'nobodyhere': None}
+    assert requests == 2